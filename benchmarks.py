@@ -0,0 +1,285 @@
+"""
+Timing benchmarks for the slow parts of the toolbox.
+
+Run from the command line with the name of a benchmark, e.g.::
+
+    python benchmarks.py fits_summary
+
+Each benchmark builds its own synthetic data in a temporary directory
+and prints a small table of timings.
+"""
+import sys
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time, sleep
+
+import numpy as np
+import pyfits
+
+import image_collection as tff
+
+
+def synthetic_directory(n_files=500, shape=(64, 64), directory=None):
+    """
+    Write `n_files` small FITS files with Feder-like headers.
+
+    Returns the name of the directory, which is created with `mkdtemp`
+    unless `directory` is given.
+    """
+    if directory is None:
+        directory = mkdtemp()
+    image_types = ['LIGHT', 'BIAS', 'DARK', 'FLAT']
+    filters = ['R', 'V', 'B', 'I']
+    data = np.zeros(shape, dtype=np.int16)
+    for i in range(n_files):
+        hdu = pyfits.PrimaryHDU(data)
+        hdu.header.update('imagetyp', image_types[i % len(image_types)])
+        hdu.header.update('filter', filters[(i / 4) % len(filters)])
+        hdu.header.update('exptime', float(i % 3) * 30)
+        hdu.header.update('date-obs',
+                          '2012-03-%02dT%02d:%02d:00' % (1 + i / 1440,
+                                                         (i / 60) % 24,
+                                                         i % 60))
+        hdu.writeto(path.join(directory, 'img%05d.fit' % i))
+    return directory
+
+
+def _best_time(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time()
+        func()
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_fits_summary(n_files=500, workers=[1, 2, 4, 8, 16],
+                       latency=0.002):
+    """
+    Time `fits_summary` against the number of worker threads.
+
+    `latency` is a delay, in seconds, added to every header read to
+    mimic files on network storage; set it to zero to time the local
+    disk alone.
+    """
+    directory = synthetic_directory(n_files)
+    read_header_values = tff.read_header_values
+
+    def slow_read(*arg, **kwd):
+        sleep(latency)
+        return read_header_values(*arg, **kwd)
+
+    keywords = ['imagetyp', 'filter', 'exptime', 'date-obs']
+    tff.read_header_values = slow_read
+    try:
+        print '%d files, %.1f ms latency per header' % (n_files,
+                                                          latency * 1000)
+        print '%8s %10s %8s' % ('workers', 'seconds', 'speedup')
+        serial = None
+        for n_workers in workers:
+            def summarize():
+                collection = tff.ImageFileCollection(directory,
+                                                     info_file=None)
+                collection.fits_summary(keywords=keywords,
+                                        workers=n_workers)
+            elapsed = _best_time(summarize)
+            if serial is None:
+                serial = elapsed
+            print '%8d %10.3f %8.2f' % (n_workers, elapsed, serial / elapsed)
+    finally:
+        tff.read_header_values = read_header_values
+        rmtree(directory)
+
+
+def bench_header_reader(n_files=500):
+    """
+    Compare the raw header reader with `pyfits.getheader`.
+    """
+    directory = synthetic_directory(n_files)
+    keywords = ['imagetyp', 'filter', 'exptime', 'date-obs']
+    files = [path.join(directory, 'img%05d.fit' % i) for i in range(n_files)]
+
+    def with_pyfits():
+        for fname in files:
+            header = pyfits.getheader(fname)
+            [header[keyword] for keyword in keywords if keyword in header]
+
+    def with_raw_reader():
+        for fname in files:
+            tff.read_header_values(fname, keywords)
+
+    try:
+        print '%d files' % n_files
+        print '%12s %10s' % ('reader', 'seconds')
+        print '%12s %10.3f' % ('pyfits', _best_time(with_pyfits))
+        print '%12s %10.3f' % ('raw', _best_time(with_raw_reader))
+    finally:
+        rmtree(directory)
+
+
+def _synthetic_summary(n_rows):
+    image_types = ['LIGHT', 'BIAS', 'DARK', 'FLAT']
+    filters = ['R', 'V', 'B', 'I', 'clear']
+    file_values = []
+    for i in range(n_rows):
+        values = {'imagetyp': image_types[i % len(image_types)],
+                  'exptime': float(i % 7) * 10}
+        if i % 11:
+            values['filter'] = filters[(i / 4) % len(filters)]
+        file_values.append(('img%06d.fit' % i, values))
+    return tff._summary_table(file_values, ['imagetyp', 'filter', 'exptime'],
+                              -999.0)
+
+
+def bench_files_filtered(n_rows=100000, n_queries=20):
+    """
+    Time `files_filtered` on a large synthetic summary against a
+    row-by-row scan of the table.
+    """
+    directory = mkdtemp()
+    try:
+        collection = tff.ImageFileCollection(directory, info_file=None)
+        collection.summary_info = _synthetic_summary(n_rows)
+        summary = collection.summary_info
+        query = {'imagetyp': 'LIGHT', 'filter': 'R'}
+
+        def scan():
+            matches = np.array([True] * len(summary))
+            for key, value in query.items():
+                have_this_value = np.array([False] * len(summary))
+                for idx, file_key_value in enumerate(summary[key]):
+                    have_this_value[idx] = (file_key_value.lower() ==
+                                            value.lower())
+                matches &= have_this_value
+            return summary['file'][matches]
+
+        start = time()
+        first = collection.files_filtered(**query)
+        build = time() - start
+        start = time()
+        for i in range(n_queries):
+            indexed = collection.files_filtered(**query)
+        per_query = (time() - start) / n_queries
+        scanned = scan()
+        assert (np.sort(indexed) == np.sort(scanned)).all()
+
+        print '%d rows, %d matches' % (n_rows, len(indexed))
+        print '%22s %10s' % ('method', 'seconds')
+        print '%22s %10.4f' % ('row scan', _best_time(scan, repeat=1))
+        print '%22s %10.4f' % ('index, first query', build)
+        print '%22s %10.4f' % ('index, later queries', per_query)
+    finally:
+        rmtree(directory)
+
+
+def bench_combine(n_images=20, shape=(1024, 1024), workers=[1, 2, 4, 8],
+                  method='median'):
+    """
+    Throughput of `combine.tiled_combine` against the number of worker
+    processes, in megapixels of input per second.
+    """
+    from combine import tiled_combine
+
+    directory = mkdtemp()
+    try:
+        random = np.random.RandomState(0)
+        file_names = []
+        for i in range(n_images):
+            data = random.randint(0, 2**16, size=shape).astype(np.uint16)
+            file_name = path.join(directory, 'bias%03d.fit' % i)
+            pyfits.PrimaryHDU(data, uint=True).writeto(file_name)
+            file_names.append(file_name)
+        megapixels = n_images * np.prod(shape) / 1e6
+        print '%d images of %d x %d, %s' % (n_images, shape[0], shape[1],
+                                             method)
+        print '%8s %10s %10s %8s' % ('workers', 'seconds', 'Mpix/s',
+                                     'speedup')
+        serial = None
+        for n_workers in workers:
+            elapsed = _best_time(lambda: tiled_combine(file_names,
+                                                       method=method,
+                                                       workers=n_workers))
+            if serial is None:
+                serial = elapsed
+            print '%8d %10.3f %10.1f %8.2f' % (n_workers, elapsed,
+                                                megapixels / elapsed,
+                                                serial / elapsed)
+    finally:
+        rmtree(directory)
+
+
+def synthetic_reduction_directory(n_lights=40, shape=(512, 512),
+                                  directory=None):
+    """
+    Write a master dark and flat and `n_lights` unsigned 16 bit light
+    frames, all with the same exposure time and filter.
+
+    Returns the name of the directory and the list of light file names.
+    """
+    if directory is None:
+        directory = mkdtemp()
+    random = np.random.RandomState(0)
+    masters = [('MASTER DARK', random.normal(100, 5, size=shape)),
+               ('MASTER FLAT', random.normal(20000, 500, size=shape))]
+    for image_type, data in masters:
+        hdu = pyfits.PrimaryHDU(data)
+        hdu.header.update('imagetyp', image_type)
+        hdu.header.update('exptime', 30.0)
+        hdu.header.update('filter', 'R')
+        hdu.writeto(path.join(directory,
+                              image_type.replace(' ', '_') + '.fit'))
+    lights = []
+    for i in range(n_lights):
+        data = random.randint(1000, 30000, size=shape).astype(np.uint16)
+        hdu = pyfits.PrimaryHDU(data, uint=True)
+        hdu.header.update('imagetyp', 'LIGHT')
+        hdu.header.update('exptime', 30.0)
+        hdu.header.update('filter', 'R')
+        lights.append('light%04d.fit' % i)
+        hdu.writeto(path.join(directory, lights[-1]))
+    return directory, lights
+
+
+def bench_reduce(n_lights=40, shape=(512, 512), batch_sizes=[1, 8, 32],
+                 workers=[2, 4, 8]):
+    """
+    Time `reduction.reduce` with the astropysics pipeline against the
+    batched reduction engine, in one process and with several `workers`
+    processes.
+    """
+    import reduction
+
+    directory, lights = synthetic_reduction_directory(n_lights, shape)
+    output = mkdtemp()
+    try:
+        print '%d frames of %d x %d' % (n_lights, shape[0], shape[1])
+        print '%12s %10s %10s' % ('engine', 'seconds', 'frames/s')
+        runs = ([('pipeline', None, 1)] +
+                [('batch %d' % size, size, 1) for size in batch_sizes] +
+                [('%d workers' % n, 8, n) for n in workers])
+        for name, batch_size, n_workers in runs:
+            elapsed = _best_time(lambda: reduction.reduce(lights, directory,
+                                                          destination=output,
+                                                          batch_size=batch_size,
+                                                          workers=n_workers))
+            print '%12s %10.3f %10.1f' % (name, elapsed, n_lights / elapsed)
+    finally:
+        rmtree(directory)
+        rmtree(output)
+
+
+benchmarks = {'fits_summary': bench_fits_summary,
+              'reduce': bench_reduce,
+              'combine': bench_combine,
+              'header_reader': bench_header_reader,
+              'files_filtered': bench_files_filtered}
+
+
+if __name__ == "__main__":
+    to_run = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in to_run:
+        print '== %s' % name
+        benchmarks[name]()
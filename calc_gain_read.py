@@ -1,13 +1,12 @@
-from image_collection import ImageFileCollection
+from image_collection import ImageFileCollection, MappedImage
 from  ccd_characterization import ccd_gain, ccd_read_noise
 from numpy import array
-from astropysics import ccd
 
 def as_images(tbl, src_dir):
     from os import path
     img = []
     for tb in tbl:
-        img.append(ccd.FitsImage(path.join(src_dir, tb['file'])).data[1:,:])
+        img.append(MappedImage(path.join(src_dir, tb['file']))[:, 1:])
     return img
         
 def calc_gain_read(src_dir):
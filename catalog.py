@@ -0,0 +1,225 @@
+"""
+SQLite catalog of FITS header summaries.
+
+A catalog keeps one row per file, indexed by directory and file name,
+with a column for each FITS keyword that has been summarized. Keyword
+columns are indexed and compared case-insensitively, so queries like
+those of :meth:`image_collection.ImageFileCollection.files_filtered`
+run as indexed SQL without opening any FITS file.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from os import path
+import os
+
+import numpy.ma as ma
+
+_reserved_columns = ['directory', 'file', 'size', 'mtime']
+
+
+def _quote(name):
+    """Quote `name` for use as an SQL identifier."""
+    return '"%s"' % name.replace('"', '""')
+
+
+class SummaryCatalog(object):
+    """
+    SQLite store of summary information for many directories.
+
+    `file_name` is the name of the database file; it is created if
+    needed. Use ':memory:' for a catalog that is not saved.
+
+    A catalog may be shared by several threads, e.g. those scanning the
+    directories of an :class:`image_collection.ImageFileArchive`; its
+    statements are run one at a time.
+
+    To catalog a directory and find its R band flats::
+
+        catalog = SummaryCatalog('archive.sqlite')
+        images = ImageFileCollection('2012-03-01',
+                                     keywords=['imagetyp', 'filter'])
+        catalog.update(images.location, images.summary_info)
+        catalog.files_filtered(imagetyp='flat', filter='R')
+    """
+    def __init__(self, file_name=':memory:'):
+        self._file_name = file_name
+        # transactions are begun explicitly by _transaction; left to
+        # itself sqlite3 commits before ALTER TABLE and CREATE INDEX
+        self._connection = sqlite3.connect(file_name,
+                                           check_same_thread=False,
+                                           isolation_level=None)
+        self._lock = threading.RLock()
+        with self._transaction():
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS files '
+                '(directory TEXT NOT NULL, file TEXT NOT NULL, '
+                'size INTEGER, mtime REAL, '
+                'PRIMARY KEY (directory, file))')
+
+    @property
+    def file_name(self):
+        """Name of the database file."""
+        return self._file_name
+
+    @property
+    def keywords(self):
+        """List of keywords with a column in the catalog."""
+        with self._lock:
+            columns = self._connection.execute('PRAGMA table_info(files)')
+            return [column[1] for column in columns
+                    if column[1] not in _reserved_columns]
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the statements of a ``with`` block in one transaction, which
+        is rolled back if the block raises.
+        """
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                yield
+            except:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def close(self):
+        """Close the connection to the database."""
+        with self._lock:
+            self._connection.close()
+
+    def _add_keyword_columns(self, keywords):
+        """
+        Add an indexed, case-insensitive column for each new keyword.
+
+        Must be called inside a transaction.
+        """
+        existing = set(self.keywords)
+        for keyword in keywords:
+            if keyword in existing:
+                continue
+            self._connection.execute('ALTER TABLE files ADD COLUMN %s '
+                                     'COLLATE NOCASE' % _quote(keyword))
+            self._connection.execute('CREATE INDEX %s ON files (%s)' %
+                                     (_quote('index_' + keyword),
+                                      _quote(keyword)))
+            existing.add(keyword)
+
+    def update(self, directory, summary, remove_missing=True):
+        """
+        Insert or update the rows for the files in `summary`.
+
+        `directory` is the directory containing the files.
+
+        `summary` is an ATpy summary table with a `file` column, e.g.
+        :attr:`ImageFileCollection.summary_info`. Masked values and
+        empty strings are stored as NULL. Keywords already in the
+        catalog that are not in `summary` keep their values.
+
+        If `remove_missing` is `True`, rows for files in `directory`
+        that are not in `summary` are deleted.
+
+        All changes are made in a single transaction.
+        """
+        directory = path.abspath(directory)
+        keywords = []
+        for key in summary.keys():
+            keyword = key.lower()
+            if keyword not in _reserved_columns and keyword not in keywords:
+                keywords.append(keyword)
+        columns = {}
+        for key in summary.keys():
+            if key.lower() in keywords and key.lower() not in columns:
+                mask = ma.getmaskarray(summary[key])
+                values = ma.getdata(summary[key]).tolist()
+                # missing string values are stored as '' in summaries
+                columns[key.lower()] = [None if masked or value == ''
+                                        else value
+                                        for value, masked in zip(values, mask)]
+        files = ma.getdata(summary['file']).tolist() if len(summary) else []
+
+        with self._transaction():
+            self._add_keyword_columns(keywords)
+            assignments = ', '.join(['size = ?', 'mtime = ?'] +
+                                    ['%s = ?' % _quote(keyword)
+                                     for keyword in keywords])
+            for row, file_name in enumerate(files):
+                try:
+                    stat = os.stat(path.join(directory, file_name))
+                    size, mtime = stat.st_size, stat.st_mtime
+                except OSError:
+                    size, mtime = None, None
+                values = [columns[keyword][row] for keyword in keywords]
+                self._connection.execute('INSERT OR IGNORE INTO files '
+                                         '(directory, file) VALUES (?, ?)',
+                                         (directory, file_name))
+                self._connection.execute('UPDATE files SET %s WHERE '
+                                         'directory = ? AND file = ?' %
+                                         assignments,
+                                         [size, mtime] + values +
+                                         [directory, file_name])
+            if remove_missing:
+                known = self._connection.execute('SELECT file FROM files '
+                                                 'WHERE directory = ?',
+                                                 (directory,))
+                gone = set(row[0] for row in known) - set(files)
+                self._connection.executemany('DELETE FROM files WHERE '
+                                             'directory = ? AND file = ?',
+                                             [(directory, file_name)
+                                              for file_name in gone])
+
+    def remove_files(self, directory, file_names):
+        """Delete the rows for the files `file_names` in `directory`."""
+        directory = path.abspath(directory)
+        with self._transaction():
+            self._connection.executemany('DELETE FROM files WHERE '
+                                         'directory = ? AND file = ?',
+                                         [(directory, file_name)
+                                          for file_name in file_names])
+
+    def remove_directory(self, directory):
+        """Delete the rows for all files in `directory`."""
+        with self._transaction():
+            self._connection.execute('DELETE FROM files WHERE directory = ?',
+                                     (path.abspath(directory),))
+
+    def files_filtered(self, directory=None, **kwd):
+        """
+        Full paths of files whose keywords have listed values.
+
+        `directory` restricts the search to one directory; by default
+        the whole catalog is searched.
+
+        `**kwd` is list of keywords and values the files must have, as
+        for :meth:`ImageFileCollection.files_filtered`: the value '*'
+        represents any value, a missing keyword is indicated by value ''
+        and comparison is case *insensitive* for strings.
+
+        Keywords that are not in the catalog raise `ValueError`.
+        """
+        known = set(self.keywords)
+        conditions = []
+        parameters = []
+        if directory is not None:
+            conditions.append('directory = ?')
+            parameters.append(path.abspath(directory))
+        for key, value in kwd.iteritems():
+            keyword = key.lower()
+            if keyword not in known:
+                raise ValueError('keyword %s is not in the catalog' % key)
+            if value == '*':
+                conditions.append('%s IS NOT NULL' % _quote(keyword))
+            elif value == '':
+                conditions.append('%s IS NULL' % _quote(keyword))
+            else:
+                conditions.append('%s = ?' % _quote(keyword))
+                parameters.append(value)
+        query = 'SELECT directory, file FROM files'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY directory, file'
+        with self._lock:
+            return [path.join(row[0], row[1])
+                    for row in self._connection.execute(query, parameters)]
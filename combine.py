@@ -0,0 +1,511 @@
+"""
+Combine stacks of images without holding every image in memory.
+
+The images are memory-mapped and combined one tile of rows at a time,
+so the memory used depends on `memory_limit` rather than on the number
+or size of the images. Every pixel is combined by the same numpy
+operation as in :class:`astropysics.ccd.ImageCombiner`, so the result
+is identical to combining the whole stack in memory.
+
+With `workers` greater than one the tiles are combined by a pool of
+processes. Each process maps the images itself, so only file names
+and row ranges are sent to the workers.
+
+Besides 'median' and 'mean' there are combines that reject outlying
+pixels, such as cosmic rays, before averaging: 'sigclip', 'minmax' and
+'avsigclip'. They work on a whole stack at once (see
+:func:`sigclip`) and take their parameters from `method_params`.
+"""
+from multiprocessing import Pool
+from inspect import getargspec
+from os import path
+import os
+
+import numpy as np
+
+from image_collection import MappedImage
+
+default_memory_limit = 256 * 2**20
+
+
+def _median(stack):
+    return np.median(stack, axis=0)
+
+
+def _mean(stack):
+    return np.mean(stack, axis=0)
+
+
+def _clip(stack, lsigma, hsigma, maxiters, sigma_func):
+    """
+    Iteratively replace pixels far from the median of `stack` with nan,
+    and return the mean of the pixels that are left. A pass that would
+    reject every remaining value of a pixel rejects none of them.
+
+    `sigma_func(data, center)` returns the standard deviation used for
+    each pixel.
+    """
+    data = np.array(stack, dtype=np.float64)
+    for i in range(maxiters):
+        center = np.nanmedian(data, axis=0)
+        sigma = sigma_func(data, center)
+        with np.errstate(invalid='ignore'):
+            reject = (((data < center - lsigma * sigma) |
+                       (data > center + hsigma * sigma)) &
+                      (sigma > 0))
+            reject &= (~(reject | np.isnan(data))).any(axis=0)
+        if not reject.any():
+            break
+        data[reject] = np.nan
+    return np.nanmean(data, axis=0)
+
+
+def sigclip(stack, lsigma=3.0, hsigma=3.0, maxiters=10):
+    """
+    Mean of `stack` along its first axis after sigma clipping.
+
+    `stack` is an array of images, e.g. with shape (n_images, rows,
+    columns). For every pixel, values more than `lsigma` standard
+    deviations below or `hsigma` above the median are rejected; this is
+    repeated, with the median and standard deviation of the remaining
+    values, until nothing more is rejected or `maxiters` passes are made.
+    """
+    return _clip(stack, lsigma, hsigma, maxiters,
+                 lambda data, center: np.nanstd(data, axis=0))
+
+
+def avsigclip(stack, lsigma=3.0, hsigma=3.0, maxiters=10):
+    """
+    Mean of `stack` along its first axis after averaged sigma clipping.
+
+    As :func:`sigclip`, but the standard deviation of each pixel is
+    ``sqrt(ratio * median)``, where ``ratio`` is the average along each
+    image row of the variance divided by the median. This assumes
+    Poisson-like noise and gives a much steadier estimate than the
+    standard deviation of a few values; it is meant for small stacks.
+    Pixels whose row has no positive median are not clipped.
+    """
+    def sigma(data, center):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = np.where(center > 0,
+                             np.nanvar(data, axis=0) / center,
+                             np.nan)
+            ratio = np.nanmean(ratio, axis=-1)[..., np.newaxis]
+            return np.sqrt(ratio * np.abs(center))
+    return _clip(stack, lsigma, hsigma, maxiters, sigma)
+
+
+def minmax(stack, nlow=1, nhigh=1):
+    """
+    Mean of `stack` along its first axis after rejecting, for every
+    pixel, the `nlow` lowest and `nhigh` highest values.
+    """
+    n_images = len(stack)
+    if nlow < 0 or nhigh < 0 or nlow + nhigh >= n_images:
+        raise ValueError('Cannot reject %d low and %d high values from %d '
+                         'images' % (nlow, nhigh, n_images))
+    ordered = np.sort(stack, axis=0)
+    return np.mean(ordered[nlow:n_images - nhigh], axis=0, dtype=np.float64)
+
+combine_methods = {'median': _median,
+                   'mean': _mean,
+                   'sigclip': sigclip,
+                   'avsigclip': avsigclip,
+                   'minmax': minmax}
+
+# Working copies of the stack, including the stack itself, made by each
+# method.
+_stack_copies = {'median': 2,
+                 'mean': 2,
+                 'sigclip': 4,
+                 'avsigclip': 4,
+                 'minmax': 3}
+
+
+def method_parameters(method, method_params=None):
+    """
+    All parameters of the combining `method`, including defaults
+    overridden by `method_params`, as a dictionary.
+    """
+    try:
+        func = combine_methods[method]
+    except KeyError:
+        raise ValueError('Invalid combining method %s' % method)
+    method_params = method_params or {}
+    args, varargs, varkw, defaults = getargspec(func)
+    names = args[len(args) - len(defaults or ()):]
+    params = dict(zip(names, defaults or ()))
+    for name in method_params:
+        if name not in params:
+            raise ValueError('Combining method %s has no parameter %s' %
+                             (method, name))
+    params.update(method_params)
+    return params
+
+
+def method_description(method, method_params=None):
+    """
+    Short description of `method` and its parameters, e.g.
+    ``sigclip(hsigma=3.0,lsigma=3.0,maxiters=10)``, for FITS headers.
+
+    Methods without parameters are described by their name alone.
+    """
+    params = method_parameters(method, method_params)
+    if not params:
+        return method
+    return '%s(%s)' % (method, ','.join('%s=%s' % (name, params[name])
+                                         for name in sorted(params)))
+
+
+def _rows_per_tile(n_images, row_shape, itemsize, memory_limit, copies=2):
+    """
+    Number of image rows that can be combined at once.
+
+    `copies` stacks of tiles, e.g. the stack and the working copy made
+    by the partition done by `np.median`, have to fit in `memory_limit`
+    bytes; at least one row is always used.
+    """
+    bytes_per_row = copies * n_images * int(np.prod(row_shape)) * itemsize
+    return max(1, int(memory_limit // bytes_per_row))
+
+
+def _open_images(file_names):
+    images = [MappedImage(file_name) for file_name in file_names]
+    if not images:
+        raise ValueError('No images to combine')
+    shape = images[0].shape
+    for image in images[1:]:
+        if image.shape != shape:
+            raise ValueError("image sizes don't match")
+    return images
+
+
+def _stack(images, start, stop, subtract=None):
+    """
+    Stack rows `start:stop` of `images`, minus the same rows of
+    `subtract` if it is given.
+    """
+    if subtract is None:
+        return np.array([image[start:stop] for image in images])
+    to_subtract = subtract[start:stop]
+    return np.array([image[start:stop] - to_subtract for image in images])
+
+
+def _combine_rows(images, start, stop, method, subtract=None,
+                  method_params=None):
+    """Combine rows `start:stop` of `images` with `method`."""
+    try:
+        op = combine_methods[method]
+    except KeyError:
+        raise ValueError('Invalid combining method %s' % method)
+    return op(_stack(images, start, stop, subtract=subtract),
+              **(method_params or {}))
+
+
+# Images mapped by each worker process of a parallel combine; set by
+# _init_worker.
+_worker_images = None
+_worker_subtract = None
+
+
+def _init_worker(file_names, subtract):
+    global _worker_images
+    global _worker_subtract
+    _worker_images = [MappedImage(file_name) for file_name in file_names]
+    if isinstance(subtract, tuple):
+        subtract = MappedImage(*subtract)
+    _worker_subtract = subtract
+
+
+def _combine_tile(tile):
+    start, stop, method, method_params = tile
+    return _combine_rows(_worker_images, start, stop, method,
+                         subtract=_worker_subtract,
+                         method_params=method_params)
+
+
+def tiled_combine(file_names, method='median',
+                  memory_limit=default_memory_limit, subtract=None,
+                  workers=1, method_params=None):
+    """
+    Combine FITS images one tile of rows at a time.
+
+    `file_names` is a list of full paths of the images.
+
+    `method` is the name of the combining method: 'median' or 'mean'
+    as for `ImageCombiner.method`, or one of the rejection methods
+    'sigclip', 'avsigclip' and 'minmax'.
+
+    `memory_limit` is the approximate number of bytes to use for the
+    tiles being combined, shared among all of the `workers`.
+
+    `subtract` is an optional image (a numpy array or
+    :class:`image_collection.MappedImage`), e.g. a master dark, that
+    is subtracted from each image before combining.
+
+    `workers` is the number of processes that combine tiles. A
+    :class:`~image_collection.MappedImage` given as `subtract` is mapped
+    again by each process; an array is copied to each process once.
+
+    `method_params` is a dictionary of parameters for `method`, e.g.
+    ``{'lsigma': 4, 'hsigma': 4}`` for 'sigclip'; see
+    :func:`method_parameters`.
+
+    Returns the combined image as a numpy array in FITS (row, column)
+    order.
+    """
+    method_parameters(method, method_params)
+    images = _open_images(file_names)
+    shape = images[0].shape
+    first = _combine_rows(images, 0, 1, method, subtract=subtract,
+                          method_params=method_params)
+    combined = np.empty(shape, dtype=first.dtype)
+    workers = max(1, min(workers, shape[0]))
+    rows = _rows_per_tile(len(images), shape[1:], first.itemsize,
+                          memory_limit // workers,
+                          copies=_stack_copies[method])
+    if workers == 1:
+        for start in range(0, shape[0], rows):
+            stop = min(start + rows, shape[0])
+            combined[start:stop] = _combine_rows(images, start, stop, method,
+                                                 subtract=subtract,
+                                                 method_params=method_params)
+        return combined
+
+    # make at least one tile per worker
+    rows = min(rows, -(-shape[0] // workers))
+    tiles = [(start, min(start + rows, shape[0]), method, method_params)
+             for start in range(0, shape[0], rows)]
+    if isinstance(subtract, MappedImage):
+        subtract = (subtract.file_name, subtract.uint)
+    pool = Pool(workers, initializer=_init_worker,
+                initargs=(file_names, subtract))
+    try:
+        for tile, rows_combined in zip(tiles,
+                                       pool.imap(_combine_tile, tiles)):
+            combined[tile[0]:tile[1]] = rows_combined
+    finally:
+        pool.close()
+        pool.join()
+    return combined
+
+
+def use_tiled_combine(combiner, memory_limit, workers, method_params):
+    """
+    Whether images should be combined with :func:`tiled_combine` rather
+    than ``combiner.combineImages``, where `combiner` is an
+    :class:`astropysics.ccd.ImageCombiner`.
+
+    Only the methods in :data:`combine_methods` can be tiled; the other
+    methods ``ImageCombiner`` accepts ('sum', 'min', 'max', callables
+    and weights) always load the images in full, as do 'median' and
+    'mean' when `combiner` has `sigclip` or `shifts` set, since the
+    tiled combine does not apply them.
+
+    Raises `ValueError` if `method_params` are given for a method that
+    is not tiled, or `sigclip` or `shifts` for a rejection method.
+    """
+    method = combiner.method
+    if not (isinstance(method, basestring) and method in combine_methods):
+        if method_params:
+            raise ValueError('method_params cannot be used with combining '
+                             'method %s' % (method,))
+        return False
+    if combiner.sigclip is not None or combiner.shifts is not None:
+        if method not in ['median', 'mean']:
+            raise ValueError('sigclip and shifts cannot be used with '
+                             'combining method %s' % method)
+        return False
+    return (memory_limit is not None or workers > 1 or
+            method not in ['median', 'mean'] or bool(method_params))
+
+
+def _file_stamp(file_name):
+    """
+    Size and modification time of `file_name`.
+    """
+    stat = os.stat(file_name)
+    return (float(stat.st_size), float(stat.st_mtime))
+
+
+class IncrementalCombine(object):
+    """
+    Combined image that can be updated as new images arrive.
+
+    The state is kept in the directory `state_dir`, which is created if
+    needed, so that a later run can pick up where this one stopped.
+
+    The size and modification time of each file are recorded when it is
+    added; :meth:`is_current` tells whether the files have changed
+    since.
+
+    `method` is 'mean' or 'median'. For 'mean' the state is the running
+    sum, in double precision, and the number of images, and the mean
+    has the data type a full combine would give it; adding images
+    takes time proportional to the number added. The mean of integer
+    images is exactly that of a full combine, but that of float images,
+    whose full combine sums in single precision, may differ from it in
+    the last bits. For 'median' every
+    image is appended to a stack on disk; adding images is again
+    proportional to their number, but an exact median has to read the
+    whole stack, which :meth:`combine` does one tile of rows at a time.
+
+    Example::
+
+        darks = IncrementalCombine('.dark_state', 'median')
+        darks.add(['dark1.fit', 'dark2.fit'])
+        master = darks.combine()
+        darks.add(['dark3.fit'])
+        master = darks.combine()
+    """
+    methods = ['mean', 'median']
+
+    def __init__(self, state_dir, method='median'):
+        if method not in self.methods:
+            raise ValueError('Combining method %s cannot be updated '
+                             'incrementally' % method)
+        self._state_dir = state_dir
+        self._method = method
+        self._files = []
+        self._stamps = []
+        self._shape = None
+        self._dtype = None
+        self._total = None
+        if not path.isdir(state_dir):
+            os.makedirs(state_dir)
+        elif path.exists(self._state_file):
+            self._load()
+
+    @property
+    def method(self):
+        """Combining method, 'mean' or 'median'."""
+        return self._method
+
+    @property
+    def files(self):
+        """Names of the files combined so far, in the order added."""
+        return list(self._files)
+
+    @property
+    def count(self):
+        """Number of images combined so far."""
+        return len(self._files)
+
+    @property
+    def _state_file(self):
+        return path.join(self._state_dir, 'state.npz')
+
+    @property
+    def _stack_file(self):
+        return path.join(self._state_dir, 'stack.raw')
+
+    def _load(self):
+        state = np.load(self._state_file)
+        if (str(state['method']) != self._method or
+            'stamps' not in state.files):
+            # a different method, or a state without file stamps,
+            # starts over
+            return
+        self._files = [str(name) for name in state['files']]
+        self._stamps = [tuple(stamp) for stamp in state['stamps']]
+        self._shape = tuple(state['shape'])
+        self._dtype = np.dtype(str(state['dtype']))
+        if self._method == 'mean':
+            self._total = state['total']
+
+    def _save(self):
+        state = dict(method=self._method,
+                     files=np.array(self._files, dtype=str),
+                     stamps=np.array(self._stamps, dtype=np.float64),
+                     shape=np.array(self._shape),
+                     dtype=self._dtype.str)
+        if self._method == 'mean':
+            state['total'] = self._total
+        temporary = self._state_file + '.new'
+        with open(temporary, 'wb') as state_file:
+            np.savez(state_file, **state)
+        os.rename(temporary, self._state_file)
+
+    def clear(self):
+        """Forget all of the images combined so far."""
+        self._files = []
+        self._stamps = []
+        self._shape = None
+        self._dtype = None
+        self._total = None
+        for file_name in [self._state_file, self._stack_file]:
+            if path.exists(file_name):
+                os.remove(file_name)
+
+    def add(self, file_names):
+        """
+        Add the images in `file_names` to the combination.
+
+        Images must all have the same shape; they are stored with the
+        data type of the first image added.
+        """
+        images = [MappedImage(file_name) for file_name in file_names]
+        if not images:
+            return
+        if self._shape is None:
+            self._shape = images[0].shape
+            self._dtype = images[0][0:1].dtype
+            if self._method == 'mean':
+                self._total = np.zeros(self._shape, dtype=np.float64)
+        for image in images:
+            if image.shape != self._shape:
+                raise ValueError("image sizes don't match")
+        if self._method == 'mean':
+            for image in images:
+                np.add(self._total, image[:], out=self._total)
+        else:
+            frame_bytes = int(np.prod(self._shape)) * self._dtype.itemsize
+            mode = 'r+b' if path.exists(self._stack_file) else 'wb'
+            with open(self._stack_file, mode) as stack:
+                # anything past the images already recorded is left over
+                # from an interrupted update
+                stack.seek(self.count * frame_bytes)
+                for image in images:
+                    np.asarray(image[:], dtype=self._dtype).tofile(stack)
+                stack.truncate()
+        self._files.extend(path.basename(file_name)
+                           for file_name in file_names)
+        self._stamps.extend(_file_stamp(file_name)
+                            for file_name in file_names)
+        self._save()
+
+    def is_current(self, file_names):
+        """
+        `True` if each of the files combined so far is one of
+        `file_names` and has the size and modification time it had
+        when it was added.
+        """
+        stamps = dict((path.basename(file_name), _file_stamp(file_name))
+                      for file_name in file_names)
+        return all(stamps.get(name) == stamp
+                   for name, stamp in zip(self._files, self._stamps))
+
+    def combine(self, memory_limit=default_memory_limit):
+        """
+        The combined image, in FITS (row, column) order.
+
+        For 'median', `memory_limit` is the approximate number of bytes
+        of the stack read at once.
+        """
+        if not self.count:
+            raise ValueError('No images to combine')
+        if self._method == 'mean':
+            # the type np.mean gives a stack of the images, as in a full
+            # combine: float32 for float32 images
+            dtype = self._dtype if self._dtype.kind == 'f' else np.float64
+            return (self._total / self.count).astype(dtype)
+        stack = np.memmap(self._stack_file, mode='r', dtype=self._dtype,
+                          shape=(self.count,) + self._shape)
+        rows = _rows_per_tile(self.count, self._shape[1:],
+                              self._dtype.itemsize, memory_limit)
+        first = _median(stack[:, 0:1])
+        combined = np.empty(self._shape, dtype=first.dtype)
+        for start in range(0, self._shape[0], rows):
+            stop = min(start + rows, self._shape[0])
+            combined[start:stop] = _median(stack[:, start:stop])
+        return combined
@@ -50,7 +50,52 @@ class FederSite(obstools.Site):
         if return_type == 'string':
             lst = lst.isoformat()
         return lst
-        
+
+    def local_sidereal_times(self, jd):
+        """
+        Local apparent sidereal time, in decimal hours, for an array of
+        Julian dates `jd`.
+
+        The calculation is the one done by `localSiderialTime`, but
+        the sidereal time is computed only once for each distinct
+        date in `jd`; files from one night share many dates.
+        """
+        from astropysics.coords.funcs import greenwich_sidereal_time
+        jd = np.asarray(jd, dtype=float)
+        dates, date_index = np.unique(jd.ravel(), return_inverse=True)
+        gast = np.array([greenwich_sidereal_time(date) for date in dates])
+        return (gast[date_index].reshape(jd.shape) + self._long.d/15) % 24
+
+    def alt_az_airmass(self, ra, dec, jd):
+        """
+        Position of objects at right ascension `ra` (decimal hours) and
+        declination `dec` (decimal degrees) at Julian dates `jd`.
+
+        The inputs are arrays (or scalars) that are broadcast against
+        each other. The position is computed as `apparentCoordinates`
+        does when given no date, i.e. without precession, and without
+        refraction.
+
+        Returns arrays of altitude and azimuth in degrees, airmass (sec
+        of the zenith distance) and hour angle in hours, between 0 and
+        24.
+        """
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)*np.pi/180
+        lst = self.local_sidereal_times(np.ravel(jd)).reshape(np.shape(jd))
+        hour_angle = lst - ra
+        sin_ha = np.sin(np.pi*hour_angle/12)
+        cos_ha = np.cos(np.pi*hour_angle/12)
+        sin_lat = np.sin(np.radians(self.latitude.d))
+        cos_lat = np.cos(np.radians(self.latitude.d))
+        alt = np.arcsin(sin_lat*np.sin(dec) + cos_lat*np.cos(dec)*cos_ha)
+        az = np.arctan2(-np.cos(dec)*sin_ha,
+                        cos_lat*np.sin(dec) - sin_lat*np.cos(dec)*cos_ha)
+        az %= 2*np.pi
+        airmass = 1/np.cos(np.pi/2 - alt)
+        # degrees as astropysics converts them, for identical rounding
+        return alt*180/np.pi, az*180/np.pi, airmass, hour_angle % 24
+
 class Instrument(object):
     """
     Telescope instrument with simple properties.
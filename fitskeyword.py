@@ -1,5 +1,6 @@
 from pyfits import Header
 from pyfits import PrimaryHDU
+from collections import namedtuple
 
 class FITSKeyword(object):
     """
@@ -96,8 +97,7 @@ class FITSKeyword(object):
         Method to add HISTORY line to header.
         Use `with_name` to override the name of the keyword object.
         """
-        if with_name is None: with_name = self.name
-        return "Updated keyword %s to value %s" % (with_name.upper(), self.value)
+        return self.withValue(self.value).historyComment(with_name)
 
     def addToHeader(self, hdu_or_header, with_synonyms=True, history=False):
         """
@@ -110,21 +110,17 @@ class FITSKeyword(object):
         `history` determines whether a history comment is added when
         the keyword is added to the header.
         """
-        if isinstance(hdu_or_header, PrimaryHDU):
-            header = hdu_or_header.header
-        elif isinstance(hdu_or_header, Header):
-            header = hdu_or_header
-        else:
-            raise ValueError('argument must be a fits Primary HDU or header')
+        self.withValue(self.value).addToHeader(hdu_or_header,
+                                               with_synonyms=with_synonyms,
+                                               history=history)
+
+    def withValue(self, value):
+        """
+        A `KeywordValue` of this keyword with value `value`.
 
-        header.update(self.name, self.value, self.comment)
-        if history:
-            header.add_history(self.historyComment())
-        if with_synonyms and self.synonyms:
-            for synonym in self.synonyms:
-                header.update(synonym, self.value, self.comment)
-                if history:
-                    header.add_history(self.historyComment(with_name=synonym))
+        The keyword itself is not modified.
+        """
+        return KeywordValue(self, value)
 
     def setValueFromHeader(self, hdu_or_header):
         """
@@ -137,12 +133,14 @@ class FITSKeyword(object):
         present in the FITS header, checks whether the values are
         identical, and if they aren't, raises an error.
         """
-        if isinstance(hdu_or_header, PrimaryHDU):
-            header = hdu_or_header.header
-        elif isinstance(hdu_or_header, Header):
-            header = hdu_or_header
-        else:
-            raise ValueError('argument must be a fits Primary HDU or header')
+        self.value = self.valueFromHeader(hdu_or_header)
+
+    def valueFromHeader(self, hdu_or_header):
+        """
+        Value of keyword in FITS header, found as in
+        `setValueFromHeader` but without setting `value`.
+        """
+        header = _header(hdu_or_header)
         values = []
         for name in self.names:
             try:
@@ -153,9 +151,49 @@ class FITSKeyword(object):
             if len(set(values)) > 1:
                 raise ValueError('Found more than one value for keyword %s:\n Values found are: %s'
                                  % (','.join(self.names), ','.join(values)))
-            self.value = values[0]
+            return values[0]
         else:
             raise ValueError('Keyword not found in header: %s' % self)
+
+class KeywordValue(namedtuple('KeywordValue', ['keyword', 'value'])):
+    """
+    Value of a `FITSKeyword` for one file.
+
+    A `KeywordValue` cannot be changed once made, so unlike setting the
+    `value` of a keyword shared by all files it is safe to use while
+    files are patched concurrently.
+    """
+    __slots__ = ()
+
+    def historyComment(self, with_name=None):
+        """
+        Method to add HISTORY line to header.
+        Use `with_name` to override the name of the keyword.
+        """
+        if with_name is None: with_name = self.keyword.name
+        return "Updated keyword %s to value %s" % (with_name.upper(), self.value)
+
+    def addToHeader(self, hdu_or_header, with_synonyms=True, history=False):
+        """
+        Add keyword with this value to FITS header; arguments are as
+        for `FITSKeyword.addToHeader`.
+        """
+        header = _header(hdu_or_header)
+        names = [self.keyword.name]
+        if with_synonyms:
+            names.extend(self.keyword.synonyms)
+        for name in names:
+            header.update(name, self.value, self.keyword.comment)
+            if history:
+                header.add_history(self.historyComment(with_name=name))
+
+def _header(hdu_or_header):
+    if isinstance(hdu_or_header, PrimaryHDU):
+        return hdu_or_header.header
+    elif isinstance(hdu_or_header, Header):
+        return hdu_or_header
+    else:
+        raise ValueError('argument must be a fits Primary HDU or header')
         
                         
 
@@ -2,11 +2,22 @@ import fnmatch
 import pyfits
 from feder import RA, Dec, target_object
 from os import listdir, path
+import os
+import cPickle
 from numpy import array, where
+import numpy as np
 import numpy.ma as ma
 from string import lower
 import atpy
 import functools
+import sys
+import threading
+import Queue
+from collections import OrderedDict
+from catalog import SummaryCatalog
+import gzip
+import zlib
+from multiprocessing.pool import ThreadPool
 
 def contains_maximdl_imagetype(image_collection):
     """
@@ -75,41 +86,793 @@ def IRAF_image_type(image_type):
     """
     return image_type.split()[0].upper()
     
-from tempfile import TemporaryFile
-def iterate_files(func):
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+def _card_value(card):
+    """
+    Value of a FITS header card, as the python type pyfits would use.
+
+    Raises `ValueError` for any value this simple parser does not
+    understand (e.g. complex or undefined values).
+    """
+    value = card[10:].lstrip()
+    if value.startswith("'"):
+        pieces = []
+        start = 1
+        while True:
+            end = value.find("'", start)
+            if end < 0:
+                raise ValueError('Unterminated string in card: %s' % card)
+            if value[end+1:end+2] == "'":
+                pieces.append(value[start:end+1])
+                start = end + 2
+            else:
+                pieces.append(value[start:end])
+                break
+        return ''.join(pieces).rstrip()
+
+    value = value.split('/', 1)[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    try:
+        return int(value)
+    except ValueError:
+        return float(value.replace('D', 'E').replace('d', 'e'))
+
+def _read_raw_header_values(file_name, keywords):
+    """
+    Read `keywords` from the primary header of `file_name` block by
+    block, without building a pyfits header.
+
+    Reading stops at the END card, or at the end of the first header
+    block in which all of the keywords have been found. Gzipped files
+    are decompressed only as far as the header.
+
+    Raises `ValueError` if the header is not in the simple form this
+    reader understands, e.g. if a wanted string value is continued on
+    CONTINUE cards.
+    """
+    wanted = set(keyword.upper() for keyword in keywords)
+    values = {}
+    # keyword whose string value ends in '&', so may be continued
+    may_continue = None
+    if file_name.endswith('.gz'):
+        fits_file = gzip.open(file_name, 'rb')
+    else:
+        fits_file = open(file_name, 'rb')
+    try:
+        first_block = True
+        while True:
+            block = fits_file.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise ValueError('Header of %s is truncated' % file_name)
+            if first_block and not block.startswith('SIMPLE  ='):
+                raise ValueError('%s does not start with SIMPLE' % file_name)
+            first_block = False
+            for start in range(0, FITS_BLOCK, FITS_CARD):
+                card = block[start:start+FITS_CARD]
+                keyword = card[:8].rstrip()
+                if may_continue is not None and keyword == 'CONTINUE':
+                    raise ValueError('Value of %s in %s is continued'
+                                     % (may_continue, file_name))
+                may_continue = None
+                if keyword == 'END':
+                    return values
+                if (keyword in wanted and keyword not in values and
+                    card[8:10] == '= '):
+                    value = _card_value(card)
+                    values[keyword] = value
+                    if isinstance(value, str) and value.endswith('&'):
+                        may_continue = keyword
+            if len(values) == len(wanted) and may_continue is None:
+                return values
+    finally:
+        fits_file.close()
+
+def read_header_values(file_name, keywords):
+    """
+    Values of `keywords` in the primary header of `file_name`.
+
+    Returns a dictionary, indexed by the upper case keyword, of the
+    keywords present in the header. Synonyms (e.g. `feder.RA.names`)
+    must be included in `keywords` to be read.
+
+    The header is parsed directly from the file; pyfits is used
+    instead if the header is malformed or contains values the fast
+    reader does not handle. Raises `IOError` if the file cannot be
+    read as FITS.
+    """
+    keywords = [keyword.upper() for keyword in keywords]
+    try:
+        return _read_raw_header_values(file_name, keywords)
+    except (ValueError, EOFError, zlib.error):
+        header = pyfits.getheader(file_name)
+        values = {}
+        for keyword in keywords:
+            if keyword in header:
+                values[keyword] = header[keyword]
+        return values
+
+class SummaryIndex(object):
+    """
+    Hash indexes on the columns of a summary table.
+
+    Each column is indexed the first time it is queried: rows are
+    grouped by value, with strings lower-cased and missing (masked or
+    empty) values grouped under ''. A query is answered by
+    intersecting the sets of rows for each keyword, so repeated
+    queries do not scan the table and never modify it.
+    """
+    def __init__(self, table):
+        self._table = table
+        self._n_rows = len(table)
+        self._indexes = {}
+        self._present = {}
+        self._columns = {}
+
+    def column(self, keyword):
+        """Values of column `keyword` as a plain numpy array."""
+        if keyword not in self._columns:
+            self._columns[keyword] = ma.getdata(self._table[keyword])
+        return self._columns[keyword]
+
+    def _index(self, keyword):
+        if keyword not in self._indexes:
+            missing = ma.getmaskarray(self._table[keyword])
+            index = {}
+            for row, value in enumerate(self.column(keyword).tolist()):
+                if missing[row]:
+                    value = ''
+                elif isinstance(value, basestring):
+                    value = value.lower()
+                index.setdefault(value, set()).add(row)
+            present = set(range(self._n_rows))
+            present -= index.get('', set())
+            self._indexes[keyword] = index
+            self._present[keyword] = present
+        return self._indexes[keyword]
+
+    def rows(self, **kwd):
+        """
+        Sorted list of rows whose keywords have the given values.
+
+        `**kwd` is list of keywords and values, with the same meaning
+        as in :meth:`ImageFileCollection.files_filtered`.
+        """
+        matches = None
+        for keyword, value in kwd.iteritems():
+            index = self._index(keyword)
+            if value == '*':
+                have_this_value = self._present[keyword]
+            else:
+                if isinstance(value, basestring):
+                    value = value.lower()
+                have_this_value = index.get(value, set())
+            if matches is None:
+                matches = set(have_this_value)
+            else:
+                matches &= have_this_value
+        if matches is None:
+            return range(self._n_rows)
+        return sorted(matches)
+
+from tempfile import TemporaryFile, NamedTemporaryFile
+
+header_cache_name = '.header_cache.pickle'
+
+def _primary_header_size(fits_file):
+    """
+    Size in bytes, a multiple of 2880, of the primary header of the
+    open file `fits_file`, read from its current position.
+    """
+    size = 0
+    while True:
+        block = fits_file.read(FITS_BLOCK)
+        if len(block) < FITS_BLOCK:
+            raise ValueError('No END card in primary header')
+        size += FITS_BLOCK
+        for start in range(0, FITS_BLOCK, FITS_CARD):
+            if block[start:start+8] == 'END     ':
+                return size
+
+def write_header_in_place(hdulist, file_name):
+    """
+    Write only the primary header of `hdulist` back to `file_name`.
+
+    This is possible when `file_name` is uncompressed, the image data
+    has not been loaded (so cannot have been changed) and the modified
+    header needs the same number of 2880-byte blocks as the header
+    already in the file.
+
+    Returns the number of bytes written, or `None` if the header could
+    not be written in place; the file is untouched in that case.
+    """
+    hdu = hdulist[0]
+    # _data_loaded is private to pyfits; without it, assume the data
+    # may have changed and let the caller write the whole file
+    if file_name.endswith('.gz') or getattr(hdu, '_data_loaded', True):
+        return None
+    hdulist.verify('exception')
+    new_header = hdu.header.tostring()
+    with open(file_name, 'r+b') as fits_file:
+        try:
+            old_size = _primary_header_size(fits_file)
+        except ValueError:
+            return None
+        if len(new_header) != old_size:
+            return None
+        fits_file.seek(0)
+        fits_file.write(new_header)
+    return len(new_header)
+
+_bitpix_dtype = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                 -32: '>f4', -64: '>f8'}
+
+class MappedImage(object):
+    """
+    Image data of the primary HDU of a FITS file, read lazily.
+
+    For uncompressed files the pixels are memory-mapped and only the
+    part of the image that is indexed is read; BZERO, BSCALE and BLANK
+    are applied to that part alone, exactly as pyfits would apply them
+    to the whole image. Gzipped files cannot be mapped, so their data
+    is read with pyfits instead.
+
+    `uint` has the same meaning as for `pyfits.open`: if `True`,
+    unsigned integer images (e.g. BITPIX 16 with BZERO 32768) are
+    returned as unsigned integers rather than floats.
+
+    Example::
+
+        overscan = MappedImage('bias.fit')[:, 3073:]
+    """
+    def __init__(self, file_name, uint=False):
+        self._file_name = file_name
+        self._uint = uint
+        self._raw = None
+        if file_name.endswith('.gz'):
+            hdulist = pyfits.open(file_name, uint=uint)
+            self._data = hdulist[0].data
+            hdulist.close()
+            if self._data is None:
+                raise ValueError('No image data in %s' % file_name)
+            self._shape = self._data.shape
+            return
+
+        self._data = None
+        # NAXIS first, so that only the axes present are asked for
+        n_axes = read_header_values(file_name, ['NAXIS']).get('NAXIS', 0)
+        if not n_axes:
+            raise ValueError('No image data in %s' % file_name)
+        keywords = (['BITPIX', 'BZERO', 'BSCALE', 'BLANK'] +
+                    ['NAXIS%d' % axis for axis in range(1, n_axes + 1)])
+        values = read_header_values(file_name, keywords)
+        self._bitpix = values['BITPIX']
+        self._bzero = values.get('BZERO', 0)
+        self._bscale = values.get('BSCALE', 1)
+        self._blank = values.get('BLANK', None)
+        self._shape = tuple(values['NAXIS%d' % axis]
+                            for axis in range(n_axes, 0, -1))
+
+    @property
+    def file_name(self):
+        """Name of the FITS file."""
+        return self._file_name
+
+    @property
+    def uint(self):
+        """`True` if unsigned integer images are kept as integers."""
+        return self._uint
+
+    @property
+    def shape(self):
+        """Shape of the image, in numpy (row, column) order."""
+        return self._shape
+
+    @property
+    def raw(self):
+        """
+        Unscaled data, as stored in the file; a memory map if possible.
+
+        The file is mapped, and so holds an open file descriptor, only
+        from the first time the data is used.
+        """
+        if self._data is not None:
+            raise ValueError('Raw data is not available for gzipped files')
+        if self._raw is None:
+            with open(self._file_name, 'rb') as fits_file:
+                offset = _primary_header_size(fits_file)
+            self._raw = np.memmap(self._file_name, mode='r', offset=offset,
+                                  dtype=_bitpix_dtype[self._bitpix],
+                                  shape=self._shape)
+        return self._raw
+
+    def _unsigned_dtype(self):
+        if not self._uint or self._bscale != 1:
+            return None
+        for bits, dtype in ((16, 'uint16'), (32, 'uint32'), (64, 'uint64')):
+            if self._bitpix == bits and self._bzero == 1 << (bits - 1):
+                return np.dtype(dtype)
+        return None
+
+    def _scale(self, raw):
+        """
+        Apply BZERO/BSCALE/BLANK to `raw` the way pyfits does.
+        """
+        if self._bzero == 0 and self._bscale == 1 and self._blank is None:
+            return raw
+
+        unsigned = None
+        if not (self._bzero == 0 and self._bscale == 1):
+            unsigned = self._unsigned_dtype()
+        if unsigned is not None:
+            data = np.array(raw, dtype=unsigned)
+            data -= np.uint64(1 << (unsigned.itemsize * 8 - 1))
+            return data
+
+        if self._blank is not None:
+            blanks = (raw == self._blank)
+        if self._bitpix > 16:
+            data = np.array(raw, dtype='float64')
+        elif self._bitpix > 0:
+            data = np.array(raw, dtype='float32')
+        else:
+            data = np.array(raw)
+        if self._bscale != 1:
+            np.multiply(data, self._bscale, data)
+        if self._bzero != 0:
+            data += self._bzero
+        if self._blank is not None:
+            data[blanks] = np.nan
+        return data
+
+    def __getitem__(self, key):
+        if self._data is not None:
+            return self._data[key]
+        return self._scale(self.raw[key])
+
+    def read_into(self, out):
+        """
+        Read the whole image into the existing array `out`, scaling it
+        in the precision of `out` instead of making a new array.
+
+        `out` must have the shape of the image.
+        """
+        if out.shape != self.shape:
+            raise ValueError('Output shape %s does not match image shape %s'
+                             % (out.shape, self.shape))
+        if self._data is not None:
+            out[...] = self._data
+            return out
+        raw = self.raw
+        if self._unsigned_dtype() is not None:
+            # unsigned integers are exact only when done the pyfits way
+            out[...] = self._scale(raw)
+            return out
+        out[...] = raw
+        if self._bscale != 1:
+            np.multiply(out, self._bscale, out)
+        if self._bzero != 0:
+            out += self._bzero
+        if self._blank is not None:
+            out[raw == self._blank] = np.nan
+        return out
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+def _read_ahead(func, items, depth, discard=None):
+    """
+    Generator of `(item, func(item))` for each of `items`, with
+    `func` run by a background thread up to `depth` items ahead of
+    the consumer.
+
+    Exceptions raised by `func` are re-raised in the consumer. If the
+    consumer stops early, results computed ahead are passed to
+    `discard` (e.g. to close files).
+    """
+    results = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def produce():
+        for item in items:
+            try:
+                result = (item, func(item), None)
+            except Exception:
+                result = (item, None, sys.exc_info())
+            if not put(result):
+                if discard is not None and result[1] is not None:
+                    discard(result[1])
+                return
+            if result[2] is not None:
+                return
+        put(done)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                return
+            item, value, error = result
+            if error is not None:
+                raise error[0], error[1], error[2]
+            yield item, value
+    finally:
+        stop.set()
+        producer.join()
+        while True:
+            try:
+                result = results.get_nowait()
+            except Queue.Empty:
+                break
+            if (result is not done and discard is not None and
+                result[1] is not None):
+                discard(result[1])
+
+class _BackgroundWriter(object):
+    """
+    Run `save(*item)` in a background thread for each item `put`.
+
+    At most `depth` items wait to be saved; `put` blocks when the
+    queue is full, which bounds the memory held by unsaved files.
+    An exception raised by `save` is re-raised by the next `put` or by
+    `close`; once one has occurred later items are passed to `discard`
+    instead of being saved.
+    """
+    def __init__(self, save, depth, discard=None):
+        self._save = save
+        self._discard = discard
+        self._queue = Queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    self._save(*item)
+                except Exception:
+                    self._error = sys.exc_info()
+            elif self._discard is not None:
+                self._discard(*item)
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def put(self, *item):
+        self._raise()
+        self._queue.put(item)
+
+    def close(self):
+        """Wait for all queued items to be saved."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
+
+def save_hdulist(hdulist, full_path, save_with_name='', save_location='',
+                 clobber=False, in_place=False):
+    """
+    Save `hdulist`, read from `full_path`, as the loops over the files
+    of an `ImageFileCollection` do.
+
+    The file is saved under its own name with `save_with_name` added
+    before the extension, in `save_location` or, if that is not set,
+    the directory of `full_path`. The original file is only replaced if
+    `clobber` is `True`; with `in_place` also set, only its header
+    blocks are rewritten if possible (see `write_header_in_place`).
+
+    Returns the path saved to and the number of bytes written, or
+    `None` if the file was not written.
+    """
+    if save_location:
+        destination_dir = save_location
+    else:
+        destination_dir = path.dirname(full_path)
+    basename = path.basename(full_path)
+    if save_with_name:
+        base, ext = path.splitext(basename)
+        basename = base + save_with_name + ext
+
+    new_path = path.join(destination_dir, basename)
+
+    written = None
+    if (new_path != full_path) or clobber:
+        if in_place and new_path == full_path:
+            written = write_header_in_place(hdulist, full_path)
+        if written is None:
+            try:
+                hdulist.writeto(new_path, clobber=clobber)
+                written = path.getsize(new_path)
+            except IOError:
+                pass
+    return new_path, written
+
+def iterate_files(func, load_data=False):
+    """
+    Turn `func(self, hdulist=...)` into a generator over the files of
+    an `ImageFileCollection`, saving each file after it is processed.
+
+    `load_data` should be `True` if `func` uses the image data, so
+    that prefetching reads the data as well as the header.
+    """
     @functools.wraps(func)
     def wrapper(self, save_with_name="", save_location='',
                 clobber=False, hdulist=None,
-                do_not_scale_image_data=True,
+                do_not_scale_image_data=True, in_place=False,
+                prefetch=0, write_depth=0,
                 **kwd):
 
         if kwd:
-            self._find_keywords_by_values(**kwd)
-            
-        for full_path in self.paths():
+            paths = [path.join(self.location, file_)
+                     for file_ in self._find_keywords_by_values(**kwd)]
+        else:
+            paths = self.paths()
+
+        def open_file(full_path):
             hdulist = pyfits.open(full_path,
                                   do_not_scale_image_data=do_not_scale_image_data)
-            yield func(self, save_with_name=save_with_name,
-                       save_location='', clobber=clobber, hdulist=hdulist)
-            if save_location:
-                destination_dir = save_location
-            else:
-                destination_dir = path.dirname(full_path)
-            basename = path.basename(full_path)
-            if save_with_name:
-                base, ext = path.splitext(basename)
-                basename = base + save_with_name + ext
+            if load_data and prefetch:
+                hdulist[0].data
+            return hdulist
 
-            new_path = path.join(destination_dir, basename)
+        def save(full_path, hdulist):
+            try:
+                new_path, written = save_hdulist(hdulist, full_path,
+                                                 save_with_name=save_with_name,
+                                                 save_location=save_location,
+                                                 clobber=clobber,
+                                                 in_place=in_place)
+                if written is not None:
+                    self.bytes_written[new_path] = written
+            finally:
+                hdulist.close()
 
-            if (new_path != full_path) or clobber:
-                try:
-                    hdulist.writeto(new_path, clobber=clobber)
-                except IOError:
-                    pass
-            hdulist.close()
+        self.bytes_written = OrderedDict()
+        if prefetch:
+            opened = _read_ahead(open_file, paths, prefetch,
+                                 discard=lambda hdulist: hdulist.close())
+        else:
+            opened = ((full_path, open_file(full_path))
+                      for full_path in paths)
+        writer = None
+        if write_depth:
+            writer = _BackgroundWriter(save, write_depth,
+                                       discard=lambda full_path, hdulist:
+                                           hdulist.close())
+        try:
+            for full_path, hdulist in opened:
+                yield func(self, save_with_name=save_with_name,
+                           save_location='', clobber=clobber, hdulist=hdulist)
+                if writer is not None:
+                    writer.put(full_path, hdulist)
+                else:
+                    save(full_path, hdulist)
+        finally:
+            opened.close()
+            if writer is not None:
+                writer.close()
     return wrapper
+
+def _iterate_files_with_data(func):
+    return iterate_files(func, load_data=True)
     
+def fits_files_in_directory(location, extensions=['fit','fits'],
+                            compressed=True):
+    """
+    Get names of FITS files in directory `location`, based on filename
+    extension, as :class:`ImageFileCollection` finds them.
+
+    `extension` is a list of filename extensions that are FITS files.
+
+    `compressed` should be true if compressed files should be included
+    in the list (e.g. `.fits.gz`)
+
+    Returns only the *names* of the files (with extension), not the full pathname.
+    """
+    # trick below is necessary to make sure we start with a clean copy of
+    # extensions each time
+    full_extensions = []
+    full_extensions.extend(extensions)
+    if compressed:
+        with_gz = [extension + '.gz' for extension in extensions]
+        full_extensions.extend(with_gz)
+
+    all_files = listdir(location)
+    files = []
+    for extension in full_extensions:
+        files.extend(fnmatch.filter(all_files, '*'+extension))
+    return files
+
+def thread_map(func, items, workers):
+    """
+    `map(func, items)` using a pool of `workers` threads.
+
+    The order of the results matches the order of `items`.
+    """
+    if workers > 1 and len(items) > 1:
+        pool = ThreadPool(min(workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+    return [func(item) for item in items]
+
+def _summary_table(file_values, keywords, missing):
+    """
+    Build the summary table from header values of individual files.
+
+    `file_values` is a list of `(file name, values)` tuples, where
+    `values` is a dictionary of the keywords present in that file.
+
+    Returns an ATpy table.
+    """
+    summary = OrderedDict()
+    summary['file'] = []
+    missing_values = OrderedDict()
+    missing_values['file'] = []
+    data_type = {}
+    for keyword in keywords:
+        summary[keyword] = []
+        missing_values[keyword] = []
+
+    for afile, values in file_values:
+        summary['file'].append(afile)
+        missing_values['file'].append(False)
+        data_type['file'] = type('string')
+        for keyword in keywords:
+            if keyword in values:
+                summary[keyword].append(values[keyword])
+                missing_values[keyword].append(False)
+                if (keyword in data_type): 
+                    if (type(values[keyword]) != data_type[keyword]):
+                        raise ValueError('Different data types found for keyword %s' % keyword)
+                else:
+                    data_type[keyword] = type(values[keyword])
+            else:
+                summary[keyword].append(missing)
+                missing_values[keyword].append(True)
+
+    summary_table = atpy.Table(masked=True)
+
+    for key in summary.keys():
+        if key not in data_type:
+            data_type[key] = type('str')
+            summary[key] = [str(val) for val in summary[key]]
+        if data_type[key] == type('str'):
+            summary_table.add_column(key, array(summary[key], dtype=str),
+                                     mask=missing_values[key])
+            summary_table[key][array(missing_values[key], dtype=bool)] = ''
+        else:
+            summary_table.add_column(key, summary[key],
+                                     mask=missing_values[key])
+
+
+    return summary_table
+
+def _missing_values(column):
+    """
+    Missing values of a summary column: masked values, and the empty
+    strings `_summary_table` puts in string columns in their place.
+    """
+    missing = ma.getmaskarray(column)
+    if column.dtype.kind == 'S':
+        missing = missing | (ma.getdata(column) == '')
+    return missing
+
+def _merged_dtype(key, old, new):
+    """
+    Data type of the summary column `key` once the values of the column
+    `new` are added to those of `old`, as `_summary_table` would have
+    made it from all of them.
+    """
+    if _missing_values(new).all():
+        return old.dtype
+    if old.dtype.kind == 'S' and new.dtype.kind == 'S':
+        return np.dtype('S%d' % max(old.dtype.itemsize, new.dtype.itemsize))
+    if old.dtype.kind != 'S' and new.dtype.kind != 'S':
+        return np.promote_types(old.dtype, new.dtype)
+    if _missing_values(old).all():
+        # a column of only missing values, made a string column by
+        # _summary_table
+        return new.dtype
+    raise ValueError('Different data types found for keyword %s' % key)
+
+def _column_values(column, dtype, missing):
+    """
+    Values and mask of the summary column `column` as type `dtype`, with
+    missing values stored as `_summary_table` stores them: empty and
+    unmasked in string columns, `missing` and masked otherwise.
+    """
+    column_missing = _missing_values(column)
+    if (column.dtype.kind == 'S') == (dtype.kind == 'S'):
+        values = ma.getdata(column).astype(dtype)
+    else:
+        # only missing values, so nothing to convert
+        values = np.zeros(len(column), dtype=dtype)
+    if dtype.kind == 'S':
+        values[column_missing] = ''
+        return values, np.zeros(len(column), dtype=bool)
+    values[column_missing] = missing
+    return values, column_missing
+
+def _update_summary_rows(table, new_rows, removed, rows, missing):
+    """
+    Update the summary `table` in place with the rows of another
+    summary, `new_rows`, with the same columns.
+
+    `rows` is a dictionary of the row of each file in `table`; it is
+    kept up to date.
+
+    Rows of files in `removed` are dropped, rows of files also in
+    `new_rows` are replaced where they are and the other rows of
+    `new_rows` are appended. Only the rows of changed files are written,
+    unless a column must be widened, or changed to the type of the
+    values read, as `_summary_table` would have made it.
+    """
+    if removed:
+        keep = np.ones(len(table), dtype=bool)
+        keep[[rows[afile] for afile in removed]] = False
+        table.data = table.data[keep]
+        rows.clear()
+        rows.update((afile, row)
+                    for row, afile in enumerate(ma.getdata(table['file'])))
+    if not len(new_rows):
+        return
+
+    dtypes = OrderedDict((key, _merged_dtype(key, table[key], new_rows[key]))
+                         for key in table.keys())
+    if any(dtypes[key] != table[key].dtype for key in dtypes):
+        columns = []
+        for key, dtype in dtypes.items():
+            data, mask = _column_values(table[key], dtype, missing)
+            columns.append((key, data, mask))
+        table.reset()
+        for key, data, mask in columns:
+            table.add_column(key, data, mask=mask)
+
+    new_files = ma.getdata(new_rows['file']).tolist()
+    appended = [afile for afile in new_files if afile not in rows]
+    if appended:
+        n_rows = len(table)
+        extra = ma.array(np.zeros(len(appended), dtype=table.data.dtype),
+                         mask=np.zeros(len(appended),
+                                       dtype=table.data.mask.dtype))
+        table.data = ma.concatenate([table.data, extra])
+        rows.update((afile, n_rows + row)
+                    for row, afile in enumerate(appended))
+    positions = [rows[afile] for afile in new_files]
+    for key, dtype in dtypes.items():
+        values, mask = _column_values(new_rows[key], dtype, missing)
+        table.data.data[key][positions] = values
+        table.data.mask[key][positions] = mask
+
 class ImageFileCollection(object):
     """
     Representation of a collection (usually a directory) of image
@@ -117,7 +880,21 @@ class ImageFileCollection(object):
 
     :attrib summary_info: An ATpy table of information about the FITS files in the direction.
 
+    :attrib bytes_written: Dictionary of the number of bytes written to
+        each file by the most recent `headers`, `hdus` or `data` loop.
+
     :param missing: Value to be used for missing entries.
+
+    :param workers: Number of threads used to read headers; see
+        :meth:`fits_summary`.
+
+    :param catalog: Optional :class:`catalog.SummaryCatalog`, or name of
+        an SQLite file, updated whenever the summary is regenerated and
+        used to answer :meth:`files_filtered`.
+
+    :param files: Optional list of file names; if given, only these
+        files in `location` are part of the collection, and no other
+        file is opened.
     
     To extract a desired set of files::
     
@@ -131,10 +908,28 @@ class ImageFileCollection(object):
     instead of a list.
     """
     def __init__(self,location='.', storage_dir=None, keywords=[],
-                 missing=-999, info_file='Manifest.txt'):
+                 missing=-999, info_file='Manifest.txt', workers=1,
+                 catalog=None, files=None):
         self._location = location
+        self._selected_files = files
         self.storage_dir = storage_dir
-        self._files = self._fits_files_in_directory()
+        self.workers = workers
+        if isinstance(catalog, basestring):
+            catalog = SummaryCatalog(catalog)
+        self.catalog = catalog
+        listed = self._fits_files_in_directory()
+        self._files = self._collection_files(listed)
+        self._header_cache_changes = {}
+        self._header_cache = self._load_header_cache()
+        location = path.abspath(location)
+        listed = set(listed)
+        self._forget_files([full_path for full_path in self._header_cache
+                            if path.dirname(full_path) == location and
+                            path.basename(full_path) not in listed])
+        self._summary_keywords = keywords
+        self._missing = missing
+        self._summary_index = None
+        self.bytes_written = OrderedDict()
         self.summary_info = {}
 
         if info_file is not None:
@@ -151,6 +946,24 @@ class ImageFileCollection(object):
 
         self.summary_info = self.fits_summary(keywords=keywords,
                                               missing=missing)
+        self._update_catalog()
+
+    @property
+    def summary_info(self):
+        """
+        ATpy table of information about the FITS files in the collection.
+
+        Setting the table discards the indexes used by
+        :meth:`files_filtered`; modify the table by replacing it rather
+        than editing it in place.
+        """
+        return self._summary_info
+
+    @summary_info.setter
+    def summary_info(self, table):
+        self._summary_info = table
+        self._summary_index = None
+        self._summary_rows = None
 
     @property
     def location(self):
@@ -174,6 +987,10 @@ class ImageFileCollection(object):
         The storage location must be writeable by the user; this is
         automatically checked when the property is set.
 
+        A cache of header values, keyed by file name, size and
+        modification time, is kept in this directory so that unchanged
+        files are not re-read the next time the collection is opened.
+
         """
         return self._storage
 
@@ -216,7 +1033,10 @@ class ImageFileCollection(object):
         # since keywords are drawn from self.summary_info, setting
         # summary_info sets the keywords.
         if keywords:
-            self.summary_info = self.fits_summary(keywords=keywords)
+            self._summary_keywords = keywords
+            self.summary_info = self.fits_summary(keywords=keywords,
+                                                  missing=self._missing)
+            self._update_catalog()
 
     @property
     def files(self):
@@ -224,6 +1044,76 @@ class ImageFileCollection(object):
         """
         return self._files
 
+    def refresh(self, changed=None):
+        """
+        Bring the collection up to date with the files in `location`.
+
+        The directory is listed again and each file already in the
+        collection is checked with `os.stat`, or only the files in
+        `changed` if it is given, e.g. by a file system watcher that
+        knows which files were written; headers are read only for files
+        that were added or whose size or modification time changed.
+        `summary_info` is updated in place: rows of deleted files are
+        dropped, rows of modified files are replaced and rows of new
+        files are appended. Only these rows are written to the summary,
+        the header cache and the catalog.
+
+        Returns a dictionary with the lists of `added`, `modified` and
+        `removed` files.
+        """
+        old_files = set(self.files)
+        self._files = self._collection_files(self._fits_files_in_directory())
+        new_files = set(self.files)
+
+        modified = []
+        location = path.abspath(self.location)
+        if changed is None:
+            changed = self.files
+        for afile in changed:
+            if afile not in old_files or afile not in new_files:
+                continue
+            entry = self._header_cache.get(path.join(location, afile))
+            try:
+                stat = os.stat(path.join(location, afile))
+            except OSError:
+                continue
+            if (entry is None or entry['size'] != stat.st_size or
+                entry['mtime'] != stat.st_mtime):
+                modified.append(afile)
+        added = [afile for afile in self.files if afile not in old_files]
+        removed = sorted(old_files - new_files)
+        self._forget_files([path.join(location, afile) for afile in removed])
+
+        missing = float(self._missing)
+        new_rows = _summary_table(self._file_values(self._summary_keywords,
+                                                    files=added + modified),
+                                  self._summary_keywords, missing)
+        if self._summary_rows is None:
+            self._summary_rows = dict(
+                (afile, row) for row, afile in
+                enumerate(ma.getdata(self.summary_info['file'])))
+        _update_summary_rows(self.summary_info, new_rows, removed,
+                             self._summary_rows, missing)
+        self._summary_index = None
+        if self.catalog is not None:
+            self.catalog.update(self.location, new_rows, remove_missing=False)
+            self.catalog.remove_files(self.location, removed)
+        return {'added': sorted(added),
+                'modified': sorted(modified),
+                'removed': removed}
+
+    def _update_catalog(self):
+        """
+        Store the current summary in the catalog, if there is one.
+
+        Rows of files not in the summary are removed only if the
+        collection holds every file in its directory.
+        """
+        if (self.catalog is not None and
+            isinstance(self.summary_info, atpy.Table)):
+            self.catalog.update(self.location, self.summary_info,
+                                remove_missing=self._selected_files is None)
+
     def values(self, keyword, unique=False):
         """Return list of values for a particular keyword.
 
@@ -257,13 +1147,33 @@ class ImageFileCollection(object):
         >>> collection.files_filtered(imagetyp='*', filter='')
         
         NOTE: Value comparison is case *insensitive* for strings.
+
+        If a catalog is attached and all of the keywords are in the
+        summary, the query is run as indexed SQL on the catalog.
+        """
+        if (self.catalog is not None and
+            isinstance(self.summary_info, atpy.Table) and
+            set(kwd.keys()).issubset(set(self.keywords))):
+            return self._catalog_files_filtered(**kwd)
+        return self._find_keywords_by_values(**kwd)
+
+    def _catalog_files_filtered(self, **kwd):
         """
+        Files of the collection whose keywords have given values, from
+        the catalog.
 
-        self._find_keywords_by_values(**kwd)
-        return self.summary_info['file'].compressed()
+        Returns an array of file names in the order of the summary, like
+        :meth:`_find_keywords_by_values`; the catalog may also hold other
+        files of this directory, which are left out.
+        """
+        matches = set(path.basename(full_path) for full_path in
+                      self.catalog.files_filtered(directory=self.location,
+                                                  **kwd))
+        return array([name for name in self.summary_info['file']
+                      if name in matches], dtype=str)
         
     def fits_summary(self, 
-                     keywords=['imagetyp'], missing=-999):
+                     keywords=['imagetyp'], missing=-999, workers=None):
         """
         Collect information about fits files in a directory.
 
@@ -276,58 +1186,193 @@ class ImageFileCollection(object):
 
         `missing` is the numerical value to be substituted if a particular file
         doesn't have a keyword. =
+
+        Headers are only read for files that are new or whose size or
+        modification time changed since they were last read; if
+        `storage_dir` is set the cache of header values is kept there
+        between sessions.
+
+        `workers` is the number of threads used to read headers; if it
+        is `None` the value given when the collection was created is
+        used. Reading headers is dominated by file latency, so several
+        workers help most when the files are on network storage. The
+        order of files in the summary does not depend on `workers`.
         
         Returns an ATpy table.
         """
-        from collections import OrderedDict
-
         missing = float(missing)
-        
-        summary = OrderedDict()
-        summary['file'] = []
-        missing_values = OrderedDict()
-        missing_values['file'] = []
-        data_type = {}
-        for keyword in keywords:
-            summary[keyword] = []
-            missing_values[keyword] = []
+        file_values = self._file_values(keywords, workers=workers)
+        return _summary_table(file_values, keywords, missing)
+
+    def _file_values(self, keywords, workers=None, files=None):
+        """
+        Header values of `keywords` for each readable file of `files`,
+        by default all of `self.files`.
+
+        Returns a list of `(file name, values)` tuples in the order of
+        `files`; files that cannot be read are left out. The header
+        cache is saved afterwards.
+        """
+        if workers is None:
+            workers = self.workers
+        if files is None:
+            files = self.files
 
-        for afile in self.files:
+        def read_values(afile):
             try:
-                header = pyfits.getheader(path.join(self.location,afile))
+                return self._header_values(afile, keywords)
             except IOError:
-                continue
-            summary['file'].append(afile)
-            missing_values['file'].append(False)
-            data_type['file'] = type('string')
-            for keyword in keywords:
-                if keyword in header:
-                    summary[keyword].append(header[keyword])
-                    missing_values[keyword].append(False)
-                    if (keyword in data_type): 
-                        if (type(header[keyword]) != data_type[keyword]):
-                            raise ValueError('Different data types found for keyword %s' % keyword)
+                return None
+
+        all_values = thread_map(read_values, files, workers)
+        self._save_header_cache()
+        return [(afile, values)
+                for afile, values in zip(files, all_values)
+                if values is not None]
+
+    def _header_values(self, afile, keywords):
+        """
+        Values of `keywords` in the header of `afile`.
+
+        Values are taken from the header cache if the size and
+        modification time of the file match the cached entry;
+        otherwise the header is read and the cache is updated.
+
+        Returns a dictionary with an entry for each keyword present
+        in the header. Raises `IOError` if the file cannot be read.
+        """
+        full_path = path.abspath(path.join(self.location, afile))
+        stat = os.stat(full_path)
+        cached = self._header_cache.get(full_path)
+        entry = cached
+        if (entry is None or
+            entry['size'] != stat.st_size or
+            entry['mtime'] != stat.st_mtime):
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                     'values': {}, 'checked': set()}
+
+        to_read = [keyword.upper() for keyword in keywords
+                   if keyword.upper() not in entry['checked']]
+        if to_read:
+            entry['values'].update(read_header_values(full_path, to_read))
+            entry['checked'].update(to_read)
+        # the size and modification time are kept even if no keywords
+        # were read, so refresh can tell the file has not changed
+        if to_read or entry is not cached:
+            self._header_cache[full_path] = entry
+            self._header_cache_changes[full_path] = entry
+
+        values = {}
+        for keyword in keywords:
+            if keyword.upper() in entry['values']:
+                values[keyword] = entry['values'][keyword.upper()]
+        return values
+
+    def _header_cache_path(self):
+        """
+        Full path of the header cache file, or `None` if the collection
+        is not stored on disk.
+        """
+        if not self.storage_dir:
+            return None
+        return path.join(self.storage_dir, header_cache_name)
+
+    def _header_cache_journal_path(self):
+        """
+        Full path of the journal of changes to the header cache.
+        """
+        return self._header_cache_path() + '.journal'
+
+    def _load_header_cache(self):
+        """
+        Read the header cache from `storage_dir`.
+
+        The cache is a dictionary, indexed by the full path of each
+        file, of the size, modification time and header values of the
+        file. The changes in the journal written by
+        `_save_header_cache` are applied to it. An empty cache is
+        returned if there is no cache file or it cannot be read.
+        """
+        self._header_cache_journal_length = 0
+        cache_path = self._header_cache_path()
+        if cache_path is None or not path.exists(cache_path):
+            return {}
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                cache = cPickle.load(cache_file)
+        except Exception:
+            print 'Unable to read header cache %s, ignoring it' % cache_path
+            return {}
+        journal_path = self._header_cache_journal_path()
+        if path.exists(journal_path):
+            with open(journal_path, 'rb') as journal:
+                while True:
+                    try:
+                        full_path, entry = cPickle.load(journal)
+                    except EOFError:
+                        break
+                    except Exception:
+                        # a change cut short by a crash; the cache is
+                        # written again in full by the next save
+                        self._header_cache_journal_length = None
+                        break
+                    if entry is None:
+                        cache.pop(full_path, None)
                     else:
-                        data_type[keyword] = type(header[keyword])
-                else:
-                    summary[keyword].append(missing)
-                    missing_values[keyword].append(True)
-                                                  
-        summary_table = atpy.Table(masked=True)
-
-        for key in summary.keys():
-            if key not in data_type:
-                data_type[key] = type('str')
-                summary[key] = [str(val) for val in summary[key]]
-            if data_type[key] == type('str'):
-                summary_table.add_column(key, summary[key], mask=missing_values[key])
-                summary_table[key][array(missing_values[key])] = ''
-            else:
-                summary_table.add_column(key, summary[key],
-                                         mask=missing_values[key])
+                        cache[full_path] = entry
+                    if self._header_cache_journal_length is not None:
+                        self._header_cache_journal_length += 1
+        return cache
+
+    def _forget_files(self, full_paths):
+        """
+        Drop the header cache entries of `full_paths`, which are files
+        that no longer exist.
+        """
+        for full_path in full_paths:
+            if self._header_cache.pop(full_path, None) is not None:
+                self._header_cache_changes[full_path] = None
 
+    def _save_header_cache(self):
+        """
+        Write the changes to the header cache to `storage_dir`.
+
+        The changes are appended to a journal next to the cache file,
+        so a save takes time in proportion to the number of files read
+        or forgotten since the last one. Once the journal is as long as
+        the cache, the whole cache is written instead, atomically so
+        that a partially written cache is never read, and the journal
+        is removed.
+        """
+        cache_path = self._header_cache_path()
+        changes = self._header_cache_changes
+        self._header_cache_changes = {}
+        if cache_path is None or not changes:
+            return
+        journal_length = self._header_cache_journal_length
+        if (path.exists(cache_path) and journal_length is not None and
+            journal_length + len(changes) <= len(self._header_cache)):
+            with open(self._header_cache_journal_path(), 'ab') as journal:
+                for change in changes.iteritems():
+                    cPickle.dump(change, journal, cPickle.HIGHEST_PROTOCOL)
+            self._header_cache_journal_length += len(changes)
+            return
 
-        return summary_table
+        tmp_cache = NamedTemporaryFile(dir=self.storage_dir, delete=False)
+        try:
+            cPickle.dump(self._header_cache, tmp_cache,
+                         cPickle.HIGHEST_PROTOCOL)
+            tmp_cache.close()
+            # without the journal, a crash before the rename leaves the
+            # old cache, which is only out of date
+            if path.exists(self._header_cache_journal_path()):
+                os.remove(self._header_cache_journal_path())
+            os.rename(tmp_cache.name, cache_path)
+        except Exception:
+            tmp_cache.close()
+            os.remove(tmp_cache.name)
+            raise
+        self._header_cache_journal_length = 0
 
     def _find_keywords_by_values(self, **kwd):
         """
@@ -344,61 +1389,39 @@ class ImageFileCollection(object):
         >>> collection.files_filtered(imagetyp='*', filter='')
         
         NOTE: Value comparison is case *insensitive* for strings.
+
+        Returns an array of file names; the summary is not modified.
         """
-        keywords = kwd.keys()
-        values = kwd.values()
-        
-        if (set(keywords) & set(self.keywords)):
+        if set(kwd.keys()).issubset(set(self.keywords)):
             # we already have the information in memory
-            use_info = self.summary_info
+            if self._summary_index is None:
+                self._summary_index = SummaryIndex(self.summary_info)
+            index = self._summary_index
         else:
             # we need to load information about these keywords.
-            use_info = self.fits_summary(keywords=keywords)
-            
-        matches = array([True] * len(use_info))
-        for key, value in zip(keywords, values):
-            if value == '*':
-                have_this_value = (use_info[key] != '')
-            else:
-                if isinstance(value, basestring):
-                    # need to loop explicitly over array rather than using
-                    # where to correctly do string comparison.
-                    have_this_value = array([False] * len(use_info))
-                    for idx, file_key_value in enumerate(use_info[key]):
-                        have_this_value[idx] = (file_key_value.lower() == value.lower())
-                else:
-                    have_this_value = (use_info[key] == value)
-            matches &= have_this_value
-            
-        # the numpy convention is that the mask is True for values to
-        # be omitted, hence use ~matches.
-        self.summary_info['file'][~matches] = ma.masked
+            index = SummaryIndex(self.fits_summary(keywords=kwd.keys(),
+                                                   missing=self._missing))
+
+        return index.column('file')[index.rows(**kwd)]
         
+    def _collection_files(self, files):
+        """
+        Names of the FITS files of the directory listing `files` that
+        are part of the collection.
+        """
+        if self._selected_files is not None:
+            selected = set(self._selected_files)
+            files = [afile for afile in files if afile in selected]
+        return files
+
     def _fits_files_in_directory(self, extensions=['fit','fits'], compressed=True):
         """
         Get names of FITS files in directory, based on filename extension.
-        
-        `extension` is a list of filename extensions that are FITS files.
-        
-        `compressed` should be true if compressed files should be included
-        in the list (e.g. `.fits.gz`)
-        
-        Returns only the *names* of the files (with extension), not the full pathname.
-        """
-        # trick below is necessary to make sure we start with a clean copy of
-        # extensions each time
-        full_extensions = []
-        full_extensions.extend(extensions)
-        if compressed:
-            with_gz = [extension + '.gz' for extension in extensions]
-            full_extensions.extend(with_gz)
-            
-            all_files = listdir(self.location)
-            files = []
-            for extension in full_extensions:
-                files.extend(fnmatch.filter(all_files, '*'+extension))
-                
-            return files
+
+        See :func:`fits_files_in_directory`.
+        """
+        return fits_files_in_directory(self.location, extensions=extensions,
+                                       compressed=compressed)
 
     def paths(self):
         """
@@ -435,6 +1458,23 @@ class ImageFileCollection(object):
         do_not_scale_image_data : bool
             If true, prevents pyfits from scaling images (useful for
             preserving unsigned int images unmodified)
+
+        in_place : bool
+            If True, and input files are being overwritten, write only
+            the header blocks of each file when the modified header
+            still fits in them; otherwise the whole file is rewritten.
+            The number of bytes written to each file is recorded in
+            `self.bytes_written`.
+
+        prefetch : int
+            If non-zero, a background thread opens up to this many
+            files ahead of the one being processed, so reading
+            overlaps with processing.
+
+        write_depth : int
+            If non-zero, files are saved by a background thread; at
+            most this many processed files wait to be written before
+            the loop waits for the writer to catch up.
         
         **kwd : dict
             Any additional keywords are passed to `pyfits.open`
@@ -442,13 +1482,262 @@ class ImageFileCollection(object):
         
         return hdulist[0].header
 
-    @iterate_files    
+    @_iterate_files_with_data
     def hdus(self, save_with_name='',
                 save_location='', clobber=False,
                 hdulist=None, do_not_scale_image_data=False,
                 **kwd):
         return hdulist[0]
 
-    @iterate_files
+    @_iterate_files_with_data
     def data(self, hdulist=None, save_with_name="", save_location='', clobber=False):
-        return hdulist[0].data
\ No newline at end of file
+        return hdulist[0].data
+
+    def mapped_data(self, uint=False, **kwd):
+        """
+        Lazy, memory-mapped image data for each file.
+
+        Generator of :class:`MappedImage`, one per file, in the order
+        of :meth:`paths`; no pixels are read, and no file is mapped,
+        until an image is used, so sub-regions (e.g. overscan) of many
+        images can be extracted cheaply. Only images that have been used
+        and are still referenced hold an open file.
+
+        `uint` is passed to :class:`MappedImage`.
+
+        `**kwd` selects files as for :meth:`files_filtered`.
+        """
+        if kwd:
+            paths = [path.join(self.location, file_)
+                     for file_ in self._find_keywords_by_values(**kwd)]
+        else:
+            paths = self.paths()
+        for full_path in paths:
+            yield MappedImage(full_path, uint=uint)
+
+
+class ImageFileArchive(object):
+    """
+    Collection of the FITS files in every directory below `root`,
+    e.g. an archive of many nights of data.
+
+    :attrib summary_info: An ATpy table of information about all of the
+        FITS files; the `directory` column gives the directory, relative
+        to `root`, of each file.
+
+    `keywords` and `missing` have the same meaning as for
+    :class:`ImageFileCollection`.
+
+    `storage_dir` should be `True` to keep a header cache in each
+    directory (see :attr:`ImageFileCollection.storage_dir`), or the
+    name of a directory below which the caches are kept in a tree that
+    mirrors the one below `root`, one cache per directory.
+
+    `workers` is the number of directories scanned at the same time.
+
+    `catalog` is an optional :class:`catalog.SummaryCatalog`, or name of
+    an SQLite file, that is kept in step with the archive on each
+    :meth:`refresh`.
+
+    To find all of the R band flats taken in March 2012::
+
+        archive = ImageFileArchive('/data/feder',
+                                   keywords=['imagetyp', 'filter',
+                                             'date-obs'])
+        archive.files_filtered(imagetyp='flat', filter='R',
+                               date_range=('2012-03', '2012-04'))
+    """
+    def __init__(self, root='.', keywords=[], missing=-999,
+                 storage_dir=None, workers=4, catalog=None):
+        self._root = root
+        self._keywords = keywords
+        self._missing = missing
+        self._storage = storage_dir
+        self.workers = workers
+        if isinstance(catalog, basestring):
+            catalog = SummaryCatalog(catalog)
+        self.catalog = catalog
+        self._collections = {}
+        self.summary_info = {}
+        self.refresh()
+
+    @property
+    def root(self):
+        """Top directory of the archive."""
+        return self._root
+
+    @property
+    def summary_info(self):
+        """
+        ATpy table of information about the FITS files in the archive.
+        """
+        return self._summary_info
+
+    @summary_info.setter
+    def summary_info(self, table):
+        self._summary_info = table
+        self._summary_index = None
+
+    @property
+    def directories(self):
+        """Directories, relative to `root`, that contain FITS files."""
+        return sorted(self._collections.keys())
+
+    def collection(self, directory):
+        """
+        The :class:`ImageFileCollection` for `directory`, which is
+        relative to `root`.
+        """
+        return self._collections[directory]
+
+    def _directories_in_tree(self):
+        """
+        Directories, relative to `root`, containing files that look
+        like FITS files.
+        """
+        patterns = ['*.fit', '*.fits', '*.fit.gz', '*.fits.gz']
+        directories = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for pattern in patterns:
+                if fnmatch.filter(filenames, pattern):
+                    directories.append(path.relpath(dirpath, self.root))
+                    break
+        return directories
+
+    def _collection_storage(self, directory):
+        """
+        `storage_dir` for the collection of `directory`, which is
+        relative to `root`.
+
+        Collections are scanned at the same time, so they must not share
+        a header cache file.
+        """
+        if not isinstance(self._storage, basestring):
+            return self._storage
+        storage = path.normpath(path.join(self._storage, directory))
+        if not path.isdir(storage):
+            try:
+                os.makedirs(storage)
+            except OSError:
+                # another thread may have made it first
+                if not path.isdir(storage):
+                    raise
+        return storage
+
+    def refresh(self):
+        """
+        Scan the directory tree and update the summary.
+
+        New directories are added, directories that no longer contain
+        FITS files are dropped and each existing directory is refreshed
+        with :meth:`ImageFileCollection.refresh`, so only new or changed
+        files are read. Directories are scanned concurrently.
+
+        Only the catalog rows of new, changed and removed files are
+        written.
+        """
+        directories = self._directories_in_tree()
+
+        def scan(directory):
+            if directory in self._collections:
+                collection = self._collections[directory]
+                changes = collection.refresh()
+            else:
+                collection = ImageFileCollection(path.join(self.root,
+                                                           directory),
+                                                 storage_dir=self._collection_storage(directory),
+                                                 info_file=None)
+                changes = None
+            return (collection, changes,
+                    collection._file_values(self._keywords, workers=1))
+
+        scanned = thread_map(scan, directories, self.workers)
+
+        if self.catalog is not None:
+            for directory in set(self._collections) - set(directories):
+                self.catalog.remove_directory(path.join(self.root, directory))
+
+        self._collections = {}
+        file_values = []
+        file_directories = []
+        for directory, (collection, changes, values) in zip(directories,
+                                                             scanned):
+            self._collections[directory] = collection
+            file_values.extend(values)
+            file_directories.extend([directory] * len(values))
+            if self.catalog is not None:
+                self._update_catalog(collection.location, values, changes)
+
+        summary = _summary_table(file_values, self._keywords,
+                                 float(self._missing))
+        summary.add_column('directory', array(file_directories, dtype=str),
+                           before='file')
+        self.summary_info = summary
+
+    def _update_catalog(self, location, values, changes):
+        """
+        Store the `values` of the files in directory `location` in the
+        catalog.
+
+        `changes` is the result of :meth:`ImageFileCollection.refresh`
+        for the directory, or `None` if it is new to the archive, in
+        which case all of its rows are written.
+        """
+        missing = float(self._missing)
+        if changes is None:
+            self.catalog.update(location, _summary_table(values,
+                                                         self._keywords,
+                                                         missing))
+            return
+        changed = set(changes['added'] + changes['modified'])
+        if changed:
+            new_rows = _summary_table([(afile, file_values)
+                                       for afile, file_values in values
+                                       if afile in changed],
+                                      self._keywords, missing)
+            self.catalog.update(location, new_rows, remove_missing=False)
+        if changes['removed']:
+            self.catalog.remove_files(location, changes['removed'])
+
+    def paths(self):
+        """
+        Full path to each file.
+        """
+        return [path.join(self.root, directory, file_)
+                for directory, file_ in zip(self.summary_info['directory'],
+                                            self.summary_info['file'])]
+
+    def files_filtered(self, date_range=None, date_keyword='date-obs',
+                       **kwd):
+        """
+        Full paths of files whose keywords have listed values.
+
+        `**kwd` is list of keywords and values the files must have, as
+        for :meth:`ImageFileCollection.files_filtered`.
+
+        `date_range` is an optional `(start, end)` pair of ISO dates,
+        e.g. `('2012-03-01', '2012-03-15T12:00')`, compared as strings
+        with `date_keyword`. Files are selected if `start <= date < end`.
+        """
+        if self._summary_index is None:
+            self._summary_index = SummaryIndex(self.summary_info)
+        index = self._summary_index
+        for keyword in kwd.keys():
+            if keyword not in self.summary_info.keys():
+                raise ValueError('keyword %s is not in the current summary'
+                                 % keyword)
+        rows = index.rows(**kwd)
+
+        if date_range is not None:
+            if date_keyword not in self.summary_info.keys():
+                raise ValueError('keyword %s is not in the current summary'
+                                 % date_keyword)
+            start, end = date_range
+            dates = index.column(date_keyword)
+            rows = [row for row in rows if start <= dates[row] < end]
+
+        directories = index.column('directory')
+        files = index.column('file')
+        return [path.join(self.root, directories[row], files[row])
+                for row in rows]
@@ -2,22 +2,73 @@ import image_collection as tff
 import ccd_characterization as ccd_char
 from astropysics import ccd
 from os import path
+import os
+from hashlib import sha1
 from numpy import median, mean
 from datetime import datetime
 from pyfits import Header
 import pyfits
+from combine import (tiled_combine, use_tiled_combine, default_memory_limit,
+                     combine_methods, method_description, IncrementalCombine)
 
 temperature_tolerance = 2 #degree C
 combiner = ccd.ImageCombiner()
 
-def combine_from_list(dir, fnames, combiner):
+def combine_from_list(dir, fnames, combiner, memory_limit=None, workers=1,
+                      method_params=None):
+    """
+    Combine the images `fnames` in directory `dir` with `combiner`.
+
+    If `memory_limit` is set, or `workers` is more than one, the images
+    are memory-mapped and combined in tiles using about `memory_limit`
+    bytes by `workers` processes (see :func:`combine.tiled_combine`)
+    instead of being loaded in full; the result is the same.
+
+    The rejection methods of :mod:`combine` ('sigclip', 'avsigclip',
+    'minmax') may be used as `combiner.method`, with their parameters in
+    `method_params`; they are always combined in tiles. Methods that
+    :mod:`combine` does not provide, e.g. 'sum', are never tiled, nor is
+    a combine that uses `combiner.sigclip` or `combiner.shifts`.
+    """
+    if use_tiled_combine(combiner, memory_limit, workers, method_params):
+        if memory_limit is None:
+            memory_limit = default_memory_limit
+        paths = [path.join(dir, fn) for fn in fnames]
+        # ccd.FitsImage data is transposed relative to the FITS file
+        return tiled_combine(paths, method=combiner.method,
+                             memory_limit=memory_limit, workers=workers,
+                             method_params=method_params).T
     data = []
     for fn in fnames:
         a_data = ccd.FitsImage(path.join(dir,fn))
         data.append(a_data)
     return combiner.combineImages(data)
 
-def master_frame(data, T, Terr, sample=None,combiner=None,img_type=''):
+def incremental_combine(dir, fnames, state_name, method='median',
+                        memory_limit=None):
+    """
+    Combine the images `fnames` in directory `dir`, reusing the state
+    kept in the subdirectory `state_name` by earlier calls.
+
+    Only the files not combined before are read; if a file combined
+    before is no longer in `fnames`, or has been changed since, the
+    state is discarded and all of the files are combined again. See :class:`combine.IncrementalCombine`
+    for the methods that can be used.
+
+    Returns the combined image, oriented like the result of
+    :func:`combine_from_list`, and the list of files combined.
+    """
+    state = IncrementalCombine(path.join(dir, state_name), method)
+    if not state.is_current([path.join(dir, fn) for fn in fnames]):
+        state.clear()
+    state.add([path.join(dir, fn) for fn in fnames if fn not in state.files])
+    # ccd.FitsImage data is transposed relative to the FITS file
+    combined = state.combine(memory_limit=memory_limit or
+                             default_memory_limit).T
+    return combined, state.files
+
+def master_frame(data, T, Terr, sample=None,combiner=None,img_type='',
+                 method_params=None):
     copy_from_sample = ['imagetyp', 'xbinning', 'ybinning',
                         'xpixsz', 'ypixsz', 'exptime']
     img = ccd.FitsImage(data)
@@ -40,7 +91,10 @@ def master_frame(data, T, Terr, sample=None,combiner=None,img_type=''):
     hdr.update('temp-dev', Terr,
                'Standard deviation of CCD temperature')
     if combiner is not None:
-        hdr.update('cmbn-mth',combiner.method,
+        method = combiner.method
+        if isinstance(method, basestring) and method in combine_methods:
+            method = method_description(method, method_params)
+        hdr.update('cmbn-mth',method,
                    'Combination method for producing master')
         
     if sample is not None:
@@ -63,7 +117,74 @@ def add_files_info(fits_image, files):
     for fil in files:
         hdr.add_comment('    '+fil)
     
-def master_bias_dark(directories):
+def master_hash(file_names, method, method_params=None, depends_on=[]):
+    """
+    Hash identifying the inputs of a master frame.
+
+    The hash covers the sorted names, sizes and modification times of
+    `file_names` and of the files in `depends_on` (e.g. the master dark
+    subtracted from flats), and the combining `method` with its
+    parameters. It changes whenever any input does.
+    """
+    key = sha1()
+    for file_name in sorted(file_names) + ['--'] + list(depends_on):
+        if file_name != '--':
+            stat = os.stat(file_name)
+            file_name = '%s %d %r' % (path.basename(file_name), stat.st_size,
+                                      stat.st_mtime)
+        key.update(file_name + '\n')
+    if isinstance(method, basestring) and method in combine_methods:
+        method = method_description(method, method_params)
+    key.update(str(method))
+    return key.hexdigest()
+
+def add_master_hash(fits_image, key):
+    hdr = fits_image.fitsfile[0].header
+    hdr.update('mstrhash', key,
+               'SHA1 of input files and combine method')
+
+def master_is_current(file_name, key):
+    """
+    `True` if the master frame `file_name` exists and was made from the
+    inputs identified by `key` (see :func:`master_hash`).
+    """
+    if not path.exists(file_name):
+        return False
+    return tff.read_header_values(file_name, ['mstrhash']).get('MSTRHASH') == key
+
+def master_bias_dark(directories, memory_limit=None, workers=1,
+                     method='median', method_params=None, rebuild=False,
+                     incremental=False):
+    """
+    Construct master bias and darks by combining individual frames.
+
+    :param directories: List of directories.
+
+    :param memory_limit: If set, frames are combined in tiles using
+        about this many bytes; see :func:`combine_from_list`.
+
+    :param workers: Number of processes used to combine each master;
+        see :func:`combine_from_list`.
+
+    :param method: Combining method, e.g. 'median' or 'sigclip'; see
+        :mod:`combine`.
+
+    :param method_params: Dictionary of parameters for `method`; they
+        are recorded with the method in the ``cmbn-mth`` keyword.
+
+    :param rebuild: Each master records a hash of its inputs in the
+        ``mstrhash`` keyword, and a master whose inputs have not changed
+        is not made again unless `rebuild` is `True`.
+
+    :param incremental: If `True`, the state of each 'mean' or 'median'
+        combination is kept in a hidden subdirectory of the directory,
+        and when frames are added only the new frames are read; see
+        :func:`incremental_combine`. `method_params` cannot be used
+        with it.
+    """
+    if incremental and method_params:
+        raise ValueError('method_params cannot be used with incremental '
+                         'combining')
     for currentDir in directories:
         print 'Directory %s' % currentDir
         keywords = ['imagetyp', 'exptime', 'ccd-temp', 'calstat', 'master']
@@ -76,17 +197,35 @@ def master_bias_dark(directories):
                                  (useful['imagetyp']=='Bias Frame')) &
                                 (useful['master'] != 'Y'))
         if bias_files:
-            combiner.method = 'median'
-            master_bias = combine_from_list(currentDir,
-                                            bias_files['file'], combiner)
-            avg_temp = bias_files['ccd-temp'].mean()
-            temp_dev = bias_files['ccd-temp'].std()
-            sample = pyfits.open(path.join(currentDir,bias_files['file'][0]))
-            bias_im = master_frame(master_bias, avg_temp,
-                                   temp_dev, sample=sample[0].header,
-                                   combiner=combiner)
-            add_files_info(bias_im,bias_files['file'])
-            bias_im.save(path.join(currentDir, 'Master_Bias.fit'))
+            bias_fn = path.join(currentDir, 'Master_Bias.fit')
+            bias_key = master_hash([path.join(currentDir, fn)
+                                    for fn in bias_files['file']],
+                                   method, method_params)
+            if not rebuild and master_is_current(bias_fn, bias_key):
+                print 'Master_Bias.fit is up to date'
+            else:
+                combiner.method = method
+                bias_list = bias_files['file']
+                if incremental:
+                    master_bias, bias_list = incremental_combine(
+                        currentDir, bias_list, '.Master_Bias.state',
+                        method=method, memory_limit=memory_limit)
+                else:
+                    master_bias = combine_from_list(currentDir,
+                                                    bias_list, combiner,
+                                                    memory_limit=memory_limit,
+                                                    workers=workers,
+                                                    method_params=method_params)
+                avg_temp = bias_files['ccd-temp'].mean()
+                temp_dev = bias_files['ccd-temp'].std()
+                sample = pyfits.open(path.join(currentDir,bias_files['file'][0]))
+                bias_im = master_frame(master_bias, avg_temp,
+                                       temp_dev, sample=sample[0].header,
+                                       combiner=combiner,
+                                       method_params=method_params)
+                add_files_info(bias_im,bias_list)
+                add_master_hash(bias_im, bias_key)
+                bias_im.save(bias_fn)
 
         dark_files = useful.where(((useful['imagetyp']=='DARK') |
                                    (useful['imagetyp']=='Dark Frame'))
@@ -103,16 +242,36 @@ def master_bias_dark(directories):
                 good_darks = abs(these_darks['ccd-temp'] - avg_temp[time]) < temperature_tolerance
                 if not good_darks.all():
                     raise RuntimeError('Darks with exposure time %f have a temperature problem!' % time )
-                combiner.method = 'median'
-                master_dark = combine_from_list(currentDir,
-                                                these_darks['file'], combiner)
+                dark_fn = 'Master_Dark_{:.2f}_sec_{:.2f}_degC.fit'.format(round(time, 2),
+                                                              round(avg_temp[time], 2))
+                dark_key = master_hash([path.join(currentDir, fn)
+                                        for fn in these_darks['file']],
+                                       method, method_params)
+                if not rebuild and master_is_current(path.join(currentDir,
+                                                               dark_fn),
+                                                     dark_key):
+                    print '%s is up to date' % dark_fn
+                    continue
+                combiner.method = method
+                dark_list = these_darks['file']
+                if incremental:
+                    state_name = '.Master_Dark_{:.2f}_sec.state'.format(round(time, 2))
+                    master_dark, dark_list = incremental_combine(
+                        currentDir, dark_list, state_name,
+                        method=method, memory_limit=memory_limit)
+                else:
+                    master_dark = combine_from_list(currentDir,
+                                                    dark_list, combiner,
+                                                    memory_limit=memory_limit,
+                                                    workers=workers,
+                                                    method_params=method_params)
                 sample = pyfits.open(path.join(currentDir,these_darks['file'][0]))
                 dark_im = master_frame(master_dark, avg_temp[time],
                                        temp_dev, sample=sample[0].header,
-                                       combiner=combiner)
-                dark_fn = 'Master_Dark_{:.2f}_sec_{:.2f}_degC.fit'.format(round(time, 2),
-                                                              round(avg_temp[time], 2))
-                add_files_info(dark_im,these_darks['file'])
+                                       combiner=combiner,
+                                       method_params=method_params)
+                add_files_info(dark_im,dark_list)
+                add_master_hash(dark_im, dark_key)
                 dark_im.save(path.join(currentDir, dark_fn))
 
                 print time, avg_temp[time], median(master_dark[time]), mean(master_dark[time])
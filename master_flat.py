@@ -5,16 +5,39 @@ from os import path
 import pyfits
 from datetime import datetime
 import numpy as np
-from master_bias_dark import master_frame, add_files_info
+from master_bias_dark import (master_frame, add_files_info, master_hash,
+                              add_master_hash, master_is_current)
+from combine import tiled_combine, use_tiled_combine, default_memory_limit
+from image_collection import MappedImage
 
 combiner = ccd.ImageCombiner()
 
-def master_flat(directories):
+def master_flat(directories, memory_limit=None, workers=1,
+                method='median', method_params=None, rebuild=False):
     """
     Construct master flats by combining individual flats.
 
     :param directories: List of directories.
 
+    :param memory_limit: If set, the dark-subtracted flats are combined
+        in tiles using about this many bytes (see
+        :func:`combine.tiled_combine`) instead of being loaded in full.
+
+    :param workers: Number of processes used to combine each master
+        flat; more than one implies the tiled combine.
+
+    :param method: Combining method, e.g. 'median' or 'sigclip'; the
+        other methods of :data:`combine.combine_methods` imply the tiled
+        combine, while those only ``ccd.ImageCombiner`` provides, e.g.
+        'sum', load the flats in full.
+
+    :param method_params: Dictionary of parameters for `method`; they
+        are recorded with the method in the ``cmbn-mth`` keyword.
+
+    :param rebuild: If `False`, a master flat whose flats, master dark
+        and combining method are unchanged since it was made (see
+        :func:`master_bias_dark.master_hash`) is not made again.
+
     Each directory must contain master darks whose exposure time
     matches the flats in the directory. A separate master flat will be
     constructed for each filter band for which there are flats in the directory.
@@ -45,21 +68,45 @@ def master_flat(directories):
                 if not master_dark:
                     print 'Sorry, no dark for the exposure %f, skipping....' %time
                     continue
-                master_dark = ccd.FitsImage(path.join(currentDir,master_dark['file'][0]))
-                flats = []
-                for flat_file in these_flats['file']:
-                    flat = ccd.FitsImage(path.join(currentDir,flat_file))
-                    flats.append(flat.data - master_dark.data)
-                combiner.method = "median"
-                master_flat = combiner.combineImages(flats)
+                dark_path = path.join(currentDir, master_dark['file'][0])
+                flat_paths = [path.join(currentDir, flat_file)
+                              for flat_file in these_flats['file']]
+                flat_fn = 'Master_Flat_%s_band.fit' % flat_filter
+                flat_key = master_hash(flat_paths, method, method_params,
+                                       depends_on=[dark_path])
+                if not rebuild and master_is_current(path.join(currentDir,
+                                                               flat_fn),
+                                                     flat_key):
+                    print '%s is up to date' % flat_fn
+                    continue
+                combiner.method = method
+                if use_tiled_combine(combiner, memory_limit, workers,
+                                     method_params):
+                    master_dark = MappedImage(dark_path)
+                    # ccd.FitsImage data is transposed relative to the file
+                    master_flat = tiled_combine(flat_paths,
+                                                method=combiner.method,
+                                                memory_limit=(memory_limit or
+                                                              default_memory_limit),
+                                                subtract=master_dark,
+                                                workers=workers,
+                                                method_params=method_params).T
+                else:
+                    master_dark = ccd.FitsImage(dark_path)
+                    flats = []
+                    for flat_file in these_flats['file']:
+                        flat = ccd.FitsImage(path.join(currentDir,flat_file))
+                        flats.append(flat.data - master_dark.data)
+                    master_flat = combiner.combineImages(flats)
                 avg_temp = these_flats['ccd-temp'].mean()
                 temp_dev = these_flats['ccd-temp'].std()
                 sample = pyfits.open(path.join(currentDir,these_flats['file'][0]))
                 flat_im = master_frame(master_flat, avg_temp,
                                        temp_dev, sample=sample[0].header,
-                                       combiner=combiner)
-                flat_fn = 'Master_Flat_%s_band.fit' % flat_filter
+                                       combiner=combiner,
+                                       method_params=method_params)
                 add_files_info(flat_im, these_flats['file'])
+                add_master_hash(flat_im, flat_key)
                 flat_im.save(path.join(currentDir,flat_fn))
 
 if __name__ == "__main__":
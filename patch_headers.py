@@ -1,6 +1,11 @@
 from os import path
-from math import cos, pi
+import os
+import traceback
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
 from datetime import datetime
+from time import time as now
 import numpy as np
 
 import asciitable
@@ -9,8 +14,10 @@ from astropysics import obstools, coords
 
 from feder import *
 from astrometry import add_astrometry
+from fitskeyword import FITSKeyword
 
-from image_collection import ImageFileCollection
+from image_collection import (ImageFileCollection, save_hdulist, thread_map,
+                              fits_files_in_directory)
 
 federstuff = Feder()
 feder = federstuff.site
@@ -78,65 +85,156 @@ def deg2dms(dd):
     deg,mnt = divmod(mnt,60)
     return int(deg),int(mnt),sec
 
-def add_time_info(header, history=False):
+def batch_time_info(dateobs):
+    """
+    Compute JD, MJD and LST for a sequence of MaximDL DATE-OBS values.
+
+    All of the dates are converted in one pass; the results are the
+    values `add_time_info` would compute for each date, JD and MJD
+    rounded to 6 decimal places and LST as a sexagesimal string.
+
+    Returns a list of `(JD, MJD, LST)` tuples in the order of `dateobs`.
+    """
+    if not len(dateobs):
+        return []
+    dates = np.array([parse_dateobs(date) for date in dateobs],
+                     dtype='int64')
+    columns = list(dates.T)
+    jd = obstools.calendar_to_jd(columns)
+    mjd = obstools.calendar_to_jd(columns, mjd=True)
+    # python's round, not np.round, so the values are identical to
+    # those computed one file at a time
+    jd = [round(value, 6) for value in jd]
+    mjd = [round(value, 6) for value in mjd]
+    lst = feder.local_sidereal_times(jd)
+    return [(jd_value, mjd_value, sexagesimal_string(deg2dms(lst_value)))
+            for jd_value, mjd_value, lst_value in zip(jd, mjd, lst)]
+
+def site_info():
+    """
+    Observatory latitude, longitude and altitude as a list of
+    `KeywordValue`.
+    """
+    return [latitude.withValue(sexagesimal_string(feder.latitude.dms)),
+            longitude.withValue(sexagesimal_string(feder.longitude.dms)),
+            obs_altitude.withValue(feder.altitude)]
+
+def time_info_values(header, time_info=None):
+    """
+    Values of the keywords added to every file, the observatory
+    location and JD, MJD and LST, for `header` as a list of
+    `KeywordValue`.
+
+    time_info : tuple
+        `(JD, MJD, LST)` for this header, as computed by
+        `batch_time_info`; if omitted they are computed from the
+        header's DATE-OBS.
+    """
+    if time_info is None:
+        time_info = batch_time_info([header['date-obs']])[0]
+    jd, mjd, lst = time_info
+    return site_info() + [LST.withValue(lst), JD.withValue(jd),
+                          MJD.withValue(mjd)]
+
+def add_time_info(header, history=False, time_info=None):
     """
     Add JD, MJD, LST to FITS header; `header` should be a pyfits
     header object.
 
     history : bool
         If `True`, write history for each keyword changed.
-    
-    Uses `feder.currentobsjd` as the date.
+
+    time_info : tuple
+        `(JD, MJD, LST)` for this header, as computed by
+        `batch_time_info`; if omitted they are computed from the
+        header's DATE-OBS.
+
+    The observatory location is added too. Nothing outside of `header`
+    is modified, so files can be patched concurrently.
     """
-    dateobs = parse_dateobs(header['date-obs'])
-    JD.value = round(obstools.calendar_to_jd(dateobs), 6)
-    MJD.value = round(obstools.calendar_to_jd(dateobs, mjd=True), 6)
-    
-    # setting currentobsjd makes calls following it use that time
-    # for calculations
-    
-    feder.currentobsjd = JD.value
-    LST.value = feder.localSiderialTime()
-    LST.value = sexagesimal_string(deg2dms(LST.value))
-    
-    for keyword in keywords_for_all_files:
-        keyword.addToHeader(header, history=history)
+    for value in time_info_values(header, time_info=time_info):
+        value.addToHeader(header, history=history)
 
-def add_object_pos_airmass(header, history=False):
-    """Add object information, such as RA/Dec and airmass.
+def batch_pointing_info(ra, dec, jd):
+    """
+    Compute altitude, azimuth, airmass and hour angle for sequences of
+    RA and Dec, as sexagesimal strings from FITS headers, and JD.
 
-    history : bool
-        If `True`, write history for each keyword changed.
-    
-    Has side effect of setting feder site JD to JD-OBS, which means it
-    also assume JD.value has been set.
+    Each distinct pointing is parsed once and the positions for all of
+    the files are computed in one pass; the results are the values
+    `add_object_pos_airmass` would compute for each file, with the same
+    rounding.
+
+    Returns a list of `(altitude, azimuth, airmass, hour angle)` tuples
+    in the order of the inputs.
     """
-    if JD.value is not None:
-        feder.currentobsjd == JD.value
-    else:
-        raise ValueError('Need to set JD.value before calling.')
+    if not len(jd):
+        return []
+    pointings = {}
+    for pointing in set(zip(ra, dec)):
+        pointing_ra, pointing_dec = [value.replace(' ', ':')
+                                     for value in pointing]
+        object_coords = coords.EquatorialCoordinatesEquinox((pointing_ra,
+                                                             pointing_dec))
+        pointings[pointing] = (object_coords.ra.hours,
+                               object_coords.dec.degrees)
+    ra_hours, dec_degrees = np.array([pointings[pointing]
+                                      for pointing in zip(ra, dec)]).T
+    alt, az, airmass_values, ha = feder.alt_az_airmass(ra_hours,
+                                                       dec_degrees, jd)
+    return [(round(alt_value, 5), round(az_value, 5),
+             round(airmass_value, 3), sexagesimal_string(deg2dms(ha_value)))
+            for alt_value, az_value, airmass_value, ha_value
+            in zip(alt, az, airmass_values, ha)]
+
+def pointing_info_values(header, pointing_info=None):
+    """
+    Values of the object keywords, such as RA/Dec and airmass, for
+    `header` as a list of `KeywordValue`.
 
+    pointing_info : tuple
+        `(altitude, azimuth, airmass, hour angle)` for this header, as
+        computed by `batch_pointing_info`; if omitted they are computed
+        from the header's RA/Dec and JD-OBS.
+
+    Raises `ValueError` if the header has no RA, or if the position
+    must be computed and the header has no JD-OBS.
+    """
     try:
-        RA.setValueFromHeader(header)
+        ra = RA.valueFromHeader(header)
     except ValueError:
         raise ValueError("No RA is present.")
-        return
 
-    Dec.setValueFromHeader(header)
-    RA.value = RA.value.replace(' ',':')
-    Dec.value = Dec.value.replace(' ',':')
-    object_coords = coords.EquatorialCoordinatesEquinox((RA.value, Dec.value))
-    alt_az = feder.apparentCoordinates(object_coords, refraction=False)
-    altitude.value = round(alt_az.alt.d, 5)
-    azimuth.value = round(alt_az.az.d, 5)
-    airmass.value = round(1/cos(pi/2 - alt_az.alt.r),3)
-    hour_angle.value = sexagesimal_string(
-        coords.EquatorialCoordinatesEquinox((feder.localSiderialTime()-
-                                            object_coords.ra.hours,
-                                             0)).ra.hms)
-    for keyword in keywords_for_light_files:
-        if keyword.value is not None:
-            keyword.addToHeader(header, history=history)
+    dec = Dec.valueFromHeader(header)
+    ra = ra.replace(' ',':')
+    dec = dec.replace(' ',':')
+    if pointing_info is None:
+        try:
+            jd = header['jd-obs']
+        except KeyError:
+            raise ValueError('Need to add time information before calling.')
+        pointing_info = batch_pointing_info([ra], [dec], [jd])[0]
+    alt, az, airmass_value, ha = pointing_info
+    return [RA.withValue(ra), Dec.withValue(dec),
+            hour_angle.withValue(ha), airmass.withValue(airmass_value),
+            altitude.withValue(alt), azimuth.withValue(az)]
+
+def add_object_pos_airmass(header, history=False, pointing_info=None):
+    """Add object information, such as RA/Dec and airmass.
+
+    history : bool
+        If `True`, write history for each keyword changed.
+
+    pointing_info : tuple
+        `(altitude, azimuth, airmass, hour angle)` for this header, as
+        computed by `batch_pointing_info`; if omitted they are computed
+        from the header's RA/Dec.
+    
+    The time is taken from JD-OBS, so `add_time_info` must be called
+    first.
+    """
+    for value in pointing_info_values(header, pointing_info=pointing_info):
+        value.addToHeader(header, history=history)
             
 
 def keyword_names_as_string(list_of_keywords):
@@ -200,8 +298,105 @@ def history(function, mode='begin', time=None):
                                           function.__name__, time,
                                           marker)
     
+def _summary_values(summary, keyword):
+    """
+    Value of the `FITSKeyword` `keyword`, under its name or any of its
+    synonyms, for each file in the table `summary`, as strings.
+
+    The value is '' for files in which the keyword is missing or in
+    which its names have different values.
+    """
+    values = None
+    for name in keyword.names:
+        column = np.asarray(summary[name.lower()].filled(''), dtype=str)
+        if values is None:
+            values = column
+            continue
+        conflict = (values != '') & (column != '') & (values != column)
+        values = np.where(values == '', column, values)
+        values[conflict] = ''
+    return values
+
+def _patch_files(directory, file_names, patch, new_file_ext, overwrite,
+                 workers=1, timings=None):
+    """
+    Call `patch(file_name, header)` for the primary header of each of
+    the files `file_names` in `directory`, then save the file as the
+    loops over `ImageFileCollection` headers do.
+
+    The files are patched by `workers` threads, so `patch` must change
+    nothing but the header it is given.
+
+    If `timings` is a dictionary, the seconds spent opening and saving
+    the files are added to its 'read' and 'write' entries, and `patch`
+    may return a dictionary of the seconds it spent in other stages,
+    which are added too.
+
+    Returns an ordered dictionary of the number of bytes written to
+    each saved file, by full path, as `ImageFileCollection.bytes_written`.
+    """
+    lock = threading.Lock()
+
+    def patch_file(file_name):
+        full_path = path.join(directory, file_name)
+        start = now()
+        hdulist = pyfits.open(full_path, do_not_scale_image_data=True)
+        try:
+            stage_times = dict(read=now() - start)
+            stage_times.update(patch(file_name, hdulist[0].header) or {})
+            start = now()
+            new_path, written = save_hdulist(hdulist, full_path,
+                                             save_with_name=new_file_ext,
+                                             clobber=overwrite, in_place=True)
+            stage_times['write'] = now() - start
+        finally:
+            hdulist.close()
+        if timings is not None:
+            with lock:
+                for stage, seconds in stage_times.items():
+                    timings[stage] = timings.get(stage, 0) + seconds
+        return new_path, written
+
+    return OrderedDict((new_path, written) for new_path, written in
+                       thread_map(patch_file, list(file_names), workers)
+                       if written is not None)
+
+def patch_header(file_name, header, time_info=None, pointing_info=None,
+                 detailed_history=True):
+    """
+    Add minimal information to the header of one Feder FITS file.
+
+    `file_name` is used only in messages. `time_info` and
+    `pointing_info` are as for `add_time_info` and
+    `add_object_pos_airmass`; `detailed_history` is as for
+    `patch_headers`.
+    """
+    run_time = datetime.now()
+    header.add_history(history(patch_headers, mode='begin',
+                               time=run_time))
+    header.add_history('patch_headers.py modified this file on %s'
+                       % run_time)
+    add_time_info(header, history=detailed_history, time_info=time_info)
+    if not detailed_history:
+        header.add_history('patch_headers.py updated keywords %s' %
+                           keyword_names_as_string(keywords_for_all_files))
+    if header['imagetyp'] == 'LIGHT':
+        try:
+            add_object_pos_airmass(header,
+                                   history=detailed_history,
+                                   pointing_info=pointing_info)
+            if not detailed_history:
+                header.add_history('patch_headers.py updated keywords %s' %
+                                   keyword_names_as_string(keywords_for_light_files))
+        except ValueError:
+            print 'Skipping file %s' % file_name
+            return
+    header.add_history(history(patch_headers, mode='end',
+                               time=run_time))
+
 def patch_headers(dir='.', new_file_ext='new',
-                  overwrite=False, detailed_history=True):
+                  overwrite=False, detailed_history=True, workers=1,
+                  files=None):
     """
     Add minimal information to Feder FITS headers.
 
@@ -211,46 +406,63 @@ def patch_headers(dir='.', new_file_ext='new',
     header information. It is added to the base name of the input
     file, between the old file name and the `.fit` or `.fits` extension.
 
-    `overwrite` should be set to `True` to replace the original files.
+    `overwrite` should be set to `True` to replace the original files;
+    only their header blocks are rewritten if the new header fits.
 
     detailed_history : bool
         If `True`, write name and value of each keyword changed to
         output FITS files. If `False`, write only a list of which
         keywords changed.
+
+    workers : int
+        Number of threads patching files at the same time.
+
+    files : list
+        Names of the files in `dir` to patch; all of them by default.
+        No other file is opened.
+
+    Returns an ordered dictionary of the number of bytes written to
+    each file, as `ImageFileCollection.bytes_written`.
     """
-    images = ImageFileCollection(location=dir, keywords=['imagetyp'])
+    times = TimeInfo()
+    pointing = PointingInfo()
+    images = ImageFileCollection(location=dir,
+                                 keywords=_union(times.keywords,
+                                                 pointing.keywords),
+                                 files=files)
+    summary = images.summary_info
+    times.prepare(dir, summary)
+    pointing.prepare(dir, summary)
 
-    latitude.value = sexagesimal_string(feder.latitude.dms)
-    longitude.value = sexagesimal_string(feder.longitude.dms)
-    obs_altitude.value = feder.altitude
+    def patch(file_name, header):
+        patch_header(file_name, header, time_info=times.info.get(file_name),
+                     pointing_info=pointing.info.get(file_name),
+                     detailed_history=detailed_history)
+
+    return _patch_files(dir, summary['file'].compressed(), patch,
+                        new_file_ext, overwrite, workers=workers)
+
+def add_overscan_info(header, instrument, history=False):
+    """
+    Add overscan information for `instrument` to FITS header.
+
+    history : bool
+        If `True`, write history for each keyword changed.
+
+    Returns the list of `KeywordValue` added.
+    """
+    image_dim = [header['naxis1'], header['naxis2']]
+    has_overscan = instrument.has_overscan(image_dim)
+    values = [overscan_present.withValue(has_overscan)]
+    if has_overscan:
+        values.extend([overscan_axis.withValue(instrument.overscan_axis),
+                       overscan_start.withValue(instrument.overscan_start)])
+    for value in values:
+        value.addToHeader(header, history=history)
+    return values
 
-    for header in images.headers(save_with_name=new_file_ext,
-                                 clobber=overwrite,
-                                 do_not_scale_image_data=True):
-        run_time = datetime.now()
-        header.add_history(history(patch_headers, mode='begin',
-                                   time=run_time))
-        header.add_history('patch_headers.py modified this file on %s'
-                           % run_time)
-        add_time_info(header, history=detailed_history)
-        if not detailed_history:
-            header.add_history('patch_headers.py updated keywords %s' %
-                               keyword_names_as_string(keywords_for_all_files))
-        if header['imagetyp'] == 'LIGHT':
-            try:
-                add_object_pos_airmass(header,
-                                 history=detailed_history)
-                if not detailed_history:
-                    header.add_history('patch_headers.py updated keywords %s' %
-                                       keyword_names_as_string(keywords_for_light_files))
-            except ValueError:
-                print 'Skipping file %s' % image
-                continue
-        header.add_history(history(patch_headers, mode='end',
-                                   time=run_time))
-        
 def add_overscan(dir='.', new_file_ext='new',
-                  overwrite=False, detailed_history=True):
+                  overwrite=False, detailed_history=True, workers=1):
     """
     Add overscan information to Feder FITS headers.
 
@@ -260,44 +472,74 @@ def add_overscan(dir='.', new_file_ext='new',
     header information. It is added to the base name of the input
     file, between the old file name and the `.fit` or `.fits` extension.
 
-    `overwrite` should be set to `True` to replace the original files.
+    `overwrite` should be set to `True` to replace the original files;
+    only their header blocks are rewritten if the new header fits.
 
     detailed_history : bool
         If `True`, write name and value of each keyword changed to
         output FITS files. If `False`, write only a list of which
         keywords changed.
+
+    workers : int
+        Number of threads patching files at the same time.
+
+    Returns an ordered dictionary of the number of bytes written to
+    each file, as `ImageFileCollection.bytes_written`.
     """
     feder_info = Feder()
     images = ImageFileCollection(location=dir, keywords=['imagetyp', 'instrume'])
-    for header in images.headers(save_with_name=new_file_ext,
-                                 clobber=overwrite,
-                                 do_not_scale_image_data=True):
-        image_dim = [header['naxis1'], header['naxis2']]
+
+    def patch(file_name, header):
         instrument = feder_info.instrument[header['instrume']]
         run_time = datetime.now()
         header.add_history(history(add_overscan, mode='begin',
                                    time=run_time))
-        overscan_present.value = instrument.has_overscan(image_dim)
-        overscan_present.addToHeader(header, history=detailed_history)
-        modified_keywords = [overscan_present]
-        if overscan_present.value:
-            overscan_axis.value = instrument.overscan_axis
-            overscan_start.value = instrument.overscan_start
-            overscan_axis.addToHeader(header,
-                                      history=detailed_history)
-            overscan_start.addToHeader(header,
-                                       history=detailed_history)
-            modified_keywords.extend([overscan_axis, overscan_start])
+        modified = add_overscan_info(header, instrument,
+                                     history=detailed_history)
         if not detailed_history:
             header.add_history('add_overscan updated keywords %s' %
-                               keyword_names_as_string(modified_keywords))
+                               keyword_names_as_string([value.keyword for
+                                                        value in modified]))
         header.add_history(history(add_overscan, mode='end',
                                    time=run_time))
 
+    return _patch_files(dir, images.summary_info['file'].compressed(),
+                        patch, new_file_ext, overwrite, workers=workers)
+
             
+# OBJECT as add_object_info has always written it, without a comment
+_object_keyword = FITSKeyword(name='object')
+
+def add_object_name(header, object_names, object_ra_dec,
+                    match_radius=20.0, history=True):
+    """
+    Add the name of the object at the RA/Dec of the header.
+
+    `object_names` is an array of object names and `object_ra_dec` the
+    corresponding positions; `match_radius` is as for
+    `add_object_info`.
+
+    Returns the `KeywordValue` added.
+    """
+    image_ra_dec = coords.coordsys.FK5Coordinates(header['ra'],
+                                                  header['dec'])
+    distance = [(ra_dec - image_ra_dec).arcmin for ra_dec in object_ra_dec]
+    distance = np.array(distance)
+    matches = (distance < match_radius)
+    if matches.sum() > 1:
+        raise RuntimeError("More than one object match for image")
+
+    if not matches.any():
+        raise RuntimeWarning("No object foundn for image")
+    object_name = (object_names[matches])[0]
+    value = _object_keyword.withValue(object_name)
+    value.addToHeader(header, history=history)
+    return value
+
 def add_object_info(directory='.', object_list=None,
                     match_radius=20.0, new_file_ext='new',
-                    overwrite=False, detailed_history=True):
+                    overwrite=False, detailed_history=True, workers=1,
+                    files=None):
     """
     Automagically add object information to FITS files.
 
@@ -308,14 +550,22 @@ def add_object_info(directory='.', object_list=None,
     `match_radius` is the maximum distance, in arcmin, between the
     RA/Dec of the image and a particular object for the image to be
     considered an image of that object.
+
+    `workers` is the number of threads patching files at the same time.
+
+    `files` is a list of the names of the files in `directory` that may
+    be patched; all of them by default. No other file is opened.
+
+    Returns an ordered dictionary of the number of bytes written to
+    each file, as `ImageFileCollection.bytes_written`.
     """
     from astro_object import AstroObject
     import numpy as np
-    from fitskeyword import FITSKeyword
     
     images = ImageFileCollection(directory,
                                      keywords=['imagetyp', 'RA',
-                                               'Dec', 'object'])
+                                               'Dec', 'object'],
+                                     files=files)
     summary = images.summary_info
 
     print summary['file']
@@ -323,7 +573,7 @@ def add_object_info(directory='.', object_list=None,
         observer, object_names = read_object_list(directory)
     except IOError:
         print 'No object list in directory %s, skipping.' % directory
-        return
+        return OrderedDict()
         
 #    ra_dec_obj = {'er ori':(93.190,12.382), 'm101':(210.826,54.335), 'ey uma':(135.575,49.810)}
 
@@ -333,24 +583,348 @@ def add_object_info(directory='.', object_list=None,
         obj = AstroObject(object_name)
         ra_dec.append(obj.ra_dec)
     object_ra_dec = np.array(ra_dec)
-    
-    for header in images.headers(save_with_name=new_file_ext,
-                                 clobber=overwrite,
-                                 object='', RA='*', Dec='*'):
-        image_ra_dec = coords.coordsys.FK5Coordinates(header['ra'],
-                                                      header['dec'])
-        distance = [(ra_dec - image_ra_dec).arcmin for ra_dec in object_ra_dec]
-        distance = np.array(distance)
-        matches = (distance < match_radius)
-        if matches.sum() > 1:
-            raise RuntimeError("More than one object match for image")
-
-        if not matches.any():
-            raise RuntimeWarning("No object foundn for image")
-            continue
-        object_name = (object_names[matches])[0]   
-        obj_keyword = FITSKeyword('object',value=object_name)
-        obj_keyword.addToHeader(header, history=True)
+
+    def patch(file_name, header):
+        add_object_name(header, object_names, object_ra_dec,
+                        match_radius=match_radius)
+
+    return _patch_files(directory,
+                        images.files_filtered(object='', RA='*', Dec='*'),
+                        patch, new_file_ext, overwrite, workers=workers)
+
+def _union(*keyword_lists):
+    """
+    Keywords in any of `keyword_lists`, each once, in order.
+    """
+    union = []
+    for keywords in keyword_lists:
+        for keyword in keywords:
+            if keyword not in union:
+                union.append(keyword)
+    return union
+
+class HeaderTransform(object):
+    """
+    One step of `fused_patch`.
+
+    `prepare` is called once for each directory, with the summary of
+    the collection of its files, which includes the `keywords` of the
+    transform; `apply` is then called for the header of each file, by
+    several threads at once, so it must change nothing but the header.
+
+    `name` labels the transform in the timings `fused_patch` reports.
+    """
+    name = ''
+    keywords = []
+
+    def prepare(self, directory, summary):
+        pass
+
+    def apply(self, file_name, header, history=False):
+        """
+        Patch `header` of the file `file_name`; `history` is as for
+        `FITSKeyword.addToHeader`.
+
+        Returns the list of `KeywordValue` added; none by default.
+        """
+        return []
+
+class TimeInfo(HeaderTransform):
+    """
+    Add observatory location, JD, MJD and LST, as `add_time_info` does.
+
+    The times of all the files of a directory are computed at once; a
+    file without DATE-OBS falls back to `add_time_info`, which reports
+    it.
+    """
+    name = 'time'
+    keywords = ['imagetyp', 'date-obs']
+
+    def prepare(self, directory, summary):
+        file_names = summary['file'].compressed()
+        dates = np.asarray(summary['date-obs'].filled(''), dtype=str)
+        dated = dates != ''
+        self.info = dict(zip(file_names[dated], batch_time_info(dates[dated])))
+
+    def apply(self, file_name, header, history=False):
+        values = time_info_values(header,
+                                  time_info=self.info.get(file_name))
+        for value in values:
+            value.addToHeader(header, history=history)
+        return values
+
+class PointingInfo(HeaderTransform):
+    """
+    Add pointing, hour angle, airmass, altitude and azimuth to light
+    frames, as `add_object_pos_airmass` does.
+
+    The positions of all the light frames of a directory with a pointing
+    and DATE-OBS are computed at once. A light frame without them is
+    skipped.
+    """
+    name = 'pointing'
+    keywords = ['imagetyp', 'date-obs'] + list(keyword.lower() for keyword
+                                               in RA.names + Dec.names)
+
+    def prepare(self, directory, summary):
+        file_names = summary['file'].compressed()
+        dates = np.asarray(summary['date-obs'].filled(''), dtype=str)
+        ra = _summary_values(summary, RA)
+        dec = _summary_values(summary, Dec)
+        light = (np.asarray(summary['imagetyp'].filled(''), dtype=str) ==
+                 'LIGHT')
+        pointed = light & (dates != '') & (ra != '') & (dec != '')
+        jd = [jd for jd, mjd, lst in batch_time_info(dates[pointed])]
+        self.info = dict(zip(file_names[pointed],
+                             batch_pointing_info(ra[pointed], dec[pointed],
+                                                 jd)))
+
+    def apply(self, file_name, header, history=False):
+        if header['imagetyp'] != 'LIGHT':
+            return []
+        try:
+            values = pointing_info_values(header,
+                                          pointing_info=self.info.get(file_name))
+        except ValueError:
+            print 'Skipping pointing of file %s' % file_name
+            return []
+        for value in values:
+            value.addToHeader(header, history=history)
+        return values
+
+class OverscanInfo(HeaderTransform):
+    """
+    Add overscan information, as `add_overscan` does; like it, raises
+    `KeyError` for a file taken with an unknown instrument.
+    """
+    name = 'overscan'
+
+    def __init__(self):
+        self._feder = Feder()
+
+    def apply(self, file_name, header, history=False):
+        instrument = self._feder.instrument[header['instrume']]
+        return add_overscan_info(header, instrument, history=history)
+
+class ObjectName(HeaderTransform):
+    """
+    Add the name of the object, from the object list of the directory,
+    to files with a pointing but no object, as `add_object_info` does.
+
+    Nothing is done in a directory without an object list, or to a file
+    that matches no object, or more than one.
+    """
+    name = 'object'
+
+    def __init__(self, object_list='obsinfo.txt', match_radius=20.0):
+        self.object_list = object_list
+        self.match_radius = match_radius
+
+    def prepare(self, directory, summary):
+        from astro_object import AstroObject
+
+        self._object_names = None
+        try:
+            observer, object_names = read_object_list(directory,
+                                                      self.object_list)
+        except IOError:
+            print 'No object list in directory %s, skipping.' % directory
+            return
+        self._object_names = np.array(object_names)
+        self._object_ra_dec = np.array([AstroObject(name).ra_dec for
+                                        name in object_names])
+
+    def apply(self, file_name, header, history=False):
+        if (self._object_names is None or header.get('object', '') != '' or
+            'ra' not in header or 'dec' not in header):
+            return []
+        try:
+            return [add_object_name(header, self._object_names,
+                                    self._object_ra_dec,
+                                    match_radius=self.match_radius,
+                                    history=history)]
+        except (RuntimeError, RuntimeWarning) as e:
+            # only the object name is skipped; the file is still saved
+            # with the keywords of the other transforms
+            print 'Skipping object of file %s: %s' % (file_name, e)
+            return []
+
+def standard_transforms(overscan=True, object_info=True):
+    """
+    The transforms of `fused_patch`, in order: time and pointing as in
+    `patch_headers`, then, if set, `overscan` and `object_info`.
+    """
+    transforms = [TimeInfo(), PointingInfo()]
+    if overscan:
+        transforms.append(OverscanInfo())
+    if object_info:
+        transforms.append(ObjectName())
+    return transforms
+
+def fused_patch(dir='.', transforms=None, new_file_ext='new',
+                overwrite=False, detailed_history=True, workers=1,
+                files=None, bytes_written=None):
+    """
+    Patch Feder FITS headers with several transforms in one pass.
+
+    Each file is opened once, patched by each of `transforms` (instances
+    of `HeaderTransform`; `standard_transforms()` by default) in turn
+    and saved once, instead of once for each of `patch_headers`,
+    `add_overscan` and `add_object_info`. The keywords added are the
+    same; a single pair of history markers surrounds them.
+
+    `dir`, `new_file_ext`, `overwrite`, `detailed_history`, `workers`
+    and `files` are as for `patch_headers`.
+
+    If `bytes_written` is a dictionary, the number of bytes written to
+    each file, by full path, is stored in it.
+
+    Returns an ordered dictionary of the seconds spent in each stage:
+    reading the 'summary' of the directory, 'read'-ing the files, each
+    transform, by name, and 'write'-ing the files. The times of the
+    files are summed over the threads patching them.
+    """
+    if transforms is None:
+        transforms = standard_transforms()
+    timings = OrderedDict([('summary', 0.0), ('read', 0.0)] +
+                          [(transform.name, 0.0) for
+                           transform in transforms] +
+                          [('write', 0.0)])
+    start = now()
+    images = ImageFileCollection(location=dir,
+                                 keywords=_union(*[transform.keywords for
+                                                   transform in transforms]),
+                                 files=files)
+    summary = images.summary_info
+    timings['summary'] = now() - start
+    for transform in transforms:
+        start = now()
+        transform.prepare(dir, summary)
+        timings[transform.name] += now() - start
+
+    def patch(file_name, header):
+        stage_times = {}
+        run_time = datetime.now()
+        header.add_history(history(fused_patch, mode='begin',
+                                   time=run_time))
+        header.add_history('patch_headers.py modified this file on %s'
+                           % run_time)
+        for transform in transforms:
+            start = now()
+            modified = transform.apply(file_name, header,
+                                       history=detailed_history)
+            if modified and not detailed_history:
+                header.add_history('patch_headers.py updated keywords %s' %
+                                   keyword_names_as_string([value.keyword for
+                                                            value in modified]))
+            stage_times[transform.name] = now() - start
+        header.add_history(history(fused_patch, mode='end', time=run_time))
+        return stage_times
+
+    written = _patch_files(dir, summary['file'].compressed(), patch,
+                           new_file_ext, overwrite, workers=workers,
+                           timings=timings)
+    if bytes_written is not None:
+        bytes_written.update(written)
+    return timings
+
+def _patch_task(task):
+    """
+    Patch the headers of one directory, or of a shard of its files, as
+    `patch_directories` does; run in a worker process.
+
+    Returns a report of the seconds spent in each stage, of the bytes
+    written and of the error, if any, that stopped the patching.
+    """
+    directory, files, options = task
+    report = dict(directory=directory, stages=OrderedDict(),
+                  bytes_written=0, error=None)
+    try:
+        transforms = standard_transforms(overscan=options['overscan'],
+                                         object_info=options['object_info'])
+        bytes_written = {}
+        report['stages'] = fused_patch(directory, transforms=transforms,
+                                       new_file_ext=options['new_file_ext'],
+                                       overwrite=options['overwrite'],
+                                       files=files,
+                                       bytes_written=bytes_written)
+        report['bytes_written'] = sum(bytes_written.values())
+    except Exception:
+        report['error'] = traceback.format_exc()
+    return report
+
+def patch_directories(directories, workers=1, shard_size=None,
+                      overscan=False, object_info=True, new_file_ext='',
+                      overwrite=True):
+    """
+    Patch the headers of the files in each of `directories` in a single
+    pass with `fused_patch`, adding time and pointing information and,
+    if `object_info` is `True`, object names, as `run_patch.py` does.
+    If `overscan` is `True`, overscan information is added too.
+
+    The directories are patched by a pool of `workers` processes, each
+    with its own site and keywords. If `shard_size` is set, the files
+    of a directory are split into shards of at most that many files,
+    which are patched separately, so a few large directories can also
+    be spread over the workers.
+
+    A failure in one directory, or shard, does not stop the others.
+    Returns a list with a report for each directory: the number of
+    files, the seconds spent in each stage of `fused_patch` and in
+    total, the bytes written and the tracebacks of any errors. A directory in which
+    patching stopped has only the stages of the shards that finished.
+    """
+    start = now()
+    options = dict(overscan=overscan, object_info=object_info,
+                   new_file_ext=new_file_ext, overwrite=overwrite)
+    reports = OrderedDict()
+    tasks = []
+    for directory in directories:
+        file_names = sorted(fits_files_in_directory(directory))
+        reports[directory] = dict(directory=directory,
+                                  files=len(file_names), seconds=0.0,
+                                  stages=OrderedDict(), bytes_written=0,
+                                  errors=[])
+        if shard_size is None or len(file_names) <= shard_size:
+            tasks.append((directory, None, options))
+        else:
+            for first in range(0, len(file_names), shard_size):
+                tasks.append((directory,
+                              file_names[first:first + shard_size], options))
+
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)))
+        try:
+            done = pool.map(_patch_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        done = [_patch_task(task) for task in tasks]
+
+    for task_report in done:
+        report = reports[task_report['directory']]
+        for stage, seconds in task_report['stages'].items():
+            report['stages'][stage] = report['stages'].get(stage, 0) + seconds
+            report['seconds'] += seconds
+        report['bytes_written'] += task_report['bytes_written']
+        if task_report['error'] is not None:
+            report['errors'].append(task_report['error'])
+
+    failed = 0
+    for report in reports.values():
+        stage_times = ', '.join('%s %.2f sec' % (stage, seconds)
+                                for stage, seconds in report['stages'].items())
+        print ('Patched %d files in %s in %.2f sec, wrote %d bytes (%s)' %
+               (report['files'], report['directory'], report['seconds'],
+                report['bytes_written'], stage_times))
+        if report['errors']:
+            failed += 1
+            for error in report['errors']:
+                print 'FAILED %s:\n%s' % (report['directory'], error)
+    print ('Patched %d of %d directories in %.2f sec' %
+           (len(reports) - failed, len(reports), now() - start))
+    return reports.values()
 
 def add_ra_dec_from_object_name(directory='.', new_file_ext=None):
     """
@@ -373,16 +947,16 @@ def add_ra_dec_from_object_name(directory='.', new_file_ext=None):
     objects = unique(missing_dec['object'])
     for object_name in objects:
         obj = AstroObject(object_name)
-        RA.value = obj.ra_dec.ra.getHmsStr(canonical=True)
-        Dec.value = obj.ra_dec.dec.getDmsStr(canonical=True)
+        ra = RA.withValue(obj.ra_dec.ra.getHmsStr(canonical=True))
+        dec = Dec.withValue(obj.ra_dec.dec.getDmsStr(canonical=True))
         these_files = missing_dec.where(missing_dec['object'] == object_name)
         for image in these_files:
             full_name = path.join(directory,image['file'])
             hdulist = pyfits.open(full_name)
             header = hdulist[0].header
             int16 = (header['bitpix'] == 16)
-            RA.addToHeader(header, history=True)
-            Dec.addToHeader(header, history=True)
+            ra.addToHeader(header, history=True)
+            dec.addToHeader(header, history=True)
             if new_file_ext is not None:
                 base, ext = path.splitext(full_name)
                 new_file_name = base+ new_file_ext + ext
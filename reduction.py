@@ -1,10 +1,492 @@
 from astropysics import ccd, pipeline
 import image_collection as tff
+from image_collection import MappedImage
 from os import path
+import os
+from multiprocessing import Pool
+from collections import OrderedDict
+import threading
+from time import time as now
 import numpy as np
+import pyfits
+
+flat_levels = {'mean': np.mean,
+               'median': np.median,
+               'max': np.max,
+               'min': np.min}
+
+default_cache_bytes = 512 * 2**20
+
+class MasterCache(object):
+    """
+    Least-recently-used cache of master calibration frames.
+
+    Entries are keyed by the absolute path, size and modification time
+    of the file, so a master that is rewritten is read again. When the
+    cached frames take more than `max_bytes` the least recently used are
+    dropped; a frame larger than `max_bytes` is not cached at all.
+
+    Cached frames are shared by everyone who asks for them, so their
+    data is made read-only.
+    """
+    def __init__(self, max_bytes=default_cache_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Bytes of image data in the cache."""
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Drop every cached frame."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _drop(self, key):
+        value, nbytes = self._entries.pop(key)
+        self._nbytes -= nbytes
+
+    def _get(self, kind, file_name, load, size):
+        file_name = path.abspath(file_name)
+        stat = os.stat(file_name)
+        key = (kind, file_name, stat.st_size, stat.st_mtime)
+        with self._lock:
+            if key in self._entries:
+                # move to the most recently used end
+                value, nbytes = self._entries.pop(key)
+                self._entries[key] = (value, nbytes)
+                return value
+        value = load(file_name)
+        nbytes = size(value)
+        with self._lock:
+            for old_key in self._entries.keys():
+                if old_key[:2] == key[:2]:
+                    self._drop(old_key)
+            if nbytes > self.max_bytes:
+                return value
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+        return value
+
+    def image(self, file_name):
+        """
+        The master `file_name` as an `astropysics.ccd.FitsImage`, with
+        read-only data.
+        """
+        def load(name):
+            image = ccd.FitsImage(name)
+            image.data.flags.writeable = False
+            return image
+        return self._get('image', file_name, load,
+                         lambda image: image.data.nbytes)
+
+    def array(self, file_name):
+        """
+        The data of master `file_name`, in FITS (row, column) order, as
+        a read-only array.
+        """
+        def load(name):
+            data = MappedImage(name)[:]
+            data.flags.writeable = False
+            return data
+        return self._get('array', file_name, load, lambda data: data.nbytes)
+
+master_cache = MasterCache()
+
+def closest_master(masters, value):
+    """
+    The key of the dictionary `masters` closest to `value`, e.g. the
+    exposure time of the dark closest to that of a light frame. Of two
+    keys equally close, the smaller is chosen.
+    """
+    if not masters:
+        raise ValueError('No masters to choose from')
+    return min(masters, key=lambda key: (abs(key - value), key))
+
+def scale_dark(dark, dark_time, time, bias=None):
+    """
+    Scale a master `dark` with exposure time `dark_time` to exposure
+    time `time`.
+
+    Master darks include the bias, so the master `bias` is needed: the
+    result is ``bias + (dark - bias) * time / dark_time``.
+    """
+    if bias is None:
+        raise ValueError('A master bias is needed to scale darks')
+    return bias + (dark - bias) * (float(time) / dark_time)
+
+def dark_for_exposure(master_darks, time, master_bias=None):
+    """
+    Data of the master dark for exposure `time`.
+
+    `master_darks` is a dictionary of master darks indexed by exposure
+    time, as returned by :func:`load_masters`. If none has exposure
+    `time`, the one closest in exposure time is scaled to `time` with
+    :func:`scale_dark`, using `master_bias`.
+    """
+    if time in master_darks:
+        return master_darks[time].data
+    dark_time = closest_master(master_darks, time)
+    if master_bias is None:
+        raise ValueError('No master dark with exposure %s, and no master '
+                         'bias to scale the closest one' % time)
+    return scale_dark(master_darks[dark_time].data, dark_time, time,
+                      bias=master_bias.data)
+
+def overscan_region(header):
+    """
+    The overscan region described by the ``oscan``, ``oscanax`` and
+    ``oscanst`` keywords written by :func:`patch_headers.add_overscan`.
+
+    `header` is a FITS header or a dictionary of keyword values with
+    upper case keys, e.g. from :func:`image_collection.read_header_values`.
+
+    Returns `None` if there is no overscan, or a tuple of the numpy axis
+    of a 2-D image along which the overscan lies (1, the last axis, for
+    ``oscanax`` 1, which is NAXIS1) and the zero-based index along that
+    axis at which the overscan starts; ``oscanst`` is the one-based FITS
+    pixel, e.g. 3073 for the 3072 active columns of the Apogee Alta U9.
+    """
+    try:
+        present = header['OSCAN']
+    except KeyError:
+        return None
+    if not present:
+        return None
+    return (2 - int(header['OSCANAX']), int(header['OSCANST']) - 1)
+
+def subtract_overscan(stack, axis, start, fit='median'):
+    """
+    Subtract the overscan level from a stack of frames, in place, and
+    return the stack trimmed of the overscan as a view.
+
+    `stack` is a float array of shape (n_frames, rows, columns) or a
+    single 2-D frame.
+
+    `axis` and `start` describe the overscan region as returned by
+    :func:`overscan_region`.
+
+    `fit` sets how the overscan level is found. For 'median' or 'mean'
+    the level of each line across the overscan (each row if the overscan
+    is a block of columns) is the median or mean of that line's overscan
+    pixels. An integer fits a polynomial of that order to those line
+    medians along the readout, for every frame at once, and subtracts
+    the fit instead.
+    """
+    if stack.ndim == 2:
+        return subtract_overscan(stack[np.newaxis], axis, start, fit)[0]
+    if axis == 0:
+        # work on a view with the overscan along the last axis
+        return subtract_overscan(stack.swapaxes(1, 2), 1, start,
+                                 fit).swapaxes(1, 2)
+    overscan = stack[:, :, start:]
+    if fit == 'mean':
+        level = np.mean(overscan, axis=2)
+    else:
+        level = np.median(overscan, axis=2)
+        if fit != 'median':
+            lines = np.arange(stack.shape[1], dtype=np.float64)
+            coefficients = np.polyfit(lines, level.T, int(fit))
+            level = np.dot(np.vander(lines, int(fit) + 1), coefficients).T
+    science = stack[:, :, :start]
+    np.subtract(science, level[:, :, np.newaxis].astype(stack.dtype),
+                out=science)
+    return science
+
+class BatchReducer(object):
+    """
+    Overscan subtraction, dark subtraction and flat fielding of many
+    frames at once.
+
+    Frames are read into a preallocated float32 stack and reduced with
+    in-place numpy operations, so nothing is allocated per frame; the
+    stack is reused by later batches of the same shape.
+
+    `dark` and `flat` are the master dark and flat as arrays in FITS
+    (row, column) order, or `None` to skip that step.
+
+    `flat_combine` is how the flat is normalized, as for
+    `astropysics.ccd.ImageFlattener.combine`: 'mean', 'median', 'max',
+    'min' or a callable. As there, a frame is reduced to ``(frame -
+    dark) * level / flat``, where ``level`` is `flat_combine` of the
+    flat.
+
+    `batch_size` is the number of frames reduced in each pass.
+
+    `overscan`, if not `None`, is the `fit` used by
+    :func:`subtract_overscan` for frames whose headers describe an
+    overscan region; those frames are overscan subtracted and trimmed
+    first. Masters that still include the overscan region are corrected
+    and trimmed the same way before they are applied.
+
+    `memory_limit`, if set, caps the stack at about that many bytes by
+    reducing fewer than `batch_size` frames at a time if needed, so the
+    memory used does not depend on the number of files reduced.
+    """
+    def __init__(self, dark=None, flat=None, flat_combine='median',
+                 batch_size=16, overscan=None, memory_limit=None):
+        self.batch_size = batch_size
+        self.overscan = overscan
+        self.memory_limit = memory_limit
+        self._stack = None
+        self.set_masters(dark, flat, flat_combine=flat_combine)
+
+    def set_masters(self, dark=None, flat=None, flat_combine='median'):
+        """
+        Set the master dark and flat used for the frames that follow.
+        """
+        if not callable(flat_combine) and flat_combine not in flat_levels:
+            raise ValueError('invalid combine value %s' % flat_combine)
+        self._masters = (dark, flat, flat_combine)
+        # dark and flat gain, as float32, for each overscan region
+        self._prepared = {}
+        self._prepare(None)
+
+    def _prepare(self, region):
+        """Float32 dark and flat gain for frames with overscan `region`."""
+        if region in self._prepared:
+            return self._prepared[region]
+        dark, flat, flat_combine = self._masters
+        if dark is not None:
+            dark = self._master_for(dark, region)
+        gain = None
+        if flat is not None:
+            flat = self._master_for(flat, region)
+            if callable(flat_combine):
+                level = flat_combine(flat)
+            else:
+                level = flat_levels[flat_combine](flat)
+            gain = np.empty(flat.shape, dtype=np.float32)
+            np.divide(level, flat, out=gain)
+        self._prepared[region] = (dark, gain)
+        return dark, gain
+
+    def _master_for(self, master, region):
+        """
+        Float32 copy of `master`, overscan subtracted and trimmed if it
+        includes the overscan `region`.
+        """
+        master = np.array(master, dtype=np.float32)
+        if region is not None and master.shape[region[0]] > region[1]:
+            master = subtract_overscan(master, region[0], region[1],
+                                       fit=self.overscan).copy()
+        return master
+
+    def _frames_per_batch(self, shape):
+        """Number of frames of `shape` reduced at once."""
+        if self.memory_limit is None:
+            return self.batch_size
+        frame_bytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        return max(1, min(self.batch_size,
+                          int(self.memory_limit // frame_bytes)))
+
+    def _stack_for(self, n_frames, shape):
+        """A float32 stack of `n_frames` frames of `shape`, reused if possible."""
+        if (self._stack is None or self._stack.shape[1:] != shape or
+            len(self._stack) < n_frames):
+            self._stack = np.empty((max(n_frames,
+                                        self._frames_per_batch(shape)),) +
+                                   shape, dtype=np.float32)
+        return self._stack[:n_frames]
+
+    def reduce_stack(self, stack, region=None):
+        """
+        Reduce, in place, the frames in `stack`, an array of shape
+        (n_frames, rows, columns), whose overscan region is `region`
+        (see :func:`overscan_region`).
+
+        Returns the reduced frames, which are a trimmed view of `stack`
+        if the overscan was subtracted.
+        """
+        if region is not None and self.overscan is not None:
+            stack = subtract_overscan(stack, region[0], region[1],
+                                      fit=self.overscan)
+        else:
+            region = None
+        dark, gain = self._prepare(region)
+        if dark is not None:
+            np.subtract(stack, dark, out=stack)
+        if gain is not None:
+            np.multiply(stack, gain, out=stack)
+        return stack
+
+    def _batches(self, file_names):
+        """
+        Split `file_names` into batches of at most `batch_size` images,
+        fewer if `memory_limit` requires, of the same shape and overscan
+        region.
+        """
+        batch = []
+        for file_name in file_names:
+            image = MappedImage(file_name)
+            region = None
+            if self.overscan is not None:
+                region = overscan_region(tff.read_header_values(file_name,
+                                             ['oscan', 'oscanax', 'oscanst']))
+            key = (image.shape, region)
+            if batch and (key != batch_key or
+                          len(batch) == self._frames_per_batch(image.shape)):
+                yield batch_key[1], batch
+                batch = []
+            batch_key = key
+            batch.append((file_name, image))
+        if batch:
+            yield batch_key[1], batch
+
+    def reduce_files(self, file_names):
+        """
+        Reduce the FITS files `file_names`, `batch_size` at a time.
+
+        Yields the file name and the reduced frame, in FITS (row, column)
+        order, for each file. The frame is part of a buffer that is
+        overwritten by the next batch, so copy it if it is needed later.
+        """
+        for region, batch in self._batches(file_names):
+            stack = self._stack_for(len(batch), batch[0][1].shape)
+            for (file_name, image), frame in zip(batch, stack):
+                image.read_into(frame)
+            stack = self.reduce_stack(stack, region=region)
+            for (file_name, image), frame in zip(batch, stack):
+                yield file_name, frame
+
+output_formats = ['float32', 'float64', 'scaled16']
+
+def scale_to_16_bits(data):
+    """
+    Scale `data` to 16 bit integers for writing with BZERO and BSCALE.
+
+    The finite values of `data` are spread over the 16 bit range, so
+    the values written are within ``bscale / 2`` of `data`; values that
+    are not finite are written as BLANK, -32768.
+
+    Returns the integers, as int16, and `bscale`, `bzero` and `blank`;
+    `blank` is `None` if all values are finite.
+    """
+    finite = np.isfinite(data)
+    all_finite = finite.all()
+    if all_finite:
+        values = data
+    else:
+        values = data[finite]
+    if values.size:
+        low, high = float(values.min()), float(values.max())
+    else:
+        low = high = 0.0
+    # -32768 is kept for BLANK
+    bscale = (high - low) / 65534.0 or 1.0
+    bzero = (high + low) / 2.0
+    scaled = np.subtract(data, bzero, dtype=np.float64)
+    np.divide(scaled, bscale, out=scaled)
+    np.around(scaled, out=scaled)
+    blank = None
+    if not all_finite:
+        blank = -32768
+        scaled[~finite] = blank
+    return scaled.astype(np.int16), bscale, bzero, blank
+
+def _save_reduced(data, source, destination, output_format=None):
+    """
+    Write `data` to `destination` with the header of the FITS file
+    `source`, dropping the scaling keywords that no longer apply.
+
+    If `data` is smaller than the source image its overscan has been
+    trimmed, and the overscan keywords are updated to say so.
+
+    `output_format` is one of `output_formats`, or `None` to write
+    `data` as it is. Returns the size of the file written, in bytes.
+    """
+    header = pyfits.getheader(source)
+    for keyword in ['bzero', 'bscale', 'blank']:
+        if keyword in header:
+            del header[keyword]
+    if (overscan_region(header) is not None and
+        data.shape != (header['naxis2'], header['naxis1'])):
+        header.update('oscan', False, 'True if image has overscan region')
+        for keyword in ['oscanax', 'oscanst']:
+            if keyword in header:
+                del header[keyword]
+        header.add_history('Overscan subtracted and trimmed')
+    if output_format is None:
+        hdu = pyfits.PrimaryHDU(data, header)
+    elif output_format == 'scaled16':
+        scaled, bscale, bzero, blank = scale_to_16_bits(data)
+        hdu = pyfits.PrimaryHDU(scaled, header)
+        hdu.header.update('bscale', bscale)
+        hdu.header.update('bzero', bzero)
+        if blank is not None:
+            hdu.header.update('blank', blank)
+    else:
+        hdu = pyfits.PrimaryHDU(np.asarray(data, dtype=output_format),
+                                header)
+    hdu.writeto(destination, clobber=True)
+    return path.getsize(destination)
+
+# State of each worker process of a parallel reduce; set by
+# _init_reduce_worker.
+_worker_reducer = None
+_worker_masters = {}
+_worker_group = None
+
+def _init_reduce_worker(dark_files, flat_files, flat_combine, batch_size,
+                        bias_file=None, overscan=None, memory_limit=None,
+                        output_format=None):
+    global _worker_reducer, _worker_masters, _worker_group
+    _worker_reducer = BatchReducer(batch_size=batch_size, overscan=overscan,
+                                   memory_limit=memory_limit)
+    _worker_masters = dict(dark_files=dark_files, flat_files=flat_files,
+                           flat_combine=flat_combine, bias_file=bias_file,
+                           output_format=output_format)
+    _worker_group = None
+
+def _worker_dark(time):
+    """Master dark for exposure `time` in a worker process."""
+    dark_files = _worker_masters['dark_files']
+    if time in dark_files:
+        return master_cache.array(dark_files[time])
+    dark_time = closest_master(dark_files, time)
+    bias = None
+    if _worker_masters['bias_file'] is not None:
+        bias = master_cache.array(_worker_masters['bias_file'])
+    return scale_dark(master_cache.array(dark_files[dark_time]), dark_time,
+                      time, bias=bias)
+
+def _reduce_batch(task):
+    """
+    Reduce and write one batch of frames in a worker process.
+
+    `task` is the exposure time, filter, and lists of source and
+    destination file names (`None` to not write the frame). Returns the
+    number of frames and of bytes written.
+    """
+    global _worker_group
+    time, filter_band, sources, destinations = task
+    if _worker_group != (time, filter_band):
+        dark = _worker_dark(time)
+        flat = master_cache.array(_worker_masters['flat_files'][filter_band])
+        _worker_reducer.set_masters(dark=dark, flat=flat,
+                                    flat_combine=_worker_masters['flat_combine'])
+        _worker_group = (time, filter_band)
+    reduced = _worker_reducer.reduce_files(sources)
+    written = 0
+    for (source, data), destination in zip(reduced, destinations):
+        if destination is not None:
+            written += _save_reduced(data, source, destination,
+                                     _worker_masters['output_format'])
+    return len(sources), written
 
 def reduce(files, source_dir, destination=None,
-           reduced_name='_reduced', overwrite=False):
+           reduced_name='_reduced', overwrite=False, batch_size=None,
+           workers=1, closest_dark=False, overscan=None,
+           output_format=None, memory_limit=None):
     """
     Reduce light files by applying darks and flats.
 
@@ -23,7 +505,45 @@ def reduce(files, source_dir, destination=None,
     for the original files to be overwritten. If you care about your
     data you won't do that, but if you want to hang yourself, use this
     rope. 
+
+    `batch_size`, if set, reduces the frames of each exposure time and
+    filter with a :class:`BatchReducer` that handles this many frames
+    at a time, in single precision, instead of feeding them one at a
+    time through an astropysics pipeline.
+
+    `workers`, if more than one, is the number of processes that reduce
+    and write frames, in batches of `batch_size` (16 if not set) frames
+    from the same exposure time and filter. Each process reads the
+    master frames it needs once. This implies the batched reduction.
+
+    `closest_dark`, if `True`, allows frames with no master dark of the
+    same exposure time to use the closest master dark, scaled with the
+    master bias (see :func:`dark_for_exposure`).
+
+    `overscan`, if set, subtracts the overscan level and trims the
+    overscan region of frames whose ``oscan`` keyword is true, before
+    the master dark and flat are applied. It is the `fit` of
+    :func:`subtract_overscan`, e.g. 'median' or a polynomial order, and
+    implies the batched reduction.
+
+    `output_format` is the data type of the reduced files: 'float32',
+    'float64' or 'scaled16', which is signed 16 bit integers scaled with
+    BZERO and BSCALE to the range of each frame (see
+    :func:`scale_to_16_bits`). By default frames from the pipeline are
+    written as float64 and those from the batched reduction as float32.
+
+    `memory_limit`, if set, is the approximate number of bytes of frames
+    held at once by each batched reducer, whatever the number of
+    `files`; it implies the batched reduction.
+
+    Returns a dictionary with the number of ``frames``, the ``bytes``
+    written, the elapsed ``seconds``, and those per frame as
+    ``bytes_per_frame`` and ``seconds_per_frame``;
+    :func:`format_reduce_report` describes it in one line.
     """
+    if output_format is not None and output_format not in output_formats:
+        raise ValueError('Unknown output format %s' % output_format)
+    start_time = now()
     if destination is not None:
         dest_dir = destination
     else:
@@ -43,11 +563,6 @@ def reduce(files, source_dir, destination=None,
                                                    'exptime','filter'])
     images = image_info.summary_info
 
-    master_darks = load_masters(images, source_dir=source_dir,
-                                type='dark', index_by='exptime')
-
-    master_flats = load_masters(images, source_dir=source_dir,
-                                type='flat', index_by='filter')
     file_idx=[]
     for fil in files:
         file_idx.append(np.where(images['file']==fil)[0])
@@ -56,21 +571,173 @@ def reduce(files, source_dir, destination=None,
     file_info.sort(['exptime','filter'])
     exposure_times = set(file_info['exptime'].reshape(len(file_info)))
     filters = set(file_info['filter'].reshape(len(file_info)))
+
+    if batch_size is None and (workers > 1 or overscan is not None or
+                               memory_limit is not None):
+        batch_size = 16
+    if workers > 1:
+        frames, written = _parallel_reduce(file_info, exposure_times,
+                                           filters, images, source_dir,
+                                           dest_dir, reduced_name,
+                                           flattener.combine, batch_size,
+                                           workers, closest_dark, overscan,
+                                           memory_limit, output_format)
+        return _reduce_report(frames, written, now() - start_time)
+
+    master_darks = load_masters(images, source_dir=source_dir,
+                                type='dark', index_by='exptime',
+                                cache=master_cache)
+    master_bias = None
+    if closest_dark and not exposure_times.issubset(master_darks):
+        master_bias = load_masters(images, source_dir=source_dir,
+                                   type='bias', cache=master_cache)
+
+    master_flats = load_masters(images, source_dir=source_dir,
+                                type='flat', index_by='filter',
+                                cache=master_cache)
+    if batch_size is not None:
+        reducer = BatchReducer(batch_size=batch_size, overscan=overscan,
+                               memory_limit=memory_limit)
+    frames = 0
+    written = 0
     for time in exposure_times:
         files_this_exposure = file_info.where(file_info['exptime']==time)
-        dark_subtractor.biasframe = master_darks[time].data
+        if closest_dark:
+            dark_subtractor.biasframe = dark_for_exposure(master_darks, time,
+                                                          master_bias)
+        else:
+            dark_subtractor.biasframe = master_darks[time].data
         for filter_band in filters:
             files_this_filter = files_this_exposure.where(files_this_exposure['filter']==filter_band)
             flattener.flatfield = master_flats[filter_band].data
+            if batch_size is not None:
+                # ccd.FitsImage data is transposed relative to the file
+                reducer.set_masters(dark=dark_subtractor.biasframe.T,
+                                    flat=flattener.flatfield.T,
+                                    flat_combine=flattener.combine)
+                paths = [path.join(source_dir, img)
+                         for img in files_this_filter['file']]
+                for source, reduced in reducer.reduce_files(paths):
+                    frames += 1
+                    if dest_dir is not None:
+                        base, ext = path.splitext(path.basename(source))
+                        written += _save_reduced(reduced, source,
+                                                 path.join(dest_dir,
+                                                           base+reduced_name+ext),
+                                                 output_format)
+                continue
             for img in files_this_filter['file']:
                 pipe.feed(ccd.FitsImage(path.join(source_dir,img)))
                 pipe.process()
                 result = pipe.extract()
+                frames += 1
+                if dest_dir is not None:
+                    base, ext = path.splitext(img)
+                    reduced_path = path.join(dest_dir,base+reduced_name+ext)
+                    if output_format is None:
+                        result.save(reduced_path)
+                        written += path.getsize(reduced_path)
+                    else:
+                        # ccd.FitsImage data is transposed relative to the file
+                        written += _save_reduced(result.data.T,
+                                                 path.join(source_dir, img),
+                                                 reduced_path, output_format)
+    return _reduce_report(frames, written, now() - start_time)
+
+def _reduce_report(frames, written, seconds):
+    """Summarize the work done by :func:`reduce`."""
+    return dict(frames=frames, bytes=written, seconds=seconds,
+                bytes_per_frame=written / max(frames, 1),
+                seconds_per_frame=seconds / max(frames, 1))
+
+def format_reduce_report(report):
+    """One line describing the `report` returned by :func:`reduce`."""
+    return ('Reduced %(frames)d frames in %(seconds).2f sec: '
+            '%(seconds_per_frame).3f sec and %(bytes_per_frame)d bytes '
+            'per frame' % report)
+
+def _parallel_reduce(file_info, exposure_times, filters, images, source_dir,
+                     dest_dir, reduced_name, flat_combine, batch_size,
+                     workers, closest_dark=False, overscan=None,
+                     memory_limit=None, output_format=None):
+    """
+    Reduce the files in `file_info` with a pool of `workers` processes;
+    see :func:`reduce`. Returns the number of frames and of bytes
+    written.
+    """
+    dark_files = master_files(images, source_dir=source_dir,
+                              type='dark', index_by='exptime')
+    flat_files = master_files(images, source_dir=source_dir,
+                              type='flat', index_by='filter')
+    bias_file = None
+    if closest_dark and not exposure_times.issubset(dark_files):
+        bias_file = master_files(images, source_dir=source_dir, type='bias')
+    tasks = []
+    for time in exposure_times:
+        files_this_exposure = file_info.where(file_info['exptime']==time)
+        for filter_band in filters:
+            files_this_filter = files_this_exposure.where(files_this_exposure['filter']==filter_band)
+            if not files_this_filter:
+                continue
+            # fail here, not in a worker, if a master is missing
+            if not closest_dark:
+                dark_files[time]
+            flat_files[filter_band]
+            sources = []
+            destinations = []
+            for img in files_this_filter['file']:
+                sources.append(path.join(source_dir, img))
                 if dest_dir is not None:
                     base, ext = path.splitext(img)
-                    result.save(path.join(dest_dir,base+reduced_name+ext))
+                    destinations.append(path.join(dest_dir,
+                                                  base+reduced_name+ext))
+                else:
+                    destinations.append(None)
+            for start in range(0, len(sources), batch_size):
+                stop = start + batch_size
+                tasks.append((time, filter_band, sources[start:stop],
+                              destinations[start:stop]))
+    pool = Pool(workers, initializer=_init_reduce_worker,
+                initargs=(dark_files, flat_files, flat_combine, batch_size,
+                          bias_file, overscan, memory_limit, output_format))
+    try:
+        done = pool.map(_reduce_batch, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    frames = [batch[0] for batch in done]
+    written = [batch[1] for batch in done]
+    return sum(frames), sum(written)
+
+def master_files(images, source_dir='.', type='', index_by=''):
+    """
+    Return the full path(s) of master calibration file(s).
+
+    The arguments are those of :func:`load_masters`; a dictionary of
+    paths is returned if `index_by` is given.
+    """
+    if not set(['BIAS', 'DARK', 'FLAT']).issuperset(set([type.upper()])):
+        raise ValueError('Read the docstring, chump! You gave me a bad type.')
+
+    masters = images.where(images['imagetyp']=='MASTER '+type.upper())
+    if not masters:
+        raise ValueError('Sorry, no master files of that type are present')
 
-def load_masters(images, source_dir='.', type='', index_by=''):
+    if not index_by:
+        if len(masters) != 1:
+            raise RuntimeError('Do not know how to group these masters')
+        return path.join(source_dir, masters['file'][0])
+
+    master_paths = {}
+    for val in masters[index_by]:
+        this_master = masters.where(masters[index_by]==val)
+        if len(this_master) != 1:
+            raise RuntimeError('Do not know how to group these masters')
+        master_paths[val] = path.join(source_dir, this_master['file'][0])
+    return master_paths
+
+def load_masters(images, source_dir='.', type='', index_by='',
+                 cache=None):
      """Return master calibration file(s)
 
      `images` should be a an image information table.
@@ -83,25 +750,23 @@ def load_masters(images, source_dir='.', type='', index_by=''):
      (e.g. 'exptime' is a sensible choice for darks, `filter` for
      flats) and forces the return value to be a dictionary of masters.
      An empty string means return a single master.
-     """
-     if not set(['BIAS', 'DARK', 'FLAT']).issuperset(set([type.upper()])):
-         raise ValueError('Read the docstring, chump! You gave me a bad type.')
-
-     masters = images.where(images['imagetyp']=='MASTER '+type.upper())
-     if not masters:
-         raise ValueError('Sorry, no master files of that type are present')
 
-     if not index_by:
-         if len(masters) != 1:
-             raise RuntimeError('Do not know how to group these masters')
-         master_images= ccd.FitsImage(path.join(dir,masters['file'][0]))
+     `cache` is an optional :class:`MasterCache` from which masters are
+     taken, so that masters are read only once; the data of the masters
+     returned is then read-only. If `None`, the default, new masters are
+     read from disk.
+     """
+     if cache is None:
+         load = ccd.FitsImage
      else:
-         master_images = {}
-         for val in masters[index_by]:
-             this_master = masters.where(masters[index_by]==val)
-             if len(this_master) != 1:
-                 raise RuntimeError('Do not know how to group these masters')
+         load = cache.image
+     paths = master_files(images, source_dir=source_dir, type=type,
+                          index_by=index_by)
+     if not index_by:
+         return load(paths)
 
-             master_images[val] = ccd.FitsImage(path.join(source_dir,this_master['file'][0]))
+     master_images = {}
+     for val, master_path in paths.items():
+         master_images[val] = load(master_path)
 
-     return master_images
\ No newline at end of file
+     return master_images
@@ -1,8 +1,7 @@
-from patch_headers import patch_headers, add_object_info
+from patch_headers import patch_directories
+from multiprocessing import cpu_count
 import sys
 
-for currentDir in sys.argv[1:]:
-    print "working on directory: %s" % currentDir
-    patch_headers(currentDir, new_file_ext='', overwrite=True)
-    add_object_info(currentDir, new_file_ext='', overwrite=True)
-    
\ No newline at end of file
+reports = patch_directories(sys.argv[1:], workers=cpu_count())
+if any(report['errors'] for report in reports):
+    sys.exit(1)
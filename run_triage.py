@@ -14,7 +14,14 @@ def write_list(dir, file, info):
     out.close()
 
 def triage_directories(directories,
-                       extra_keywords=[]):
+                       extra_keywords=[], catalog=None):
+    """
+    Write lists of files needing attention, and a `Manifest.txt`, in
+    each directory.
+
+    `catalog` is an optional `catalog.SummaryCatalog` in which the
+    summary of each directory is also stored.
+    """
     for currentDir in directories:
 #    pdb.set_trace()
         moo = tff.triage_fits_files(currentDir,
@@ -40,6 +47,8 @@ def triage_directories(directories,
         tbl = moo['files']
         if len(tbl) > 0:
             tbl.write(os.path.join(currentDir, file_list), type='ascii', delimiter=',')
+        if catalog is not None:
+            catalog.update(currentDir, tbl)
                  
 if __name__ == "__main__":
     dirs = sys.argv[1:]
@@ -0,0 +1,15 @@
+from ..calc_gain_read import as_images
+from astropysics import ccd
+from os import path
+import numpy as np
+
+_data_dir = path.join(path.dirname(path.abspath(__file__)), 'data')
+
+
+def test_as_images_drops_first_fits_column():
+    names = ['biastest1.fit', 'flattest.fit']
+    images = as_images([dict(file=name) for name in names], _data_dir)
+    for name, image in zip(names, images):
+        # FitsImage data is the transpose of the FITS array
+        old = ccd.FitsImage(path.join(_data_dir, name)).data[1:, :]
+        assert np.all(np.asarray(image) == old.T)
@@ -0,0 +1,133 @@
+from .. import catalog as cat
+from .. import image_collection as tff
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import numpy as np
+import pyfits
+import pytest
+
+_test_dir = ''
+
+
+def make_image(name, **keywords):
+    hdu = pyfits.PrimaryHDU(np.arange(100))
+    for keyword, value in keywords.items():
+        hdu.header.update(keyword, value)
+    hdu.writeto(os.path.join(_test_dir, name), clobber=True)
+
+
+def test_files_filtered_matches_collection(monkeypatch):
+    catalog = cat.SummaryCatalog()
+    keywords = ['imagetyp', 'filter', 'exptime']
+    images = tff.ImageFileCollection(_test_dir, info_file=None,
+                                     keywords=keywords)
+    cataloged = tff.ImageFileCollection(_test_dir, info_file=None,
+                                        keywords=keywords, catalog=catalog)
+
+    def no_index(*arg, **kwd):
+        raise AssertionError('query should have been run on the catalog')
+    monkeypatch.setattr(cataloged, '_find_keywords_by_values', no_index)
+    queries = [{'imagetyp': 'light'},
+               {'imagetyp': 'LIGHT', 'filter': 'r'},
+               {'filter': ''},
+               {'filter': '*'},
+               {'exptime': 30.0}]
+    for query in queries:
+        # in the order of the summary, with or without a catalog
+        expected = list(images.files_filtered(**query))
+        assert list(cataloged.files_filtered(**query)) == expected
+        assert catalog.files_filtered(**query) == \
+            [os.path.join(os.path.abspath(_test_dir), name)
+             for name in sorted(expected)]
+
+
+def test_failed_update_leaves_catalog_unchanged(monkeypatch):
+    catalog = cat.SummaryCatalog()
+    images = tff.ImageFileCollection(_test_dir, info_file=None,
+                                     keywords=['imagetyp'])
+    catalog.update(_test_dir, images.summary_info)
+    images.keywords = ['imagetyp', 'filter']
+
+    def failing_stat(*arg, **kwd):
+        raise RuntimeError('disk went away')
+    monkeypatch.setattr(cat.os, 'stat', failing_stat)
+    with pytest.raises(RuntimeError):
+        catalog.update(_test_dir, images.summary_info)
+    monkeypatch.undo()
+    # the new column was rolled back with the rows
+    assert catalog.keywords == ['imagetyp']
+    assert len(catalog.files_filtered(imagetyp='light')) == 2
+
+
+def test_catalog_shared_between_threads():
+    db_dir = mkdtemp()
+    catalog = cat.SummaryCatalog(os.path.join(db_dir, 'catalog.sqlite'))
+    images = tff.ImageFileCollection(_test_dir, info_file=None,
+                                     keywords=['imagetyp', 'filter'])
+    directories = [os.path.join(db_dir, 'night%d' % night)
+                   for night in range(8)]
+
+    def update(directory):
+        catalog.update(directory, images.summary_info)
+        return len(catalog.files_filtered(directory=directory,
+                                          imagetyp='light'))
+
+    assert tff.thread_map(update, directories, 8) == [2] * 8
+    assert len(catalog.files_filtered(imagetyp='*')) == 8 * 4
+    catalog.close()
+    rmtree(db_dir)
+
+
+def test_update_keeps_other_keywords_and_removes_files():
+    catalog = cat.SummaryCatalog()
+    images = tff.ImageFileCollection(_test_dir, info_file=None,
+                                     keywords=['imagetyp', 'filter'])
+    catalog.update(_test_dir, images.summary_info)
+    images.keywords = ['exptime']
+    catalog.update(_test_dir, images.summary_info)
+    assert set(catalog.keywords) == set(['imagetyp', 'filter', 'exptime'])
+    assert len(catalog.files_filtered(imagetyp='bias', exptime=0.0)) == 1
+
+    fewer = images.summary_info.where(images.summary_info['file'] !=
+                                      'bias.fit')
+    catalog.update(_test_dir, fewer)
+    assert catalog.files_filtered(imagetyp='bias') == []
+
+
+def test_subset_collection_keeps_other_rows():
+    catalog = cat.SummaryCatalog()
+    tff.ImageFileCollection(_test_dir, info_file=None,
+                            keywords=['imagetyp'], catalog=catalog)
+    assert len(catalog.files_filtered(imagetyp='*')) == 4
+    tff.ImageFileCollection(_test_dir, info_file=None,
+                            keywords=['imagetyp'], catalog=catalog,
+                            files=['bias.fit'])
+    assert len(catalog.files_filtered(imagetyp='*')) == 4
+    assert len(catalog.files_filtered(imagetyp='light')) == 2
+
+
+def test_catalog_persists_and_unknown_keyword():
+    db_dir = mkdtemp()
+    db_name = os.path.join(db_dir, 'catalog.sqlite')
+    tff.ImageFileCollection(_test_dir, info_file=None,
+                            keywords=['imagetyp'], catalog=db_name)
+    catalog = cat.SummaryCatalog(db_name)
+    assert len(catalog.files_filtered(imagetyp='light')) == 2
+    with pytest.raises(ValueError):
+        catalog.files_filtered(object='m101')
+    catalog.close()
+    rmtree(db_dir)
+
+
+def setup_module():
+    global _test_dir
+    _test_dir = mkdtemp()
+    make_image('light_r.fit', imagetyp='LIGHT', filter='R', exptime=30.0)
+    make_image('light_nofilter.fit', imagetyp='LIGHT', exptime=60.0)
+    make_image('bias.fit', imagetyp='BIAS', exptime=0.0)
+    make_image('flat_r.fit', imagetyp='FLAT', filter='r', exptime=30.0)
+
+
+def teardown_module():
+    rmtree(_test_dir)
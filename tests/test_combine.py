@@ -0,0 +1,275 @@
+from .. import combine
+from ..master_bias_dark import combine_from_list, master_frame
+from astropysics import ccd
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import numpy as np
+import pyfits
+import pytest
+
+_test_dir = ''
+_file_names = []
+_shape = (37, 23)
+
+
+def in_memory_combine(method, subtract=None):
+    combiner = ccd.ImageCombiner()
+    combiner.method = method
+    images = [ccd.FitsImage(name) for name in _file_names]
+    if subtract is None:
+        return combiner.combineImages(images)
+    dark = ccd.FitsImage(subtract)
+    return combiner.combineImages([image.data - dark.data
+                                   for image in images])
+
+
+def test_tiled_combine_identical_to_in_memory():
+    for method in ['median', 'mean']:
+        expected = in_memory_combine(method)
+        for memory_limit in [1, 10000, 2**30]:
+            combined = combine.tiled_combine(_file_names, method=method,
+                                             memory_limit=memory_limit)
+            assert combined.dtype == expected.dtype
+            assert (combined.T == expected).all()
+
+
+def test_tiled_combine_with_subtraction():
+    dark_name = os.path.join(_test_dir, 'dark.fit')
+    expected = in_memory_combine('median', subtract=dark_name)
+    combined = combine.tiled_combine(_file_names, method='median',
+                                     memory_limit=5000,
+                                     subtract=combine.MappedImage(dark_name))
+    assert (combined.T == expected).all()
+
+
+def test_parallel_combine_identical_to_serial():
+    dark = combine.MappedImage(os.path.join(_test_dir, 'dark.fit'))
+    for method in ['median', 'mean']:
+        for subtract in [None, dark, dark[:]]:
+            serial = combine.tiled_combine(_file_names, method=method,
+                                           subtract=subtract)
+            parallel = combine.tiled_combine(_file_names, method=method,
+                                             memory_limit=5000,
+                                             subtract=subtract, workers=3)
+            assert parallel.dtype == serial.dtype
+            assert (parallel == serial).all()
+
+
+def cosmic_ray_stack():
+    random = np.random.RandomState(1)
+    stack = random.normal(1000, 30, size=(9, 12, 10))
+    stack[3, 4, 5] = 60000
+    stack[7, 0, 0] = 30000
+    return stack
+
+
+def test_rejection_methods_remove_cosmic_rays():
+    stack = cosmic_ray_stack()
+    assert abs(np.mean(stack, axis=0) - 1000).max() > 1000
+    for method in ['sigclip', 'avsigclip']:
+        combined = combine.combine_methods[method](stack)
+        assert combined.shape == stack.shape[1:]
+        assert abs(combined - 1000).max() < 60
+
+
+def test_minmax_matches_explicit_rejection():
+    stack = cosmic_ray_stack()
+    combined = combine.minmax(stack, nlow=1, nhigh=2)
+    for row in range(stack.shape[1]):
+        for column in range(stack.shape[2]):
+            values = sorted(stack[:, row, column])[1:-2]
+            assert np.allclose(combined[row, column], np.mean(values))
+    with pytest.raises(ValueError):
+        combine.minmax(stack, nlow=5, nhigh=4)
+
+
+def test_tiled_rejection_matches_whole_stack():
+    stack = np.array([combine.MappedImage(name)[:] for name in _file_names])
+    # tight limits, so that some pixels would lose every value
+    params = {'sigclip': {'lsigma': 0.5, 'hsigma': 0.5},
+              'avsigclip': {'lsigma': 1, 'hsigma': 1},
+              'minmax': {'nlow': 2}}
+    for method in params:
+        whole = combine.combine_methods[method](stack, **params[method])
+        tiled = combine.tiled_combine(_file_names, method=method,
+                                      memory_limit=1,
+                                      method_params=params[method])
+        assert not np.isnan(whole).any()
+        assert (tiled == whole).all()
+
+
+def test_method_description_and_header():
+    assert combine.method_description('median') == 'median'
+    assert (combine.method_description('sigclip', {'lsigma': 4}) ==
+            'sigclip(hsigma=3.0,lsigma=4,maxiters=10)')
+    with pytest.raises(ValueError):
+        combine.method_description('sigclip', {'nlow': 1})
+    with pytest.raises(ValueError):
+        combine.tiled_combine(_file_names, method='minmax',
+                              method_params={'sigma': 1})
+    combiner = ccd.ImageCombiner()
+    combiner.method = 'minmax'
+    image = master_frame(np.zeros((4, 4)), 0, 0, combiner=combiner,
+                         method_params={'nhigh': 2})
+    assert (image.fitsfile[0].header['cmbn-mth'] ==
+            'minmax(nhigh=2,nlow=1)')
+
+
+def test_combine_from_list_memory_limit():
+    combiner = ccd.ImageCombiner()
+    combiner.method = 'median'
+    names = [os.path.basename(name) for name in _file_names]
+    in_memory = combine_from_list(_test_dir, names, combiner)
+    tiled = combine_from_list(_test_dir, names, combiner, memory_limit=3000)
+    assert (in_memory == tiled).all()
+    parallel = combine_from_list(_test_dir, names, combiner, workers=2)
+    assert (in_memory == parallel).all()
+    combiner.method = 'sigclip'
+    clipped = combine_from_list(_test_dir, names, combiner,
+                                method_params={'maxiters': 2})
+    assert clipped.shape == in_memory.shape
+
+
+def test_combine_from_list_falls_back_for_other_methods():
+    # 'sum' and weights are ImageCombiner methods that cannot be tiled
+    combiner = ccd.ImageCombiner()
+    names = [os.path.basename(name) for name in _file_names]
+    for method in ['sum', [1.0] * len(names)]:
+        combiner.method = method
+        expected = in_memory_combine(method)
+        for memory_limit, workers in [(None, 1), (3000, 1), (None, 2)]:
+            combined = combine_from_list(_test_dir, names, combiner,
+                                         memory_limit=memory_limit,
+                                         workers=workers)
+            assert (combined == expected).all()
+    combiner.method = 'sum'
+    with pytest.raises(ValueError):
+        combine_from_list(_test_dir, names, combiner,
+                          method_params={'maxiters': 2})
+
+
+def test_combine_from_list_keeps_sigclip():
+    combiner = ccd.ImageCombiner()
+    combiner.method = 'median'
+    combiner.sigclip = 1
+    names = [os.path.basename(name) for name in _file_names]
+    expected = combiner.combineImages([ccd.FitsImage(name)
+                                       for name in _file_names])
+    for memory_limit, workers in [(3000, 1), (None, 2)]:
+        combined = combine_from_list(_test_dir, names, combiner,
+                                     memory_limit=memory_limit,
+                                     workers=workers)
+        assert (combined == expected).all()
+    combiner.method = 'sigclip'
+    with pytest.raises(ValueError):
+        combine_from_list(_test_dir, names, combiner)
+
+
+def test_combine_from_list_keeps_shifts():
+    combiner = ccd.ImageCombiner()
+    combiner.method = 'mean'
+    combiner.shifts = [(index % 2, 0) for index in range(len(_file_names))]
+    names = [os.path.basename(name) for name in _file_names]
+    expected = combiner.combineImages([ccd.FitsImage(name)
+                                       for name in _file_names])
+    for memory_limit, workers in [(3000, 1), (None, 2)]:
+        combined = combine_from_list(_test_dir, names, combiner,
+                                     memory_limit=memory_limit,
+                                     workers=workers)
+        assert (combined == expected).all()
+
+
+def test_bad_method_and_mismatched_sizes():
+    with pytest.raises(ValueError):
+        combine.tiled_combine(_file_names, method='not a method')
+    odd_name = os.path.join(_test_dir, 'odd_size.fit')
+    pyfits.PrimaryHDU(np.zeros((5, 5), dtype=np.float32)).writeto(odd_name)
+    with pytest.raises(ValueError):
+        combine.tiled_combine(_file_names + [odd_name])
+    os.remove(odd_name)
+
+
+def test_incremental_combine_matches_full_combine():
+    for method in ['median', 'mean']:
+        state_dir = os.path.join(_test_dir, '.%s_state' % method)
+        partial = combine.IncrementalCombine(state_dir, method)
+        partial.add(_file_names[:2])
+        assert partial.count == 2
+        # state is picked up again by a new object
+        resumed = combine.IncrementalCombine(state_dir, method)
+        assert resumed.files == [os.path.basename(name)
+                                 for name in _file_names[:2]]
+        resumed.add(_file_names[2:])
+        combined = resumed.combine(memory_limit=1000)
+        full = combine.tiled_combine(_file_names, method=method)
+        assert combined.dtype == full.dtype
+        assert combined.dtype == in_memory_combine(method).dtype
+        if method == 'median':
+            assert (combined == full).all()
+        else:
+            # a full combine sums these float32 images in single precision
+            assert np.allclose(combined, full, rtol=1e-6)
+        resumed.clear()
+        assert combine.IncrementalCombine(state_dir, method).count == 0
+
+
+def test_incremental_mean_of_integer_images_is_exact():
+    random = np.random.RandomState(7)
+    names = []
+    for i in range(5):
+        data = random.randint(-2**15, 2**15, size=_shape).astype(np.int16)
+        name = os.path.join(_test_dir, 'int16_%d.fit' % i)
+        pyfits.PrimaryHDU(data).writeto(name)
+        names.append(name)
+    state_dir = os.path.join(_test_dir, '.int16_state')
+    incremental = combine.IncrementalCombine(state_dir, 'mean')
+    incremental.add(names[:3])
+    incremental.add(names[3:])
+    combined = incremental.combine()
+    full = combine.tiled_combine(names, method='mean')
+    assert combined.dtype == full.dtype
+    assert (combined == full).all()
+    incremental.clear()
+    for name in names:
+        os.remove(name)
+
+
+def test_incremental_combine_notices_changed_files():
+    state_dir = os.path.join(_test_dir, '.stamp_state')
+    partial = combine.IncrementalCombine(state_dir, 'mean')
+    partial.add(_file_names[:2])
+    assert partial.is_current(_file_names)
+    assert not partial.is_current(_file_names[1:])
+    stat = os.stat(_file_names[0])
+    os.utime(_file_names[0], (stat.st_atime, stat.st_mtime + 10))
+    assert not combine.IncrementalCombine(state_dir, 'mean').is_current(
+        _file_names)
+    os.utime(_file_names[0], (stat.st_atime, stat.st_mtime))
+    partial.clear()
+
+
+def test_incremental_combine_bad_method():
+    with pytest.raises(ValueError):
+        combine.IncrementalCombine(os.path.join(_test_dir, '.bad'),
+                                   'sigclip')
+
+
+def setup_module():
+    global _test_dir
+    global _file_names
+    _test_dir = mkdtemp()
+    _file_names = []
+    random = np.random.RandomState(42)
+    for i in range(6):
+        data = random.randint(0, 2**16, size=_shape).astype(np.uint16)
+        hdu = pyfits.PrimaryHDU(data, uint=True)
+        name = os.path.join(_test_dir, 'bias%d.fit' % i)
+        hdu.writeto(name)
+        _file_names.append(name)
+    dark = random.normal(1000, 10, size=_shape).astype(np.float32)
+    pyfits.PrimaryHDU(dark).writeto(os.path.join(_test_dir, 'dark.fit'))
+
+
+def teardown_module():
+    rmtree(_test_dir)
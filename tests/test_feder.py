@@ -20,4 +20,56 @@ def test_apogee_fits_names():
                       ApogeeAltaU9)
     
     
-    
\ No newline at end of file
+
+def test_local_sidereal_times_matches_localSiderialTime():
+    import numpy as np
+    feder_site = FederSite()
+    jds = [calendar_to_jd((2012, 6, 5, 4, 17, 0)),
+           calendar_to_jd((2000, 1, 1, 5, 13, 0)),
+           calendar_to_jd((2013, 12, 31, 23, 59, 59))]
+    lsts = feder_site.local_sidereal_times(jds)
+    for jd, lst in zip(jds, lsts):
+        feder_site.currentobsjd = jd
+        assert np.abs(feder_site.localSiderialTime() - lst) < 1e-9
+
+def test_local_sidereal_times_once_per_date(monkeypatch):
+    import numpy as np
+    from astropysics.coords import funcs
+    feder_site = FederSite()
+    jds = [calendar_to_jd((2012, 6, 5, 4, 17, 0)),
+           calendar_to_jd((2013, 12, 31, 23, 59, 59))]
+    expected = feder_site.local_sidereal_times(jds)
+    dates = []
+    greenwich_sidereal_time = funcs.greenwich_sidereal_time
+    def recording_gst(jd, *arg, **kwd):
+        dates.append(jd)
+        return greenwich_sidereal_time(jd, *arg, **kwd)
+    monkeypatch.setattr(funcs, 'greenwich_sidereal_time', recording_gst)
+    lsts = feder_site.local_sidereal_times(jds*3)
+    assert sorted(dates) == sorted(jds)
+    assert (lsts == np.tile(expected, 3)).all()
+
+def test_alt_az_airmass_matches_apparentCoordinates():
+    import numpy as np
+    from math import cos, pi
+    from astropysics import coords
+    feder_site = FederSite()
+    jd = calendar_to_jd((2012, 6, 5, 4, 17, 0))
+    pointings = [('14:03:15', '+54:21:04'), ('06:12:45', '-05:30:00'),
+                 ('23:59:59', '+89:00:00')]
+    ra = [coords.AngularCoordinate(ra_str, sghms=True).hours
+          for ra_str, dec_str in pointings]
+    dec = [coords.AngularCoordinate(dec_str).degrees
+           for ra_str, dec_str in pointings]
+    alt, az, airmass, ha = feder_site.alt_az_airmass(ra, dec, [jd]*3)
+    feder_site.currentobsjd = jd
+    for i, pointing in enumerate(pointings):
+        object_coords = coords.EquatorialCoordinatesEquinox(pointing)
+        alt_az = feder_site.apparentCoordinates(object_coords,
+                                                refraction=False)
+        assert np.abs(alt[i] - alt_az.alt.d) < 1e-9
+        assert np.abs(az[i] - alt_az.az.d) < 1e-9
+        assert np.abs(airmass[i] - 1/cos(pi/2 - alt_az.alt.r)) < 1e-9
+        expected_ha = (feder_site.localSiderialTime() -
+                       object_coords.ra.hours) % 24
+        assert np.abs(ha[i] - expected_ha) < 1e-9
@@ -58,3 +58,24 @@ class TestGoodFITSKeyword(FITSKeyword):
 
             
 
+
+def test_keyword_value_leaves_keyword_alone():
+    from pyfits import Header
+    keyword = FITSKeyword(name='kwd', comment='A comment',
+                          synonyms=['kwdalt'])
+    value = keyword.withValue(7)
+    header = Header()
+    value.addToHeader(header, history=True)
+    assert keyword.value is None
+    assert header['kwd'] == 7
+    assert header['kwdalt'] == 7
+    assert header.ascard['kwd'].comment == 'A comment'
+    assert 'Updated keyword KWDALT to value 7' in str(header['history'])
+
+def test_value_from_header_leaves_keyword_alone():
+    from pyfits import Header
+    keyword = FITSKeyword(name='kwd', synonyms=['kwdalt'])
+    header = Header()
+    header.update('kwdalt', 'abc')
+    assert keyword.valueFromHeader(header) == 'abc'
+    assert keyword.value is None
@@ -0,0 +1,107 @@
+from .. import master_bias_dark as mbd
+from ..image_collection import read_header_values
+import pyfits
+import os
+from os import path
+from shutil import copytree, rmtree
+from tempfile import mkdtemp
+import glob
+import pytest
+
+_test_dir = ''
+
+
+def masters():
+    return sorted(glob.glob(path.join(_test_dir, 'Master_*.fit')))
+
+
+def set_old_mtime(file_names):
+    for file_name in file_names:
+        os.utime(file_name, (1000000000, 1000000000))
+
+
+def test_unchanged_masters_are_not_rebuilt():
+    mbd.master_bias_dark([_test_dir])
+    made = masters()
+    assert len(made) == 2
+    for master in made:
+        assert read_header_values(master, ['mstrhash'])['MSTRHASH']
+    set_old_mtime(made)
+    mbd.master_bias_dark([_test_dir])
+    assert [os.stat(master).st_mtime for master in made] == [1000000000] * 2
+    mbd.master_bias_dark([_test_dir], rebuild=True)
+    assert [os.stat(master).st_mtime for master in made] != [1000000000] * 2
+
+
+def test_changed_input_rebuilds_only_its_master():
+    mbd.master_bias_dark([_test_dir])
+    made = masters()
+    set_old_mtime(made)
+    os.utime(path.join(_test_dir, 'darktest3.fit'), None)
+    mbd.master_bias_dark([_test_dir])
+    bias = path.join(_test_dir, 'Master_Bias.fit')
+    for master in made:
+        rebuilt = os.stat(master).st_mtime != 1000000000
+        assert rebuilt == (master != bias)
+
+
+def test_incremental_masters_add_new_frames():
+    bias = sorted(glob.glob(path.join(_test_dir, 'biastest*.fit')))
+    hidden = path.join(_test_dir, 'hidden')
+    os.mkdir(hidden)
+    os.rename(bias[-1], path.join(hidden, path.basename(bias[-1])))
+    mbd.master_bias_dark([_test_dir], incremental=True, rebuild=True)
+    master = path.join(_test_dir, 'Master_Bias.fit')
+    n_files = read_header_values(master, ['n-files'])['N-FILES']
+    os.rename(path.join(hidden, path.basename(bias[-1])), bias[-1])
+    mbd.master_bias_dark([_test_dir], incremental=True)
+    incremental = pyfits.open(master)
+    header = incremental[0].header
+    assert header['n-files'] == n_files + 1
+    assert '    ' + path.basename(bias[-1]) in [str(comment) for comment in
+                                                header.get_comment()]
+    mbd.master_bias_dark([_test_dir], rebuild=True)
+    full = pyfits.open(master)
+    assert (incremental[0].data == full[0].data).all()
+
+
+def test_incremental_masters_reread_changed_frames():
+    bias = sorted(glob.glob(path.join(_test_dir, 'biastest*.fit')))
+    master = path.join(_test_dir, 'Master_Bias.fit')
+    mbd.master_bias_dark([_test_dir], incremental=True, rebuild=True)
+    changed = pyfits.open(bias[0])
+    changed[0].data = changed[0].data + 100
+    changed.writeto(bias[0], clobber=True)
+    changed.close()
+    os.utime(bias[0], (2000000000, 2000000000))
+    mbd.master_bias_dark([_test_dir], incremental=True)
+    incremental = pyfits.getdata(master)
+    mbd.master_bias_dark([_test_dir], rebuild=True)
+    assert (incremental == pyfits.getdata(master)).all()
+
+
+def test_incremental_masters_reject_method_params():
+    with pytest.raises(ValueError):
+        mbd.master_bias_dark([_test_dir], incremental=True,
+                             method_params={'lsigma': 4})
+
+
+def test_master_hash_depends_on_files_and_method():
+    bias = sorted(glob.glob(path.join(_test_dir, 'biastest*.fit')))
+    key = mbd.master_hash(bias, 'median')
+    assert key == mbd.master_hash(list(reversed(bias)), 'median')
+    assert key != mbd.master_hash(bias[1:], 'median')
+    assert key != mbd.master_hash(bias, 'mean')
+    assert (mbd.master_hash(bias, 'sigclip') !=
+            mbd.master_hash(bias, 'sigclip', {'lsigma': 4}))
+    assert key != mbd.master_hash(bias, 'median', depends_on=[bias[0]])
+
+
+def setup_module():
+    global _test_dir
+    _test_dir = path.join(mkdtemp(), 'data')
+    copytree(path.join(path.dirname(__file__), 'data'), _test_dir)
+
+
+def teardown_module():
+    rmtree(path.dirname(_test_dir))
@@ -1,12 +1,13 @@
 from ..patch_headers import *
 from tempfile import mkdtemp
-from os import path, mkdir, chdir
+from os import path, mkdir, chdir, getcwd
 from shutil import rmtree
 import numpy as np
 import pytest
 
 test_tuple = (1,2,3.1415)
 _test_dir = ''
+_original_dir = ''
 def test_sexagesimal_string():
     assert sexagesimal_string(test_tuple) == '01:02:03.14'
 
@@ -44,6 +45,317 @@ def test_history_function_name():
     hist = history(test_history_function_name, mode='begin')
     assert hist.find('test_history_function_name') > 0
     
+def test_batch_time_info_matches_astropysics():
+    from ..feder import FederSite
+    dates = ['2012-06-05T04:17:00', '2012-06-05T04:17:01',
+             '2011-12-31T23:59:59', '2013-01-01T00:00:00',
+             '2012-02-29T12:34:56']
+    batch = batch_time_info(dates)
+    assert len(batch) == len(dates)
+    site = FederSite()
+    for date, (jd, mjd, lst) in zip(dates, batch):
+        dateobs = parse_dateobs(date)
+        assert jd == round(obstools.calendar_to_jd(dateobs), 6)
+        assert mjd == round(obstools.calendar_to_jd(dateobs, mjd=True), 6)
+        site.currentobsjd = jd
+        assert lst == sexagesimal_string(deg2dms(site.localSiderialTime()))
+
+def test_batch_time_info_empty():
+    assert batch_time_info([]) == []
+
+def test_patch_headers_time_info_matches_add_time_info():
+    new_ext = '_time'
+    patch_headers(_test_dir, new_file_ext=new_ext)
+    patched = pyfits.getheader(path.join(_test_dir, 'uint16'+new_ext+'.fit'))
+    header = pyfits.getheader(path.join(_test_dir, 'uint16.fit'))
+    add_time_info(header)
+    for keyword in ['jd-obs', 'mjd-obs', 'lst']:
+        assert patched[keyword] == header[keyword]
+
+def _pointing_header(date, ra, dec):
+    header = pyfits.Header()
+    header.update('date-obs', date)
+    header.update('objctra', ra)
+    header.update('objctdec', dec)
+    return header
+
+pointing_test_values = [('2012-06-05T04:17:00', '14 03 15', '+54 21 04'),
+                        ('2012-06-05T04:20:00', '14 03 15', '+54 21 04'),
+                        ('2012-06-05T04:17:00', '06 12 45.5', '-05 30 00'),
+                        ('2012-01-15T02:00:00', '09 02 18', '+49 48 36'),
+                        ('2012-01-15T10:00:00', '23 59 59', '+00 00 01')]
+
+def _hours(sexagesimal):
+    return np.dot([float(part) for part in sexagesimal.split(':')],
+                  [1, 1/60., 1/3600.])
+
+def test_batch_pointing_info_matches_astropysics():
+    from math import cos, pi
+    from ..feder import FederSite
+    dates, ra, dec = zip(*pointing_test_values)
+    jd = [time_info[0] for time_info in batch_time_info(dates)]
+    batch = batch_pointing_info(ra, dec, jd)
+    assert len(batch) == len(dates)
+    site = FederSite()
+    for (date, ra_str, dec_str), jd_value, pointing in zip(pointing_test_values,
+                                                            jd, batch):
+        object_coords = coords.EquatorialCoordinatesEquinox(
+            (ra_str.replace(' ', ':'), dec_str.replace(' ', ':')))
+        site.currentobsjd = jd_value
+        alt_az = site.apparentCoordinates(object_coords, refraction=False)
+        batch_alt, batch_az, batch_airmass, batch_ha = pointing
+        assert np.abs(batch_alt - alt_az.alt.d) <= 1e-5
+        assert np.abs(batch_az - alt_az.az.d) <= 1e-5
+        assert np.abs(batch_airmass - 1/cos(pi/2 - alt_az.alt.r)) <= 1e-3
+        ha = (site.localSiderialTime() - object_coords.ra.hours) % 24
+        assert np.abs(_hours(batch_ha) - ha) < 1e-5
+
+def test_hour_angle_is_in_hours():
+    date, ra, dec = pointing_test_values[0]
+    header = _pointing_header(date, ra, dec)
+    add_time_info(header)
+    add_object_pos_airmass(header)
+    ra_hours = _hours(ra.replace(' ', ':'))
+    assert np.abs((_hours(header['lst']) - ra_hours) % 24 -
+                  _hours(header['ha'])) < 1e-3
+
+def test_batch_pointing_info_empty():
+    assert batch_pointing_info([], [], []) == []
+
+def test_patch_headers_pointing_matches_add_object_pos_airmass():
+    new_ext = '_pointing'
+    patch_headers(_test_dir, new_file_ext=new_ext)
+    patched = pyfits.getheader(path.join(_test_dir, 'uint16'+new_ext+'.fit'))
+    header = pyfits.getheader(path.join(_test_dir, 'uint16.fit'))
+    add_time_info(header)
+    add_object_pos_airmass(header)
+    for keyword in ['ra', 'dec', 'alt-obj', 'az-obj', 'airmass', 'ha']:
+        assert patched[keyword] == header[keyword]
+
+def _stress_directory(n_files=40):
+    """
+    Directory of copies of uint16.fit with different dates, pointings
+    and image types.
+    """
+    stress_dir = path.join(_test_dir, 'stress')
+    mkdir(stress_dir)
+    hdulist = pyfits.open(path.join(_test_dir, 'uint16.fit'),
+                          do_not_scale_image_data=True)
+    header = hdulist[0].header
+    for i in range(n_files):
+        header.update('date-obs',
+                      '2012-06-%02dT%02d:%02d:%02d' % (1 + i % 28, i % 24,
+                                                       (7*i) % 60,
+                                                       (13*i) % 60))
+        header.update('objctra', '%02d %02d 15' % (i % 24, i % 60))
+        header.update('objctdec', '%+03d 21 04' % (i*4 % 180 - 89))
+        header.update('imagetyp', ['LIGHT', 'LIGHT', 'DARK', 'BIAS'][i % 4])
+        hdulist.writeto(path.join(stress_dir, 'stress%03d.fit' % i))
+    hdulist.close()
+    return stress_dir
+
+def _timeless_cards(file_name):
+    """
+    Header cards of `file_name` except the history that records when
+    the file was patched.
+    """
+    header = pyfits.getheader(file_name)
+    return [(card.key, str(card.value)) for card in header.ascard
+            if not (card.key == 'HISTORY' and
+                    (' on ' in str(card.value)))]
+
+def test_concurrent_patching_matches_serial():
+    from shutil import copytree
+    from glob import glob
+    stress_dir = _stress_directory()
+
+    def patched_copy(name, workers):
+        copy_dir = path.join(_test_dir, name)
+        copytree(stress_dir, copy_dir)
+        patch_headers(copy_dir, new_file_ext='', overwrite=True,
+                      workers=workers)
+        add_overscan(copy_dir, new_file_ext='', overwrite=True,
+                     workers=workers)
+        return copy_dir
+
+    serial_dir = patched_copy('serial', 1)
+    serial = sorted(glob(path.join(serial_dir, '*.fit')))
+    assert len(serial) == 40
+    for attempt in range(3):
+        threaded_dir = patched_copy('threads%d' % attempt, 8)
+        for serial_file in serial:
+            threaded_file = path.join(threaded_dir, path.basename(serial_file))
+            assert (_timeless_cards(threaded_file) ==
+                    _timeless_cards(serial_file))
+        rmtree(threaded_dir)
+    rmtree(serial_dir)
+    rmtree(stress_dir)
+
+def _keyword_cards(file_name):
+    """
+    Header cards of `file_name` other than history.
+    """
+    header = pyfits.getheader(file_name)
+    return [(card.key, str(card.value)) for card in header.ascard
+            if card.key != 'HISTORY']
+
+def _separately_patched(stress_dir, name):
+    """
+    Copy of `stress_dir` patched by `patch_headers` and `add_overscan`.
+    """
+    from shutil import copytree
+    serial_dir = path.join(_test_dir, name)
+    copytree(stress_dir, serial_dir)
+    patch_headers(serial_dir, new_file_ext='', overwrite=True)
+    add_overscan(serial_dir, new_file_ext='', overwrite=True)
+    return serial_dir
+
+def test_patching_reports_bytes_written():
+    from glob import glob
+    stress_dir = _stress_directory(n_files=8)
+    file_names = sorted(glob(path.join(stress_dir, '*.fit')))
+    written = patch_headers(stress_dir, new_file_ext='', overwrite=True)
+    assert sorted(written.keys()) == file_names
+    for file_name in file_names:
+        assert 0 < written[file_name] <= path.getsize(file_name)
+    bytes_written = {}
+    fused_patch(stress_dir, new_file_ext='', overwrite=True,
+                bytes_written=bytes_written)
+    assert sorted(bytes_written.keys()) == file_names
+    reports = patch_directories([stress_dir])
+    assert reports[0]['bytes_written'] > 0
+    rmtree(stress_dir)
+
+def test_patch_directories_matches_patch_headers():
+    from shutil import copytree
+    from ..image_collection import fits_files_in_directory
+    stress_dir = _stress_directory()
+    serial_dir = _separately_patched(stress_dir, 'serial_dirs')
+    good = [path.join(_test_dir, 'good%d' % i) for i in range(2)]
+    for directory in good:
+        copytree(stress_dir, directory)
+    bad = path.join(_test_dir, 'bad')
+    mkdir(bad)
+    hdu = pyfits.PrimaryHDU(np.zeros([4, 4]))
+    hdu.header.update('imagetyp', 'LIGHT')
+    hdu.writeto(path.join(bad, 'no_date.fit'))
+    reports = patch_directories(good + [bad], workers=2, shard_size=15,
+                                overscan=True)
+    assert [report['directory'] for report in reports] == good + [bad]
+    for report in reports[:2]:
+        assert report['files'] == 40
+        assert not report['errors']
+        assert report['stages'].keys() == ['summary', 'read', 'time',
+                                           'pointing', 'overscan', 'object',
+                                           'write']
+        assert report['seconds'] > 0
+        for file_name in fits_files_in_directory(report['directory']):
+            assert (_keyword_cards(path.join(report['directory'], file_name)) ==
+                    _keyword_cards(path.join(serial_dir, file_name)))
+    assert len(reports[2]['errors']) == 1
+    assert 'KeyError' in reports[2]['errors'][0]
+    for directory in good + [bad, serial_dir, stress_dir]:
+        rmtree(directory)
+
+def test_fused_patch_opens_and_saves_each_file_once(monkeypatch):
+    import sys
+    from shutil import copytree
+    from glob import glob
+    stress_dir = _stress_directory()
+    serial_dir = _separately_patched(stress_dir, 'serial_fused')
+    fused_dir = path.join(_test_dir, 'fused')
+    copytree(stress_dir, fused_dir)
+    module = sys.modules[fused_patch.__module__]
+    opened = []
+    saved = []
+    original_open = module.pyfits.open
+    original_save = module.save_hdulist
+
+    def counting_open(name, *args, **kwd):
+        opened.append(name)
+        return original_open(name, *args, **kwd)
+
+    def counting_save(hdulist, full_path, *args, **kwd):
+        saved.append(full_path)
+        return original_save(hdulist, full_path, *args, **kwd)
+
+    monkeypatch.setattr(module.pyfits, 'open', counting_open)
+    monkeypatch.setattr(module, 'save_hdulist', counting_save)
+    timings = fused_patch(fused_dir, new_file_ext='', overwrite=True,
+                          workers=4)
+    monkeypatch.undo()
+    fused = sorted(glob(path.join(fused_dir, '*.fit')))
+    assert len(fused) == 40
+    assert sorted(opened) == fused
+    assert sorted(saved) == fused
+    assert timings.keys() == ['summary', 'read', 'time', 'pointing',
+                              'overscan', 'object', 'write']
+    assert timings['read'] > 0 and timings['write'] > 0
+    for fused_file in fused:
+        serial_file = path.join(serial_dir, path.basename(fused_file))
+        assert _keyword_cards(fused_file) == _keyword_cards(serial_file)
+        assert np.all(pyfits.getdata(fused_file) ==
+                      pyfits.getdata(serial_file))
+    for directory in [fused_dir, serial_dir, stress_dir]:
+        rmtree(directory)
+
+def test_fused_patch_saves_files_that_match_no_object(monkeypatch):
+    from shutil import copytree
+    from glob import glob
+    from astropysics import coords
+    from .. import astro_object
+    stress_dir = _stress_directory()
+    no_match_dir = path.join(_test_dir, 'no_match')
+    copytree(stress_dir, no_match_dir)
+    with open(path.join(no_match_dir, 'obsinfo.txt'), 'w') as object_list:
+        object_list.write('Ima Observer\nnowhere\n')
+
+    class Nowhere(object):
+        """Object far from every pointing, found without Sesame."""
+        def __init__(self, name):
+            self.ra_dec = coords.coordsys.FK5Coordinates(180.0, 0.3)
+
+    monkeypatch.setattr(astro_object, 'AstroObject', Nowhere)
+    reports = patch_directories([no_match_dir])
+    assert not reports[0]['errors']
+    for file_name in glob(path.join(no_match_dir, '*.fit')):
+        header = pyfits.getheader(file_name)
+        assert 'jd-obs' in header
+        # run_patch.py does not add overscan information
+        assert 'oscan' not in header
+        assert 'object' not in header
+        if header['imagetyp'] == 'LIGHT':
+            assert 'airmass' in header
+    for directory in [no_match_dir, stress_dir]:
+        rmtree(directory)
+
+def test_fused_patch_runs_only_the_transforms_given():
+    new_ext = '_time_only'
+    timings = fused_patch(_test_dir, transforms=[TimeInfo()],
+                          new_file_ext=new_ext, detailed_history=False)
+    assert timings.keys() == ['summary', 'read', 'time', 'write']
+    header = pyfits.getheader(path.join(_test_dir, 'uint16' + new_ext + '.fit'))
+    assert 'jd-obs' in header
+    assert 'airmass' not in header
+    assert 'oscan' not in header
+    history = ''.join(header.get_history())
+    assert 'updated keywords' in history
+    assert 'JD-OBS' in history
+
+def test_header_transform_does_nothing_by_default():
+    header = pyfits.Header()
+    transform = HeaderTransform()
+    transform.prepare(_test_dir, None)
+    assert transform.apply('any.fit', header) == []
+    assert len(header.ascard) == 0
+
+def test_patching_leaves_keyword_singletons_alone():
+    from ..feder import JD, LST, RA, airmass, overscan_present
+    new_ext = '_singletons'
+    patch_headers(_test_dir, new_file_ext=new_ext)
+    for keyword in [JD, LST, RA, airmass, overscan_present]:
+        assert keyword.value is None
+
 def test_data_is_unmodified_by_patch_headers():
     """No changes should be made to the data."""
     new_ext = '_new'
@@ -78,6 +390,20 @@ def test_adding_object_name():
     print 'add object name: %s' % fname
     assert (with_name[0].header['object'] == 'm101')
     
+def test_object_name_card_has_no_comment():
+    from astropysics import coords
+    from ..fitskeyword import FITSKeyword
+    header = pyfits.Header()
+    header.update('ra', '14:03:12.6')
+    header.update('dec', '+54:20:57')
+    expected = header.copy()
+    FITSKeyword('object', value='m101').addToHeader(expected, history=True)
+    object_ra_dec = np.array([coords.coordsys.FK5Coordinates('14:03:12.6',
+                                                             '+54:20:57')])
+    add_object_name(header, np.array(['m101']), object_ra_dec)
+    assert str(header.ascard['object']) == str(expected.ascard['object'])
+    assert header.ascard['object'].comment == ''
+
 def test_adding_overscan_apogee_u9():
     from ..feder import ApogeeAltaU9
 
@@ -106,8 +432,10 @@ def test_adding_overscan_apogee_u9():
     
 def setup():
     global _test_dir
+    global _original_dir
     from shutil import copy
 
+    _original_dir = getcwd()
     _test_dir = mkdtemp()
     to_write = '# comment 1\nIma Observer\n# comment 2\ney uma\nm101'
     object_file = open(path.join(_test_dir,'obsinfo.txt'),'wb')
@@ -116,4 +444,7 @@ def setup():
 
 def teardown():
     global _test_dir
+    # test_adding_overscan_apogee_u9 changes into a directory below
+    # _test_dir; the modules that run after this one expect the original
+    chdir(_original_dir)
     rmtree(_test_dir)
@@ -14,4 +14,350 @@ def teardown():
     from shutil import rmtree
 
     rmtree(test_dir)
-    
\ No newline at end of file
+    
+def make_reduction_dir(n_lights=5, shape=(30, 20)):
+    """
+    Directory with master darks and flats and `n_lights` light frames
+    with two exposure times and two filters.
+    """
+    from os import path
+    import pyfits
+    directory = mkdtemp()
+    random = np.random.RandomState(3)
+    for time in [10.0, 30.0]:
+        dark = random.normal(100 + time, 5, size=shape)
+        hdu = pyfits.PrimaryHDU(dark)
+        hdu.header.update('imagetyp', 'MASTER DARK')
+        hdu.header.update('exptime', time)
+        hdu.writeto(path.join(directory, 'dark%d.fit' % time))
+    for band in ['R', 'V']:
+        flat = random.normal(20000, 500, size=shape)
+        hdu = pyfits.PrimaryHDU(flat)
+        hdu.header.update('imagetyp', 'MASTER FLAT')
+        hdu.header.update('filter', band)
+        hdu.writeto(path.join(directory, 'flat%s.fit' % band))
+    lights = []
+    for i in range(n_lights):
+        data = random.randint(1000, 30000, size=shape).astype(np.uint16)
+        hdu = pyfits.PrimaryHDU(data, uint=True)
+        hdu.header.update('imagetyp', 'LIGHT')
+        hdu.header.update('exptime', [10.0, 30.0][i % 2])
+        hdu.header.update('filter', ['R', 'V'][(i // 2) % 2])
+        name = 'light%d.fit' % i
+        hdu.writeto(path.join(directory, name))
+        lights.append(name)
+    return directory, lights
+
+def test_batch_reduce_matches_pipeline():
+    from os import path, mkdir
+    from shutil import rmtree
+    import pyfits
+    from .. import reduction
+    directory, lights = make_reduction_dir()
+    try:
+        for name in ['pipeline', 'batch']:
+            mkdir(path.join(directory, name))
+        reduction.reduce(lights, directory,
+                         destination=path.join(directory, 'pipeline'))
+        reduction.reduce(lights, directory,
+                         destination=path.join(directory, 'batch'),
+                         batch_size=2)
+        for light in lights:
+            base, ext = path.splitext(light)
+            reduced = base + '_reduced' + ext
+            pipe = pyfits.getdata(path.join(directory, 'pipeline', reduced))
+            batch = pyfits.getdata(path.join(directory, 'batch', reduced))
+            assert batch.dtype.kind == 'f' and batch.dtype.itemsize == 4
+            assert batch.shape == pipe.shape
+            assert np.allclose(batch, pipe, rtol=1e-5)
+            header = pyfits.getheader(path.join(directory, 'batch', reduced))
+            assert 'bzero' not in header
+            assert header['imagetyp'] == 'LIGHT'
+    finally:
+        rmtree(directory)
+
+def test_batch_reducer_reuses_buffer():
+    from .. import reduction
+    dark = np.ones((4, 3))
+    flat = np.array([[1., 2., 4.]] * 4)
+    reducer = reduction.BatchReducer(dark=dark, flat=flat,
+                                     flat_combine='max', batch_size=3)
+    stack = reducer._stack_for(2, (4, 3))
+    again = reducer._stack_for(3, (4, 3))
+    assert np.may_share_memory(stack, again)
+    frames = np.array([np.full((4, 3), 5.0), np.full((4, 3), 9.0)],
+                      dtype=np.float32)
+    reducer.reduce_stack(frames)
+    assert (frames[0] == [[16., 8., 4.]] * 4).all()
+    assert (frames[1] == [[32., 16., 8.]] * 4).all()
+
+def test_parallel_reduce_matches_batch():
+    from os import path, mkdir, listdir
+    from shutil import rmtree
+    import pyfits
+    from .. import reduction
+    directory, lights = make_reduction_dir(n_lights=9)
+    try:
+        for name in ['batch', 'parallel']:
+            mkdir(path.join(directory, name))
+        reduction.reduce(lights, directory,
+                         destination=path.join(directory, 'batch'),
+                         batch_size=2)
+        reduction.reduce(lights, directory,
+                         destination=path.join(directory, 'parallel'),
+                         batch_size=2, workers=3)
+        reduced = sorted(listdir(path.join(directory, 'batch')))
+        assert reduced == sorted(listdir(path.join(directory, 'parallel')))
+        assert len(reduced) == len(lights)
+        for name in reduced:
+            batch = pyfits.getdata(path.join(directory, 'batch', name))
+            parallel = pyfits.getdata(path.join(directory, 'parallel', name))
+            assert (batch == parallel).all()
+    finally:
+        rmtree(directory)
+
+def test_master_cache_lru_and_byte_budget():
+    from os import path, utime
+    from shutil import rmtree
+    import pyfits
+    from .. import reduction
+    directory = mkdtemp()
+    try:
+        names = []
+        for i in range(3):
+            name = path.join(directory, 'master%d.fit' % i)
+            pyfits.PrimaryHDU(np.zeros((10, 10)) + i).writeto(name)
+            names.append(name)
+        # room for two 800 byte masters
+        cache = reduction.MasterCache(max_bytes=2000)
+        first = cache.array(names[0])
+        assert cache.array(names[0]) is first
+        cache.array(names[1])
+        # names[0] is now more recently used than names[1]
+        cache.array(names[0])
+        cache.array(names[2])
+        assert len(cache) == 2
+        assert cache.nbytes == 1600
+        assert cache.array(names[0]) is first
+        assert (cache.array(names[1]) == 1).all()
+        # a changed file is read again
+        utime(names[1], (1000000000, 1000000000))
+        pyfits.PrimaryHDU(np.zeros((10, 10)) + 7).writeto(names[1],
+                                                          clobber=True)
+        assert (cache.array(names[1]) == 7).all()
+        assert len(cache) == 2
+        small = reduction.MasterCache(max_bytes=100)
+        small.image(names[0])
+        assert len(small) == 0
+    finally:
+        rmtree(directory)
+
+def test_master_cache_is_read_only_and_checks_size():
+    from os import path, utime
+    from shutil import rmtree
+    import pyfits
+    import pytest
+    from .. import reduction
+    directory = mkdtemp()
+    try:
+        name = path.join(directory, 'master.fit')
+        pyfits.PrimaryHDU(np.zeros((10, 10))).writeto(name)
+        utime(name, (1000000000, 1000000000))
+        cache = reduction.MasterCache()
+        with pytest.raises(ValueError):
+            cache.array(name)[0, 0] = 1
+        with pytest.raises(ValueError):
+            cache.image(name).data[0, 0] = 1
+        # rewritten with the same modification time but a new size
+        pyfits.PrimaryHDU(np.ones((12, 12))).writeto(name, clobber=True)
+        utime(name, (1000000000, 1000000000))
+        assert cache.array(name).shape == (12, 12)
+        assert cache.image(name).data.shape == (12, 12)
+    finally:
+        rmtree(directory)
+
+def test_closest_dark_is_scaled_with_bias():
+    from os import path, mkdir
+    from shutil import rmtree
+    import pyfits
+    from .. import reduction
+    directory, lights = make_reduction_dir(n_lights=4)
+    try:
+        bias = np.zeros((30, 20)) + 90.
+        hdu = pyfits.PrimaryHDU(bias)
+        hdu.header.update('imagetyp', 'MASTER BIAS')
+        hdu.writeto(path.join(directory, 'bias.fit'))
+        light = pyfits.open(path.join(directory, lights[0]), uint=True)
+        light[0].header.update('exptime', 15.0)
+        light.writeto(path.join(directory, 'light15.fit'))
+        destination = path.join(directory, 'reduced')
+        mkdir(destination)
+        for workers in [1, 2]:
+            reduction.reduce(['light15.fit'], directory,
+                             destination=destination, batch_size=1,
+                             workers=workers, closest_dark=True)
+            reduced = pyfits.getdata(path.join(destination,
+                                               'light15_reduced.fit'))
+            # darks have 10 and 30 s; 10 is the closest to 15 s
+            dark = pyfits.getdata(path.join(directory, 'dark10.fit'))
+            flat = pyfits.getdata(path.join(directory, 'flat%s.fit' %
+                                            light[0].header['filter']))
+            expected = ((light[0].data - (bias + (dark - bias) * 1.5)) *
+                        np.median(flat) / flat)
+            assert np.allclose(reduced, expected, rtol=1e-5)
+    finally:
+        rmtree(directory)
+
+def overscan_stack(n_frames=3, rows=6, columns=10, start=7):
+    random = np.random.RandomState(5)
+    signal = random.normal(500, 20, size=(n_frames, rows, start))
+    # a bias level that changes from row to row and frame to frame
+    level = (100 + 3 * np.arange(rows)[np.newaxis, :] +
+             10 * np.arange(n_frames)[:, np.newaxis])
+    stack = np.empty((n_frames, rows, columns), dtype=np.float32)
+    stack[:, :, :start] = signal + level[:, :, np.newaxis]
+    stack[:, :, start:] = level[:, :, np.newaxis]
+    return stack, signal
+
+def test_subtract_overscan_columns_and_rows():
+    from .. import reduction
+    stack, signal = overscan_stack()
+    for fit in ['median', 'mean', 1]:
+        trimmed = reduction.subtract_overscan(stack.copy(), 1, 7, fit=fit)
+        assert trimmed.shape == signal.shape
+        assert np.allclose(trimmed, signal, atol=1e-3)
+    # the same with the overscan as a block of rows
+    rows = stack.swapaxes(1, 2).copy()
+    trimmed = reduction.subtract_overscan(rows, 0, 7)
+    assert np.allclose(trimmed, signal.swapaxes(1, 2), atol=1e-3)
+    # a single frame
+    trimmed = reduction.subtract_overscan(stack[0].copy(), 1, 7)
+    assert np.allclose(trimmed, signal[0], atol=1e-3)
+
+def test_subtract_overscan_polynomial_smooths_noise():
+    from .. import reduction
+    stack, signal = overscan_stack(rows=200)
+    random = np.random.RandomState(2)
+    stack[:, :, 7:] += random.normal(0, 2, size=stack[:, :, 7:].shape)
+    by_line = reduction.subtract_overscan(stack.copy(), 1, 7, fit='median')
+    fitted = reduction.subtract_overscan(stack.copy(), 1, 7, fit=1)
+    assert np.std(fitted - signal) < np.std(by_line - signal)
+
+def test_overscan_region():
+    from .. import reduction
+    assert reduction.overscan_region({}) is None
+    assert reduction.overscan_region({'OSCAN': False}) is None
+    assert reduction.overscan_region({'OSCAN': True, 'OSCANAX': 1,
+                                      'OSCANST': 3073}) == (1, 3072)
+    assert reduction.overscan_region({'OSCAN': True, 'OSCANAX': 2,
+                                      'OSCANST': 10}) == (0, 9)
+
+def test_reduce_with_overscan():
+    from os import path, mkdir
+    from shutil import rmtree
+    import pyfits
+    from .. import reduction
+    directory, lights = make_reduction_dir(n_lights=3, shape=(30, 24))
+    try:
+        stack, signal = overscan_stack(n_frames=3, rows=30, columns=24,
+                                       start=20)
+        # masters with overscan columns: the dark includes the bias level
+        # and the flat, made from dark subtracted flats, does not
+        for master, level in [('dark10.fit', 100), ('dark30.fit', 100),
+                              ('flatR.fit', 0), ('flatV.fit', 0)]:
+            hdulist = pyfits.open(path.join(directory, master),
+                                  mode='update')
+            hdulist[0].data[:, 20:] = level
+            hdulist.close()
+        for light, frame in zip(lights, stack):
+            hdulist = pyfits.open(path.join(directory, light))
+            header = hdulist[0].header
+            header.update('oscan', True)
+            header.update('oscanax', 1)
+            # FITS pixel 21 is index 20
+            header.update('oscanst', 21)
+            del header['bzero']
+            pyfits.PrimaryHDU(frame, header).writeto(path.join(directory,
+                                                               light),
+                                                     clobber=True)
+        destination = path.join(directory, 'reduced')
+        mkdir(destination)
+        reduction.reduce(lights, directory, destination=destination,
+                         overscan='median')
+        for i, light in enumerate(lights):
+            header = pyfits.getheader(path.join(directory, light))
+            dark = pyfits.getdata(path.join(directory, 'dark%d.fit' %
+                                            header['exptime']))
+            flat = pyfits.getdata(path.join(directory, 'flat%s.fit' %
+                                            header['filter']))
+            dark = dark[:, :20] - np.median(dark[:, 20:], axis=1)[:, np.newaxis]
+            flat = flat[:, :20] - np.median(flat[:, 20:], axis=1)[:, np.newaxis]
+            expected = (signal[i] - dark) * np.median(flat) / flat
+            reduced = pyfits.open(path.join(destination,
+                                            light.replace('.fit',
+                                                          '_reduced.fit')))
+            assert reduced[0].data.shape == (30, 20)
+            assert np.allclose(reduced[0].data, expected, rtol=1e-4)
+            assert not reduced[0].header['oscan']
+            assert 'oscanst' not in reduced[0].header
+    finally:
+        rmtree(directory)
+
+def test_scale_to_16_bits():
+    from .. import reduction
+    data = np.linspace(-1000.5, 52000.25, 300).reshape(15, 20)
+    data[3, 4] = np.nan
+    scaled, bscale, bzero, blank = reduction.scale_to_16_bits(data)
+    assert scaled.dtype == np.int16
+    assert blank == -32768 and scaled[3, 4] == blank
+    restored = bzero + bscale * scaled.astype(np.float64)
+    finite = np.isfinite(data)
+    assert np.abs(restored - data)[finite].max() <= bscale / 2 * 1.0001
+    assert (scaled[finite] > blank).all()
+    constant, bscale, bzero, blank = reduction.scale_to_16_bits(np.ones((2, 2)))
+    assert blank is None and (bzero + bscale * constant == 1).all()
+
+def test_reduce_output_formats_and_report(capsys):
+    from os import path, mkdir
+    from shutil import rmtree
+    import pyfits
+    from .. import reduction
+    directory, lights = make_reduction_dir(n_lights=6, shape=(60, 50))
+    try:
+        results = {}
+        reports = {}
+        for output_format in ['float64', 'float32', 'scaled16']:
+            destination = path.join(directory, output_format)
+            mkdir(destination)
+            # a memory limit of two frames at a time
+            reports[output_format] = reduction.reduce(lights, directory,
+                                                      destination=destination,
+                                                      output_format=output_format,
+                                                      memory_limit=2 * 4 * 3000)
+            results[output_format] = [pyfits.open(path.join(destination,
+                                                             light.replace('.fit', '_reduced.fit')))
+                                      for light in lights]
+        for output_format, report in reports.items():
+            assert report['frames'] == len(lights)
+            assert report['bytes'] == report['bytes_per_frame'] * len(lights)
+            assert report['seconds_per_frame'] >= 0
+        # the report is returned, not printed
+        assert 'Reduced' not in capsys.readouterr()[0]
+        assert (reduction.format_reduce_report(reports['float32']) ==
+                'Reduced 6 frames in %.2f sec: %.3f sec and %d bytes '
+                'per frame' % (reports['float32']['seconds'],
+                               reports['float32']['seconds_per_frame'],
+                               reports['float32']['bytes_per_frame']))
+        assert reports['scaled16']['bytes'] < reports['float32']['bytes']
+        assert reports['float32']['bytes'] < reports['float64']['bytes']
+        for double, single, scaled in zip(results['float64'],
+                                          results['float32'],
+                                          results['scaled16']):
+            assert double[0].header['bitpix'] == -64
+            assert single[0].header['bitpix'] == -32
+            assert scaled[0].header['bitpix'] == 16
+            assert np.allclose(single[0].data, double[0].data, rtol=1e-6)
+            bscale = scaled[0].header['bscale']
+            assert np.abs(scaled[0].data - double[0].data).max() <= bscale
+    finally:
+        rmtree(directory)
@@ -43,6 +43,144 @@ def test_fits_summary():
 
 
 
+def test_read_header_values_matches_pyfits():
+    keywords = ['imagetyp', 'filter', 'objctra', 'naxis1', 'simple',
+                'object']
+    for file_name in os.listdir(_test_dir):
+        if not (file_name.endswith('.fit') or file_name.endswith('.gz')):
+            continue
+        full_path = os.path.join(_test_dir, file_name)
+        header = pyfits.getheader(full_path)
+        values = tff.read_header_values(full_path, keywords)
+        for keyword in keywords:
+            if keyword in header:
+                assert values[keyword.upper()] == header[keyword]
+                assert type(values[keyword.upper()]) == type(header[keyword])
+            else:
+                assert keyword.upper() not in values
+
+
+def test_read_header_values_card_types():
+    hdu = pyfits.PrimaryHDU(numpy.arange(10))
+    hdu.header.update('quoted', "it's R  ")
+    hdu.header.update('exptime', 30.0)
+    hdu.header.update('binning', 2)
+    hdu.header.update('master', False)
+    hdu.header.update('bigfloat', 1.5e30)
+    hdu.header.update('cplx', complex(1, 2))
+    fname = os.path.join(_test_dir, 'card_types.fits')
+    hdu.writeto(fname)
+    header = pyfits.getheader(fname)
+    keywords = ['quoted', 'exptime', 'binning', 'master', 'bigfloat']
+    values = tff.read_header_values(fname, keywords)
+    for keyword in keywords:
+        assert values[keyword.upper()] == header[keyword]
+        assert type(values[keyword.upper()]) == type(header[keyword])
+    # complex values are not handled by the fast reader
+    assert (tff.read_header_values(fname, ['cplx'])['CPLX'] ==
+            header['cplx'])
+    os.remove(fname)
+
+
+def test_read_header_values_long_string():
+    hdu = pyfits.PrimaryHDU(numpy.arange(10))
+    long_object = 'a very long object name, ' * 6
+    hdu.header.update('object', long_object)
+    hdu.header.update('imagetyp', 'LIGHT')
+    fname = os.path.join(_test_dir, 'long_string.fits')
+    hdu.writeto(fname)
+    header = pyfits.getheader(fname)
+    values = tff.read_header_values(fname, ['object', 'imagetyp'])
+    assert values['OBJECT'] == header['object']
+    assert values['OBJECT'].startswith(long_object.rstrip())
+    assert values['IMAGETYP'] == 'LIGHT'
+    os.remove(fname)
+
+
+def test_mapped_image_matches_pyfits():
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data')
+    names = [os.path.join(data_dir, 'uint16.fit'),
+             os.path.join(_test_dir, 'filter_object_light.fit'),
+             os.path.join(_test_dir, 'filter_object_light.fit.gz')]
+    scaled = pyfits.PrimaryHDU(numpy.arange(24, dtype=numpy.int16).reshape(4, 6))
+    scaled.header.update('bscale', 2.5)
+    scaled.header.update('bzero', 10.0)
+    scaled_name = os.path.join(_test_dir, 'scaled.fits')
+    scaled.writeto(scaled_name)
+    names.append(scaled_name)
+    for name in names:
+        for uint in [False, True]:
+            expected = pyfits.getdata(name, uint=uint)
+            mapped = tff.MappedImage(name, uint=uint)
+            assert mapped.shape == expected.shape
+            full = numpy.asarray(mapped)
+            assert full.dtype == expected.dtype
+            assert (full == expected).all()
+            section = (slice(1, None),) + (slice(None, None, 2),) * (full.ndim - 1)
+            assert (mapped[section] == expected[section]).all()
+    os.remove(scaled_name)
+
+
+def test_mapped_data_is_lazy():
+    collection = tff.ImageFileCollection(location=_test_dir,
+                                         keywords=['imagetyp'])
+    images = list(collection.mapped_data(imagetyp='light'))
+    assert len(images) == len(collection.files_filtered(imagetyp='light'))
+    for img in images:
+        if not img.file_name.endswith('.gz'):
+            # nothing is mapped until the data is used
+            assert img._raw is None
+            assert isinstance(img.raw, numpy.memmap)
+
+
+def test_mapped_data_more_files_than_descriptors():
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = 256
+    if soft != resource.RLIM_INFINITY:
+        limit = min(limit, soft)
+    n_files = limit + 50
+    directory = mkdtemp()
+    try:
+        for i in range(n_files):
+            hdu = pyfits.PrimaryHDU(numpy.arange(100) + i)
+            hdu.header.update('imagetyp', 'BIAS')
+            hdu.writeto(os.path.join(directory, 'bias%03d.fit' % i))
+        collection = tff.ImageFileCollection(location=directory,
+                                             keywords=['imagetyp'])
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            first_pixels = [img[0] for img in collection.mapped_data()]
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        assert sorted(first_pixels) == range(n_files)
+    finally:
+        rmtree(directory)
+
+
+def test_mapped_image_reads_only_axes_present(monkeypatch):
+    asked = []
+    read_header_values = tff.read_header_values
+    def recording_read(file_name, keywords):
+        asked.extend(keywords)
+        return read_header_values(file_name, keywords)
+    monkeypatch.setattr(tff, 'read_header_values', recording_read)
+    mapped = tff.MappedImage(os.path.join(_test_dir,
+                                          'filter_object_light.fit'))
+    assert mapped.shape == (100,)
+    assert (set(keyword for keyword in asked if keyword.startswith('NAXIS'))
+            == set(['NAXIS', 'NAXIS1']))
+
+
+def test_header_not_written_in_place_without_data_flag():
+    # an HDU without pyfits' private _data_loaded might have changed data
+    class UnknownHDU(object):
+        pass
+    fname = os.path.join(_test_dir, 'filter_object_light.fit')
+    assert tff.write_header_in_place([UnknownHDU()], fname) is None
+
+
 class TestImageFileCollection(object):
     
     def test_storage_dir_set(self):
@@ -166,7 +304,405 @@ class TestImageFileCollection(object):
         assert 'filter' not in tbl_new.keys()
         assert 'object' not in tbl_orig.keys()
         
-        
+
+    def test_fits_summary_with_workers(self):
+        keywords = ['imagetyp', 'filter']
+        serial = tff.ImageFileCollection(location=_test_dir,
+                                         keywords=keywords)
+        threaded = tff.ImageFileCollection(location=_test_dir,
+                                           keywords=keywords,
+                                           workers=4)
+        for keyword in ['file'] + keywords:
+            assert (serial.summary_info[keyword] ==
+                    threaded.summary_info[keyword]).all()
+
+    def test_header_cache_skips_unchanged_files(self, monkeypatch):
+        storage = mkdtemp()
+        keywords = ['imagetyp', 'filter']
+        collection = tff.ImageFileCollection(location=_test_dir,
+                                             storage_dir=storage,
+                                             keywords=keywords)
+        assert os.path.exists(os.path.join(storage, tff.header_cache_name))
+
+        def no_reading(*arg, **kwd):
+            raise AssertionError('header should have come from the cache')
+        monkeypatch.setattr(tff, 'read_header_values', no_reading)
+        cached = tff.ImageFileCollection(location=_test_dir,
+                                         storage_dir=storage,
+                                         keywords=keywords)
+        for keyword in ['file'] + keywords:
+            assert (collection.summary_info[keyword] ==
+                    cached.summary_info[keyword]).all()
+        rmtree(storage)
+
+    def test_header_cache_rereads_changed_files(self, monkeypatch):
+        working_dir = mkdtemp()
+        img = numpy.arange(100)
+        for name in ['first.fit', 'second.fit']:
+            hdu = pyfits.PrimaryHDU(img)
+            hdu.header.update('imagetyp', 'LIGHT')
+            hdu.writeto(os.path.join(working_dir, name))
+        tff.ImageFileCollection(location=working_dir, storage_dir=True,
+                                keywords=['imagetyp', 'filter'])
+
+        hdu = pyfits.PrimaryHDU(img)
+        hdu.header.update('imagetyp', 'BIAS')
+        hdu.header.update('filter', 'R')
+        hdu.writeto(os.path.join(working_dir, 'second.fit'), clobber=True)
+
+        read = []
+        read_header_values = tff.read_header_values
+        def counting_read(file_name, keywords):
+            read.append(os.path.basename(file_name))
+            return read_header_values(file_name, keywords)
+        monkeypatch.setattr(tff, 'read_header_values', counting_read)
+        collection = tff.ImageFileCollection(location=working_dir,
+                                             storage_dir=True,
+                                             keywords=['imagetyp',
+                                                       'filter'])
+        assert read == ['second.fit']
+        assert (collection.files_filtered(imagetyp='bias') ==
+                ['second.fit'])
+        rmtree(working_dir)
+
+    def test_refresh_reads_only_changed_files(self, monkeypatch):
+        working_dir = mkdtemp()
+        img = numpy.arange(100)
+        for name in ['keep.fit', 'change.fit', 'delete.fit']:
+            hdu = pyfits.PrimaryHDU(img)
+            hdu.header.update('imagetyp', 'LIGHT')
+            hdu.writeto(os.path.join(working_dir, name))
+        collection = tff.ImageFileCollection(location=working_dir,
+                                             keywords=['imagetyp'])
+
+        os.remove(os.path.join(working_dir, 'delete.fit'))
+        hdu = pyfits.PrimaryHDU(numpy.arange(1000))
+        hdu.header.update('imagetyp', 'DARK')
+        hdu.writeto(os.path.join(working_dir, 'change.fit'), clobber=True)
+        hdu.header.update('imagetyp', 'BIAS')
+        hdu.writeto(os.path.join(working_dir, 'add.fit'))
+
+        read = []
+        read_header_values = tff.read_header_values
+        def counting_read(file_name, keywords):
+            read.append(os.path.basename(file_name))
+            return read_header_values(file_name, keywords)
+        monkeypatch.setattr(tff, 'read_header_values', counting_read)
+
+        changes = collection.refresh()
+        assert sorted(read) == ['add.fit', 'change.fit']
+        assert changes == {'added': ['add.fit'],
+                           'modified': ['change.fit'],
+                           'removed': ['delete.fit']}
+        summary = collection.summary_info
+        assert sorted(summary['file']) == ['add.fit', 'change.fit',
+                                           'keep.fit']
+        assert list(collection.files_filtered(imagetyp='dark')) == \
+            ['change.fit']
+        rmtree(working_dir)
+
+    def test_refresh_updates_summary_in_place(self, monkeypatch):
+        working_dir = mkdtemp()
+        img = numpy.arange(100)
+        for name in ['a.fit', 'b.fit', 'c.fit']:
+            hdu = pyfits.PrimaryHDU(img)
+            hdu.header.update('imagetyp', 'LIGHT')
+            hdu.writeto(os.path.join(working_dir, name))
+        collection = tff.ImageFileCollection(location=working_dir,
+                                             storage_dir=True,
+                                             keywords=['imagetyp',
+                                                       'exptime'])
+        summary = collection.summary_info
+        files = list(summary['file'])
+
+        os.remove(os.path.join(working_dir, files[0]))
+        hdu = pyfits.PrimaryHDU(numpy.arange(1000))
+        hdu.header.update('imagetyp', 'DARK FRAME')
+        hdu.header.update('exptime', 30.0)
+        hdu.writeto(os.path.join(working_dir, files[1]), clobber=True)
+        hdu.writeto(os.path.join(working_dir, 'd.fit'))
+
+        listings = []
+        fits_files_in_directory = collection._fits_files_in_directory
+        def counting_listing(*arg, **kwd):
+            listings.append(1)
+            return fits_files_in_directory(*arg, **kwd)
+        monkeypatch.setattr(collection, '_fits_files_in_directory',
+                            counting_listing)
+        collection.refresh()
+        assert len(listings) == 1
+        assert collection.summary_info is summary
+        assert list(summary['file']) == files[1:] + ['d.fit']
+        assert list(summary['imagetyp']) == ['DARK FRAME', 'LIGHT',
+                                             'DARK FRAME']
+        assert list(summary['exptime'].mask) == [False, True, False]
+        assert summary['exptime'][0] == 30.0
+        assert list(collection.files_filtered(imagetyp='dark frame')) == \
+            [files[1], 'd.fit']
+
+        # only the changes were appended to the cache
+        journal = os.path.join(working_dir,
+                               tff.header_cache_name + '.journal')
+        assert os.path.exists(journal)
+        def no_reading(*arg, **kwd):
+            raise AssertionError('header should have come from the cache')
+        monkeypatch.setattr(tff, 'read_header_values', no_reading)
+        cached = tff.ImageFileCollection(location=working_dir,
+                                         storage_dir=True,
+                                         keywords=['imagetyp', 'exptime'])
+        assert sorted(cached.files_filtered(imagetyp='dark frame')) == \
+            sorted([files[1], 'd.fit'])
+        rmtree(working_dir)
+
+    def test_refresh_touches_only_changed_files(self, monkeypatch):
+        working_dir = mkdtemp()
+        img = numpy.arange(100)
+        for name in ['a.fit', 'b.fit', 'c.fit']:
+            hdu = pyfits.PrimaryHDU(img)
+            hdu.header.update('imagetyp', 'LIGHT')
+            hdu.header.update('exptime', 30.0)
+            hdu.writeto(os.path.join(working_dir, name))
+        collection = tff.ImageFileCollection(location=working_dir,
+                                             keywords=['imagetyp',
+                                                       'exptime'])
+        data = collection.summary_info.data
+        row = list(collection.summary_info['file']).index('b.fit')
+        hdu = pyfits.PrimaryHDU(img)
+        hdu.header.update('imagetyp', 'DARK')
+        hdu.writeto(os.path.join(working_dir, 'b.fit'), clobber=True)
+
+        stats = []
+        stat = os.stat
+        def counting_stat(file_name):
+            stats.append(os.path.basename(file_name))
+            return stat(file_name)
+        monkeypatch.setattr(tff.os, 'stat', counting_stat)
+        changes = collection.refresh(changed=['b.fit'])
+        monkeypatch.undo()
+        assert changes['modified'] == ['b.fit']
+        assert set(stats) == set(['b.fit'])
+        # values that fit the columns are written into the same arrays
+        assert collection.summary_info.data is data
+        assert collection.summary_info['imagetyp'][row] == 'DARK'
+        assert collection.summary_info['exptime'].mask[row]
+        assert list(collection.files_filtered(imagetyp='dark')) == ['b.fit']
+
+        # with no keywords, files are still known to be unchanged
+        plain = tff.ImageFileCollection(location=working_dir)
+        assert plain.refresh()['modified'] == []
+        rmtree(working_dir)
+
+    def test_selected_files_only_are_read(self, monkeypatch):
+        working_dir = mkdtemp()
+        img = numpy.arange(100)
+        for name in ['one.fit', 'two.fit', 'other.fit']:
+            hdu = pyfits.PrimaryHDU(img)
+            hdu.header.update('imagetyp', 'LIGHT')
+            hdu.writeto(os.path.join(working_dir, name))
+
+        read = []
+        read_header_values = tff.read_header_values
+        def counting_read(file_name, keywords):
+            read.append(os.path.basename(file_name))
+            return read_header_values(file_name, keywords)
+        monkeypatch.setattr(tff, 'read_header_values', counting_read)
+
+        collection = tff.ImageFileCollection(location=working_dir,
+                                             keywords=['imagetyp'],
+                                             files=['two.fit', 'one.fit'])
+        assert sorted(read) == ['one.fit', 'two.fit']
+        assert sorted(collection.files) == ['one.fit', 'two.fit']
+        assert len(collection.summary_info) == 2
+        rmtree(working_dir)
+
+    def test_files_filtered_does_not_change_summary(self):
+        collection = tff.ImageFileCollection(location=_test_dir,
+                                             keywords=['imagetyp',
+                                                       'filter'])
+        summary = collection.summary_info
+        n_files = len(collection.paths())
+        n_bias = (summary['imagetyp'] == 'BIAS').sum()
+        n_light = (summary['imagetyp'] == 'LIGHT').sum()
+        n_light_r = ((summary['imagetyp'] == 'LIGHT') &
+                     (summary['filter'] == 'R')).sum()
+        assert len(collection.files_filtered(imagetyp='bias')) == n_bias
+        assert len(collection.files_filtered(imagetyp='light')) == n_light
+        for header in collection.headers(imagetyp='light'):
+            pass
+        assert len(collection.paths()) == n_files
+        assert (len(collection.files_filtered(filter='*')) ==
+                (summary['filter'] != '').sum())
+        assert len(collection.files_filtered(filter='r',
+                                             imagetyp='LIGHT')) == n_light_r
+
+    def test_files_filtered_empty_directory(self):
+        empty_dir = mkdtemp()
+        collection = tff.ImageFileCollection(location=empty_dir,
+                                             keywords=['imagetyp'])
+        assert len(collection.files_filtered(imagetyp='light')) == 0
+        rmtree(empty_dir)
+
+    def test_headers_in_place_writes_only_header(self):
+        working_dir = mkdtemp()
+        data = numpy.arange(10000, dtype=numpy.int16)
+        fname = os.path.join(working_dir, 'in_place.fit')
+        pyfits.PrimaryHDU(data).writeto(fname)
+        size = os.path.getsize(fname)
+        collection = tff.ImageFileCollection(location=working_dir)
+
+        for header in collection.headers(clobber=True, in_place=True):
+            header.update('imagetyp', 'LIGHT')
+        assert collection.bytes_written == {fname: 2880}
+        assert os.path.getsize(fname) == size
+        hdulist = pyfits.open(fname)
+        assert hdulist[0].header['imagetyp'] == 'LIGHT'
+        assert (hdulist[0].data == data).all()
+        hdulist.close()
+
+        # a header that no longer fits forces a full rewrite
+        for header in collection.headers(clobber=True, in_place=True):
+            for i in range(40):
+                header.add_history('line %d' % i)
+        assert collection.bytes_written == {fname: os.path.getsize(fname)}
+        assert os.path.getsize(fname) == size + 2880
+        hdulist = pyfits.open(fname)
+        assert hdulist[0].header['imagetyp'] == 'LIGHT'
+        assert (hdulist[0].data == data).all()
+        hdulist.close()
+        rmtree(working_dir)
+
+    def test_prefetch_and_background_writes(self):
+        working_dir = mkdtemp()
+        for i in range(10):
+            hdu = pyfits.PrimaryHDU(numpy.arange(100) + i)
+            hdu.header.update('imagetyp', 'LIGHT')
+            hdu.header.update('index', i)
+            hdu.writeto(os.path.join(working_dir, 'img%02d.fit' % i))
+        collection = tff.ImageFileCollection(location=working_dir)
+
+        serial = [img.copy() for img in collection.data()]
+        prefetched = [img.copy() for img in collection.data(prefetch=3)]
+        assert len(prefetched) == len(serial)
+        for expected, img in zip(serial, prefetched):
+            assert (expected == img).all()
+
+        for header in collection.headers(save_with_name='_bg', prefetch=2,
+                                         write_depth=2):
+            header.update('object', 'obj%d' % header['index'])
+        assert len(collection.bytes_written) == 10
+        for i in range(10):
+            header = pyfits.getheader(os.path.join(working_dir,
+                                                   'img%02d_bg.fit' % i))
+            assert header['object'] == 'obj%d' % i
+
+        # stopping early must not leave threads waiting
+        for header in collection.headers(prefetch=2, write_depth=1):
+            break
+        rmtree(working_dir)
+
+
+class TestImageFileArchive(object):
+
+    def setup_method(self, method):
+        self.root = mkdtemp()
+        img = numpy.arange(100)
+        nights = {'2012-03-01': ['R', 'V'],
+                  '2012-03-02': ['R'],
+                  os.path.join('april', '2012-04-01'): ['R']}
+        for night, filters in nights.items():
+            directory = os.path.join(self.root, night)
+            os.makedirs(directory)
+            for filter_band in filters:
+                for imagetyp in ['FLAT', 'LIGHT']:
+                    hdu = pyfits.PrimaryHDU(img)
+                    hdu.header.update('imagetyp', imagetyp)
+                    hdu.header.update('filter', filter_band)
+                    hdu.header.update('date-obs',
+                                      os.path.basename(night) + 'T03:00:00')
+                    hdu.writeto(os.path.join(directory, '%s_%s.fit' %
+                                             (imagetyp, filter_band)))
+
+    def teardown_method(self, method):
+        rmtree(self.root)
+
+    def test_summary_spans_directories(self):
+        archive = tff.ImageFileArchive(self.root,
+                                       keywords=['imagetyp', 'filter'])
+        assert len(archive.directories) == 3
+        assert len(archive.summary_info) == 8
+        assert 'directory' in archive.summary_info.keys()
+        for full_path in archive.paths():
+            assert os.path.exists(full_path)
+
+    def test_query_across_nights(self):
+        archive = tff.ImageFileArchive(self.root,
+                                       keywords=['imagetyp', 'filter',
+                                                 'date-obs'])
+        r_flats = archive.files_filtered(imagetyp='flat', filter='r')
+        assert len(r_flats) == 3
+        march_r_flats = archive.files_filtered(imagetyp='flat',
+                                               filter='R',
+                                               date_range=('2012-03',
+                                                           '2012-04'))
+        assert len(march_r_flats) == 2
+        assert all(os.path.basename(os.path.dirname(flat)).startswith(
+            '2012-03') for flat in march_r_flats)
+        with pytest.raises(ValueError):
+            archive.files_filtered(object='m101')
+
+    def test_refresh_adds_directories(self):
+        archive = tff.ImageFileArchive(self.root, keywords=['imagetyp'])
+        new_night = os.path.join(self.root, '2012-03-03')
+        os.mkdir(new_night)
+        hdu = pyfits.PrimaryHDU(numpy.arange(100))
+        hdu.header.update('imagetyp', 'BIAS')
+        hdu.writeto(os.path.join(new_night, 'bias.fit'))
+        archive.refresh()
+        assert len(archive.directories) == 4
+        assert len(archive.files_filtered(imagetyp='bias')) == 1
+
+    def test_refresh_writes_only_changed_catalog_rows(self, monkeypatch):
+        catalog = tff.SummaryCatalog()
+        archive = tff.ImageFileArchive(self.root, keywords=['imagetyp'],
+                                       catalog=catalog)
+        assert len(catalog.files_filtered(imagetyp='*')) == 8
+        written = []
+
+        def recording_update(directory, summary, remove_missing=True):
+            written.extend(summary['file'])
+        monkeypatch.setattr(catalog, 'update', recording_update)
+        archive.refresh()
+        assert written == []
+
+        night = os.path.join(self.root, '2012-03-02')
+        os.remove(os.path.join(night, 'FLAT_R.fit'))
+        hdu = pyfits.PrimaryHDU(numpy.arange(100))
+        hdu.header.update('imagetyp', 'BIAS')
+        hdu.writeto(os.path.join(night, 'bias.fit'))
+        archive.refresh()
+        assert list(written) == ['bias.fit']
+        monkeypatch.undo()
+        assert len(catalog.files_filtered(imagetyp='*')) == 7
+
+    def test_shared_storage_dir_keeps_every_directory(self, monkeypatch):
+        storage = mkdtemp()
+        try:
+            keywords = ['imagetyp', 'filter']
+            archive = tff.ImageFileArchive(self.root, keywords=keywords,
+                                           storage_dir=storage)
+            for directory in archive.directories:
+                assert os.path.exists(os.path.join(storage, directory,
+                                                   tff.header_cache_name))
+
+            def no_reading(*arg, **kwd):
+                raise AssertionError('header should have come from the cache')
+            monkeypatch.setattr(tff, 'read_header_values', no_reading)
+            cached = tff.ImageFileArchive(self.root, keywords=keywords,
+                                          storage_dir=storage)
+            assert len(cached.summary_info) == len(archive.summary_info)
+        finally:
+            rmtree(storage)
+
 def setup_module():
     global _n_test
     global _test_dir